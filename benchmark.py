@@ -0,0 +1,258 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+from time import perf_counter, strftime
+from itertools import product
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import makedirs, walk, wait4, stat, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+from os.path import abspath, dirname, join
+
+class TreeGenerator:
+    """
+    Permite construir en una carpeta temporal un arbol de usuarios sintetico, con la misma estructura que espera
+    el manejador de spam, junto con un lote de dominios y el archivo de configuracion que apunta a ese arbol.
+    Parametros:
+        - users: La cantidad de usuarios a generar.
+        - list_size: La cantidad de dominios de la lista blanca y negra de cada usuario.
+        - batch_size: La cantidad de dominios del lote.
+        - overlap: La fraccion del lote, entre 0 y 1, que ya esta presente en las listas de los usuarios.
+        - line_endings: El formato de las lineas de los archivos: "lf", "crlf", "mixed" (saltos CRLF, lineas vacias
+        y sin salto de linea final) o "no-final-newline".
+        - seed: La semilla usada para que los arboles generados sean reproducibles: cada llamada a generate con los
+        mismos parametros produce el mismo arbol.
+    """
+    def __init__(self, users, list_size, batch_size, overlap, line_endings, seed):
+        self.users = users
+        self.list_size = list_size
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.line_endings = line_endings
+        self.seed = seed
+
+    """
+    Permite obtener el contenido de un archivo a partir de sus lineas, segun el formato de lineas indicado.
+    Parametros:
+        - lines: Las lineas del archivo.
+    """
+    def render(self, lines):
+        if self.line_endings == "crlf":
+            return "".join(f"{line}\r\n" for line in lines)
+        if self.line_endings == "no-final-newline":
+            return "\n".join(lines)
+        if self.line_endings == "mixed":
+            return "\r\n\r\n".join(lines)
+
+        return "".join(f"{line}\n" for line in lines)
+
+    """
+    Permite escribir un archivo con las lineas indicadas, creando las carpetas que falten.
+    Parametros:
+        - path: La ruta del archivo.
+        - lines: Las lineas del archivo.
+    """
+    def write(self, path, lines):
+        makedirs(dirname(path), exist_ok = True)
+
+        with open(path, 'w', newline = '') as file:
+            file.write(self.render(lines))
+
+    """
+    Permite generar el arbol completo en la carpeta indicada. Todas las listas negras contienen los mismos dominios
+    en distinto orden, de modo que la fraccion `overlap` del lote coincide con entradas existentes de cada usuario.
+    Parametros:
+        - root: La carpeta donde se genera el arbol.
+        - action: La accion a medir, que determina el formato del lote ("patch" usa lineas con '+' y '-').
+        - filter: El filtro de usuarios del lote: "", "allow" o "deny".
+    """
+    def generate(self, root, action, filter = ""):
+        self.random = random.Random(self.seed)
+        pool = [f"*@dominio{index}.cl" for index in range(max(self.list_size * 2, 1))]
+        present = pool[:self.list_size]
+        existing = int(round(self.batch_size * self.overlap))
+        batch = self.random.sample(present, min(existing, len(present))) + [f"*@nuevo{index}.com" for index in range(self.batch_size - min(existing, len(present)))]
+        self.random.shuffle(batch)
+
+        names = [f"usuario{index:06d}" for index in range(self.users)]
+
+        for name in names:
+            self.write(join(root, "mail", name, ".spamassassin", "whitelist"), self.random.sample(pool, self.list_size))
+            self.write(join(root, "mail", name, ".spamassassin", "blacklist"), self.random.sample(present, len(present)))
+
+        if action == "patch":
+            half = len(batch) // 2
+            self.write(join(root, "batch", "blacklist"), [f"+{line}" for line in batch[:half]] + [f"-{line}" for line in batch[half:]])
+        else:
+            self.write(join(root, "batch", "blacklist"), batch)
+
+        if filter != "":
+            self.write(join(root, "batch", filter), names[::2])
+
+        self.write(join(root, "config", "parameters.config"), [f"source_path = {join(root, 'mail')}/"])
+        makedirs(join(root, "log"), exist_ok = True)
+
+        return names
+
+class Benchmark:
+    """
+    Permite ejecutar la interfaz de consola real de spager.py y spager3.py sobre arboles sinteticos y medir el
+    tiempo total, el tiempo por usuario, la memoria maxima del proceso y la cantidad de archivos reescritos.
+    Parametros:
+        - interpreters: Diccionario que asocia cada script a medir con el interprete que lo ejecuta.
+        - repeat: La cantidad de veces que se repite cada medicion; cada repeticion usa un arbol nuevo.
+        - jobs: La cantidad de hilos que se entregan al parametro jobs de los scripts.
+    """
+    actions = ["add", "remove", "patch"]
+
+    def __init__(self, interpreters, repeat = 1, jobs = 1):
+        self.interpreters = interpreters
+        self.repeat = repeat
+        self.jobs = jobs
+        self.root = dirname(abspath(__file__))
+
+    """
+    Permite obtener el inodo y la fecha de modificacion de todos los archivos bajo una carpeta, indexados por ruta.
+    Un archivo reemplazado mediante un renombre cambia de inodo y uno escrito en el lugar cambia de fecha, de modo
+    que se cuentan como reescritos aunque su contenido sea el mismo.
+    Parametros:
+        - folder: La carpeta a recorrer.
+    """
+    @staticmethod
+    def snapshot(folder):
+        result = {}
+
+        for path, _, filenames in walk(folder):
+            for filename in filenames:
+                status = stat(join(path, filename))
+                result[join(path, filename)] = (status.st_ino, status.st_mtime_ns)
+
+        return result
+
+    """
+    Permite ejecutar un script como proceso hijo y obtener su codigo de salida, el tiempo transcurrido, la memoria
+    maxima en kilobytes (segun `ru_maxrss` de Linux) y las ultimas lineas de su salida de errores. Si el proceso
+    termina por una señal, el codigo de salida es el numero de la señal con signo negativo, como en subprocess.
+    Parametros:
+        - command: La lista con el interprete, el script y sus argumentos.
+        - cwd: La carpeta desde donde se ejecuta, que contiene config/ y log/.
+    """
+    @staticmethod
+    def run(command, cwd):
+        start = perf_counter()
+        process = subprocess.Popen(command, cwd = cwd, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+        error = process.stderr.read().decode(errors = 'replace')
+        _, status, usage = wait4(process.pid, 0)
+        elapsed = perf_counter() - start
+        process.returncode = -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+        process.stderr.close()
+
+        return process.returncode, elapsed, usage.ru_maxrss, error.strip().splitlines()[-3:]
+
+    """
+    Permite medir un escenario para cada script y repeticion, y retorna una lista con un resultado por medicion.
+    Parametros:
+        - generator: El TreeGenerator que describe el escenario.
+        - action: La accion a medir: "add", "remove" o "patch".
+        - filter: El filtro de usuarios del lote: "", "allow" o "deny".
+    """
+    def measure(self, generator, action, filter = ""):
+        results = []
+
+        for script, interpreter in self.interpreters.items():
+            for repetition in range(self.repeat):
+                folder = mkdtemp(prefix = "spager-benchmark-")
+
+                try:
+                    users = generator.generate(folder, action, filter)
+                    before = Benchmark.snapshot(join(folder, "mail"))
+                    command = [interpreter, join(self.root, script), f"--{action}", "--auto", join(folder, "batch"), "--jobs", str(self.jobs)]
+                    code, elapsed, rss, error = Benchmark.run(command, folder)
+                    after = Benchmark.snapshot(join(folder, "mail"))
+                finally:
+                    rmtree(folder)
+
+                results.append({
+                    "script": script,
+                    "interpreter": interpreter,
+                    "action": action,
+                    "filter": filter,
+                    "users": generator.users,
+                    "list_size": generator.list_size,
+                    "batch_size": generator.batch_size,
+                    "overlap": generator.overlap,
+                    "line_endings": generator.line_endings,
+                    "jobs": self.jobs,
+                    "repetition": repetition,
+                    "exit_code": code,
+                    "seconds": round(elapsed, 6),
+                    "users_per_second": round(len(users) / elapsed, 3) if elapsed > 0 else None,
+                    "ms_per_user": round(elapsed * 1000 / len(users), 6) if len(users) > 0 else None,
+                    "peak_rss_kb": rss,
+                    "files_rewritten": sum(1 for path, state in after.items() if before.get(path) != state),
+                    "error": error if code != 0 else []
+                    })
+
+        return results
+
+    """
+    Permite obtener la revision de git del repositorio, para poder comparar resultados entre versiones.
+    """
+    def revision(self):
+        try:
+            return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd = self.root, stderr = subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+"""
+Se definen los parametros del benchmark. Todos los parametros de tamaño aceptan varios valores y se mide cada
+combinacion posible:
+    - users, list_size, batch_size, overlap y line_endings: Describen los arboles sinteticos a generar.
+    - actions: Las acciones a medir.
+    - filters: Los filtros de usuarios a medir; "none" mide el lote sin filtro.
+    - scripts: Los scripts a medir, junto con python2 y python3 para indicar sus interpretes.
+    - output: La ruta del archivo JSON con los resultados; si no se indica, se escriben en la salida estandar.
+"""
+parser = argparse.ArgumentParser(description="Mide el rendimiento de spager.py y spager3.py sobre arboles de usuarios sinteticos.")
+
+parser.add_argument("--users", type=int, nargs="+", default=[100], help="Cantidades de usuarios a generar.")
+parser.add_argument("--list-size", type=int, nargs="+", default=[100], help="Cantidades de dominios por lista de cada usuario.")
+parser.add_argument("--batch-size", type=int, nargs="+", default=[100], help="Cantidades de dominios del lote.")
+parser.add_argument("--overlap", type=float, nargs="+", default=[0.5], help="Fracciones del lote ya presentes en las listas, entre 0 y 1.")
+parser.add_argument("--line-endings", nargs="+", default=["lf"], choices=["lf", "crlf", "mixed", "no-final-newline"], help="Formatos de linea de los archivos generados.")
+parser.add_argument("--actions", nargs="+", default=Benchmark.actions, choices=Benchmark.actions, help="Acciones a medir.")
+parser.add_argument("--filters", nargs="+", default=["none"], choices=["none", "allow", "deny"], help="Filtros de usuarios a medir.")
+parser.add_argument("--scripts", nargs="+", default=["spager.py", "spager3.py"], choices=["spager.py", "spager3.py"], help="Scripts a medir.")
+parser.add_argument("--python2", default="python2", help="Interprete usado para spager.py.")
+parser.add_argument("--python3", default=sys.executable, help="Interprete usado para spager3.py.")
+parser.add_argument("--repeat", type=int, default=1, help="Cantidad de repeticiones de cada medicion.")
+parser.add_argument("--jobs", type=int, default=1, help="Valor del parametro jobs de los scripts.")
+parser.add_argument("--seed", type=int, default=0, help="Semilla para generar los arboles.")
+parser.add_argument("--output", default="", help="Ruta del archivo JSON con los resultados.")
+
+args = parser.parse_args()
+
+try:
+    if any(value < 0 or value > 1 for value in args.overlap):
+        raise Exception("El parametro overlap debe estar entre 0 y 1.")
+    if args.repeat < 1 or args.jobs < 1:
+        raise Exception("Los parametros repeat y jobs deben ser enteros positivos.")
+except Exception as error:
+    parser.error(error)
+
+interpreters = {script: args.python2 if script == "spager.py" else args.python3 for script in args.scripts}
+benchmark = Benchmark(interpreters, args.repeat, args.jobs)
+results = []
+
+for users, list_size, batch_size, overlap, line_endings, action, filter in product(args.users, args.list_size, args.batch_size, args.overlap, args.line_endings, args.actions, args.filters):
+    generator = TreeGenerator(users, list_size, batch_size, overlap, line_endings, args.seed)
+    results += benchmark.measure(generator, action, "" if filter == "none" else filter)
+
+report = json.dumps({"revision": benchmark.revision(), "date": strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "results": results}, indent = 4)
+
+if args.output != "":
+    with open(args.output, 'w') as file:
+        file.write(f"{report}\n")
+else:
+    print(report)
@@ -1,355 +1,5121 @@
-# -*- coding: UTF-8 -*-
-import logging
-import argparse
-import re
-from copy import deepcopy
-from tempfile import mkstemp
-from os import fdopen, remove, walk, listdir
-from shutil import move, copymode
-
-class ParameterManager:
-    format = r'^([a-zA-Z_]+)\s*\=\s*([^\s]+)$'
-    valid_parameters = ["source_path", "whitelist_relative_path", "blacklist_relative_path", "log_path", "log_format"]
-    splitted_parameters = {
-        "whitelist_relative_path": {"key": "relative_paths", "subkey": "whitelist"},
-        "blacklist_relative_path": {"key": "relative_paths", "subkey": "blacklist"}
-        }
-
-    """
-    Permite obtener todos los parametros del archivo de configuracion presentes en la ruta
-    `config/parameters.config` que seran usados como referencia para agregar o eliminar dominios.
-    """
-    @staticmethod
-    def get_parameters(source):
-        parameters = {
-            "source_path": '/home/re000444/mail/imaco.cl/',
-            "relative_paths": {
-                "whitelist": '/.spamassassin/whitelist',
-                "blacklist": '/.spamassassin/blacklist'
-            },
-            "log_path": "log/history.log",
-            "log_format": "[%(levelname)s:%(name)s:%(asctime)s]: %(message)s"
-        }
-        
-        with open(source) as file:
-            for parameter in file:
-                parameter = parameter.strip()
-
-                if parameter == '':
-                    continue
-
-                tokenized_parameter = re.match(ParameterManager.format, parameter)
-
-                if not tokenized_parameter:
-                    raise Exception("La configuracion presenta problemas en la sintaxis. Asegurese de escribir en cada linea el formato PARAMETRO=VALOR.")
-
-                tokenized_parameter = {"name": tokenized_parameter.groups()[0], "value": tokenized_parameter.groups()[1]}
-
-                if tokenized_parameter["name"] not in ParameterManager.valid_parameters:
-                    raise Exception("El parametro {} no existe ya que solo son validos los siguientes: {}".format(tokenized_parameter['name'], ParameterManager.valid_parameters))
-                
-                if tokenized_parameter["name"] in ParameterManager.splitted_parameters.keys():
-                    key = ParameterManager.splitted_parameters[tokenized_parameter["name"]]["key"]
-                    subkey = ParameterManager.splitted_parameters[tokenized_parameter["name"]]["subkey"]
-                    parameters[key][subkey] = tokenized_parameter["value"]
-                else:
-                    parameters[tokenized_parameter["name"]] = tokenized_parameter["value"]
-                
-        return parameters
-
-class SpamManager:
-    parameters = ParameterManager.get_parameters("config/parameters.config")
-    logging_functions = {"info": logging.info, "warning": logging.warning, "error": logging.error}
-
-    def __init__(self):
-        logging.basicConfig(
-            filename = SpamManager.parameters["log_path"],
-            format = SpamManager.parameters["log_format"],
-            level = logging.DEBUG)
-        self.users = next(walk(SpamManager.parameters["source_path"]))[1]
-
-    """
-    Permite registrar en el archivo log un mensaje de cierto tipo, ya sea warning, error o info.
-    """
-    @staticmethod
-    def log_and_print(message, kind):
-        SpamManager.logging_functions[kind](message)
-        print message
-    
-    """
-    Permite almacenar todas las lineas de un archivo como elementos de una lista,
-    saltandose todas aquellas que estan vacias.
-    Parametros:
-        - absolute_path: La ruta absoluta del archivo
-    """
-    @staticmethod
-    def tokenize(absolute_path):
-        result = []
-        
-        with open(absolute_path) as file:
-            for line in file:
-                line = line.strip()
-                if line == '':
-                    continue
-                result.append(line)
-                
-        return result
-    
-    """
-    Permite filtrar que usuarios seran afectados por los cambios hechos en la lista blanca y/o negra.
-    Parametros:
-        - users: La lista de usuarios que se pretende filtrar.
-        - filter: Es un diccionario que puede contener las llaves "allow" y "deny", y junto a ello, las listas
-        de todos los usuarios.
-            -- Si "allow" esta presente, significa que solo los usuarios enlistados son afectados por los cambios.
-            -- Si "deny" esta presente, significa que todos los usuarios seran afectados por los cambios, excepto
-            los enlistados
-    """
-    @staticmethod
-    def filter_as(users, filter):
-        for key, domains in filter.items():
-            if key not in ["allow", "deny"]:
-                raise Exception("Llaves mal provistas en la funcion filter_as; Solo se permiten las siguientes: allow o deny.")
-
-            users, domains = set(users), set(domains)
-
-            """
-            Simula un left join que excluye cualquier elemento del lado derecho, es decir, obtenemos los elementos que no estan
-            presentes en el lado derecho para asi ver si estamos tratando con un usuario que no existe.
-            """
-            if len(domains) != len(users.intersection(domains)):
-                raise Exception("Uno o mas usuarios que trata de filtrar no existen dentro del dominio.")
-            
-            if key == "allow":
-                users = list(domains)
-            else:
-                users = list(users.difference(domains))
-                
-        return users
-
-    """
-    Permite agregar nuevos dominios tanto para la lista blanca como negra de los usuarios, verificando
-    si estos ya se encuentran presentes en las listas actuales; si ocurre una coincidencia, se lanza
-    una excepcion y simplemente se elimina de los nuevos dominios a agregar. Note que el metodo puede
-    agregar solo itemes a la lista blanca, negra o ambas.
-    Parametros:
-        - lists: Un diccionario que puede contener las llaves "whitelist" y "blacklist" junto las listas
-        de todos los posibles dominios a agregar.
-        - filter_as: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
-        los dominios a filtrar.
-            -- Si la llave es "allow", solo se agregaran los nuevos dominios a esos usuarios.
-            -- Si la llave es "deny", se agregaran los dominios a todos los usuarios exceptos a los que
-            indique el filtro de dominios.
-    """
-    def add(self, lists, filter = {}):
-        users = SpamManager.filter_as(self.users, filter)
-            
-        for user in users:
-            paths = {key: "{}{}{}".format(SpamManager.parameters['source_path'], user, SpamManager.parameters['relative_paths'][key]) for key in lists.keys()}
-            inserted_domains = {key: deepcopy(lists[key]) for key in lists.keys()}
-            repeated_domains = {key: [] for key in lists.keys()}
-
-            for key, path in paths.items():
-                last_line_character = ''
-                
-                with open(path, 'r+') as file:          
-                    for domain in file:
-                        last_line_character = domain[-1]
-                        domain = domain.strip()
-                        
-                        if domain == '':
-                            continue
-
-                        if domain in inserted_domains[key]:
-                            inserted_domains[key].remove(domain)
-                            repeated_domains[key].append(domain)
-                
-                with open(path, 'a+') as file:
-                    prepend = ''
-                    domains_concat_by_breaklines = '\n'.join(inserted_domains[key])
-                    
-                    if len(inserted_domains[key]) != 0 and last_line_character != '\n':
-                        prepend = '\n'
-                        
-                    file.write(prepend + domains_concat_by_breaklines)
-
-            summary = "Usuario: {}\n".format(user)
-            
-            for key in lists.keys():
-                summary += "\tLista: {}\n".format(key)
-                summary += "\t\tAgregados: {}\n".format(inserted_domains[key])
-                summary += "\t\tRepetidos: {}\n".format(repeated_domains[key])
-
-            SpamManager.log_and_print(summary, "info")
-
-    """
-    Permite eliminar dominios de la lista blanca y negra de los usuarios. Note que el metodo puede hacerlo solo para
-    itemes de la lista blanca, negra o ambos.
-    Parametros:
-        - Undesirables: Diccionario que puede contener las llaves "whitelist" y "blacklist" junto con una lista de todos
-        los posibles dominios a eliminar.
-        - Filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
-        los dominios a filtrar.
-            -- Si la llave es "allow", solo se agregaran los nuevos dominios a esos usuarios.
-            -- Si la llave es "deny", se agregaran los dominios a todos los usuarios exceptos a los que
-            indique el filtro de dominios.
-    """
-    def remove(self, undesirables, filter = {}):
-        users = SpamManager.filter_as(self.users, filter)
-
-        for user in users:
-            paths = {key: "{}{}{}".format(SpamManager.parameters['source_path'], user, SpamManager.parameters['relative_paths'][key]) for key in undesirables.keys()}
-            dropped_domains = {key: [] for key in undesirables.keys()}
-
-            for key, path in paths.items():
-                temporal_file, absolute_temporal_file_path = mkstemp()
-                
-                with fdopen(temporal_file, 'w') as new_file:
-                    with open(path) as old_file:
-                        for domain in old_file:
-                            domain = domain.strip()
-                            
-                            if domain == '':
-                                continue
-                            
-                            if domain not in undesirables[key]:
-                                new_file.write("{}\n".format(domain))
-                            else:
-                                dropped_domains[key].append(domain)
-                                
-                copymode(path, absolute_temporal_file_path)
-                remove(path)
-                move(absolute_temporal_file_path, path)
-
-            summary = "Usuario: {}\n".format(user)
-
-            for key in undesirables.keys():
-            	summary += "\tLista: {}\n".format(key)
-            	summary += "\t\tEliminados: {}\n".format(dropped_domains[key])
-
-            SpamManager.log_and_print(summary, "info")
-
-"""
-Se definen todos los parametros para ser ejectuado el script en consola: add, remove, whitelist, blacklist, allow y deny.
-    - add: Es un booleano que indica si la accion principal es agregar dominios a la lista negra y/o blanca.
-    remove: Es un booleano que indica si la accion principal es eliminar dominios de la lista negra y/o blanca.
-    whitelist: Ruta del archivo que contiene todos los dominios a agregar. Siguen el formato:
-        *@dominio1
-        *@dominio2
-        ...
-        dominiok
-        dominiok+1
-        ...
-    - blacklist: Ruta del archivo que contiene todos los dominios a agregar. Sigue el formato:
-        *@dominio1
-        *@dominio2
-        ...
-        dominiok
-        dominiok+1
-        ...
-    - allow: Ruta del archivo que contiene todos los usuarios que seran afectados por los cambios. Sigue el formato:
-        usuario1
-        usuario2
-        ...
-    - deny: Ruta del archivo que contiene todos los usuarios que NO seran afectados por los cambios. Sigue el formato:
-        usuario1
-        usuario2
-        ...
-    Note que no esta permitido tener los flags add y remove activos al mismo tiempo.
-"""
-parser = argparse.ArgumentParser()
-
-parser.add_argument("--add",
-                    help="Permite agregar dominios a la lista blanca y/o negra.",
-                    action="store_true")
-parser.add_argument("--remove",
-                    help="Permite eliminar dominios de la lista blanca y/o negra",
-                    action="store_true")
-parser.add_argument("--whitelist",
-                    default="",
-                    type=str,
-                    help="La ruta absoluta o relativa del archivo que contiene todos los dominios que se desean agregar a la lista blanca. Estos deben estar separados por un un salto de linea y pueden ser de la forma '*@dominio', o bien, 'dominio' (sin comillas).")
-parser.add_argument("--blacklist",
-                    default="",
-                    type=str,
-                    help="La ruta absoluta o relativa del archivo que contiene todos los dominios que se desean agregar a la lista negra. Estos deben estar separados por un un salto de linea y pueden ser de la forma '*@dominio', o bien, 'dominio' (sin comillas).")
-parser.add_argument("--allow",
-                    type=str,
-                    default="",
-                    help="La ruta absoluta o relativa del archivo que contiene todos los usuarios a los que se desea aplicar estos nuevos dominios. Todos estos deben estar separados por un salto de linea.")
-parser.add_argument("--deny",
-                    type=str,
-                    default="",
-                    help="La ruta absoluta o relativa del archivo que contiene todos los usuarios a los que no se desea aplicar estos nuevos dominios. Todos estos deben estar separados por un salto de linea.")
-parser.add_argument("--auto",
-                    type=str,
-                    default="",
-                    help="Permite asociar automÃ¡ticamente la lista blanca, negra, los usuarios denegados y/o permitidos y ejecutar la actualizaciÃ³n de dominios. Como parÃ¡metro debe ser una una ruta relativa o absoluta de la carpeta que tenga todos los archivos anteriormente mencionados. Estos deben llamarse estrictamente whitelist, blacklist, deny y allow.")
-
-args = parser.parse_args()
-
-"""
-Se elige la accion de acuerdo al parametro provisto en la consola. En caso de que uno de los archivos no exista,
-se genera una excepcion y no se realiza nada.
-"""
-try:
-    if args.auto:
-        if not (args.add or args.remove):
-            raise Exception("Debe indicar si desea agregar (add) o eliminar (remove) los dominios.")
-        if args.add and args.remove:
-            raise Exception("Solo se permite agregar o remover dominios a la lista blanca y/o negra, pero no ambas opciones al mismo tiempo.")
-        if args.whitelist or args.blacklist or args.allow or args.deny:
-            raise Exception("No se pueden usar los parámetros whitelist, blacklist, allow o deny cuando el parametro auto esta activo.")
-    else:
-        if not (args.add or args.remove):
-            raise Exception("Debe indicar si desea agregar (add) o eliminar (remove) los dominios.")
-        if args.add and args.remove:
-            raise Exception("Solo se permite agregar o remover dominios a la lista blanca y/o negra, pero no ambas opciones al mismo tiempo.")
-        if not (args.whitelist or args.blacklist):
-            raise Exception("Debe indicar como minimo el tipo de lista que desea modificar mediante los parametros whitelist y blacklist.")
-
-    list_filenames = {"whitelist": args.whitelist, "blacklist": args.blacklist}
-    filter_filenames = {"allow": args.allow, "deny": args.deny}
-
-    not_empty_filenames = {key: filename for (key, filename) in list_filenames.items() if filename != ""}
-    not_empty_filters = {key: filename for (key, filename) in filter_filenames.items() if filename != ""}
-        
-    lists = {}
-    filters = {}
-
-    manager = SpamManager()
-
-    """
-    Cuando el parametro auto esta activado, se tomaran todos los archivos con nombres 
-    """
-    if args.auto != "":
-        listnames = listdir(args.auto)
-        available_listnames = ["whitelist", "blacklist"]
-        available_filternames = ["allow", "deny"]
-
-        if args.auto[-1] != "/":
-            args.auto += "/"
-        
-        for listname in listnames:
-            filename = "{}{}".format(args.auto, listname)
-            
-            if listname in available_listnames:
-                not_empty_filenames[listname] = filename
-            if listname in available_filternames:
-                not_empty_filters[listname] = filename
-
-    for key, filename in not_empty_filenames.items():
-        lists[key] = SpamManager.tokenize(filename)
-
-    for key, filename in not_empty_filters.items():
-        filters[key] = SpamManager.tokenize(filename)
-
-    if args.add:
-        manager.add(lists, filters)
-    elif args.remove:
-        manager.remove(lists, filters)
-        
-except IOError as error:
-    parser.error("Una o muchas rutas de los archivos son invalidas.")
-except Exception as error:
-    parser.error(error)
+# -*- coding: UTF-8 -*-
+import logging
+import sys
+import atexit
+import argparse
+import re
+import json
+import socket
+import signal
+import ctypes
+import sqlite3
+import zlib
+from ctypes.util import find_library
+from select import select, error as select_error
+from time import time, sleep
+from time import time as perf_counter
+from hashlib import sha1
+from threading import Lock, Thread, BoundedSemaphore, current_thread
+from collections import Counter
+from heapq import merge
+from itertools import islice, chain
+from contextlib import closing, contextmanager
+from fnmatch import translate
+from tempfile import mkstemp
+from glob import glob
+from os import fdopen, remove, rename, listdir, fstat, stat, close, fsync, chmod, umask, O_RDONLY
+from os import read as os_read
+from os import open as os_open
+from os.path import dirname, exists, isdir, splitext, commonprefix
+from mmap import mmap, ACCESS_READ
+from shutil import copymode, copyfileobj
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+class ParameterManager:
+    format = r'^([a-zA-Z_]+)\s*\=\s*([^\s]+)$'
+    valid_parameters = ["source_path", "whitelist_relative_path", "blacklist_relative_path", "log_path", "log_format", "manifest_path", "index_path", "roster_path", "store_path", "journal_path", "checkpoint_path", "history_path", "groups_path", "memory_budget", "socket_path", "daemon_interval", "io_bytes_per_second", "io_files_per_second", "io_concurrency", "io_latency"]
+    integer_parameters = ["memory_budget", "daemon_interval", "io_bytes_per_second", "io_files_per_second", "io_concurrency", "io_latency"]
+    splitted_parameters = {
+        "whitelist_relative_path": {"key": "relative_paths", "subkey": "whitelist"},
+        "blacklist_relative_path": {"key": "relative_paths", "subkey": "blacklist"}
+        }
+    tenant_paths = ["log_path", "manifest_path", "index_path", "roster_path", "store_path", "journal_path", "checkpoint_path", "history_path"]
+
+    """
+    Permite obtener los parametros por defecto, usados cuando la configuracion no los indica.
+    """
+    @staticmethod
+    def defaults():
+        return {
+            "source_path": '/home/re000444/mail/imaco.cl/',
+            "relative_paths": {
+                "whitelist": '/.spamassassin/whitelist',
+                "blacklist": '/.spamassassin/blacklist'
+            },
+            "log_path": "log/history.log",
+            "log_format": "[%(levelname)s:%(name)s:%(asctime)s]: %(message)s",
+            "manifest_path": "log/manifest.json",
+            "index_path": "log/index.db",
+            "roster_path": "log/roster.json",
+            "store_path": "log/policy.db",
+            "journal_path": "log/journal.log",
+            "checkpoint_path": "log/checkpoint.log",
+            "history_path": "log/changes.db",
+            "groups_path": "config/groups.config",
+            "memory_budget": 1000000,
+            "socket_path": "log/spager.sock",
+            "daemon_interval": 5,
+            "io_bytes_per_second": 0,
+            "io_files_per_second": 0,
+            "io_concurrency": 0,
+            "io_latency": 0
+        }
+
+    """
+    Permite obtener la configuracion a partir de distintas fuentes:
+        - None: Se lee el archivo por defecto `config/parameters.config`.
+        - Una ruta: Se lee el archivo de configuracion indicado.
+        - Un diccionario: Se toman los parametros con los mismos nombres y valores del archivo de configuracion,
+        por ejemplo {"source_path": "/home/mail/", "log_path": "/var/log/spager.log"}.
+    Parametros:
+        - config: La fuente de la configuracion.
+    """
+    @staticmethod
+    def load(config = None):
+        if config is None:
+            return ParameterManager.expand(ParameterManager.get_parameters("config/parameters.config"))
+        if isinstance(config, dict):
+            parameters = ParameterManager.defaults()
+
+            for name, value in config.items():
+                ParameterManager.set_parameter(parameters, name, str(value))
+
+            return ParameterManager.expand(parameters)
+
+        return ParameterManager.expand(ParameterManager.get_parameters(config))
+
+    """
+    Permite obtener las carpetas de usuarios (dominios) indicadas en source_path, que puede ser una sola carpeta,
+    varias carpetas separadas por comas o patrones con comodines (por ejemplo, '/home/*/mail/*/'). Las carpetas
+    quedan en el parametro "tenants", asociadas a un nombre que las distingue: la parte de su ruta que no comparten
+    con las demas. Si hay una sola carpeta, esta queda ademas como source_path.
+    Parametros:
+        - parameters: La configuracion a completar.
+    """
+    @staticmethod
+    def expand(parameters):
+        source_path = parameters["source_path"]
+
+        if ',' not in source_path and not any(character in source_path for character in "*?["):
+            parameters["tenants"] = {"": source_path}
+            return parameters
+
+        roots = set()
+
+        for pattern in source_path.split(','):
+            if pattern == '':
+                continue
+
+            if any(character in pattern for character in "*?["):
+                roots.update(root.rstrip('/') + '/' for root in glob(pattern) if isdir(root))
+            elif isdir(pattern):
+                roots.add(pattern.rstrip('/') + '/')
+            else:
+                raise Exception("La carpeta {} del parametro source_path no existe.".format(pattern))
+
+        if len(roots) == 0:
+            raise Exception("El parametro source_path no coincide con ninguna carpeta.")
+
+        roots = sorted(roots)
+        prefix = commonprefix(roots) if len(roots) > 1 else dirname(roots[0].rstrip('/')) + '/'
+        prefix = prefix[:prefix.rfind('/') + 1]
+        parameters["tenants"] = {root[len(prefix):].strip('/').replace('/', '_'): root for root in roots}
+
+        if len(roots) == 1:
+            parameters["source_path"] = roots[0]
+
+        return parameters
+
+    """
+    Permite obtener la configuracion de uno de los dominios de source_path: su carpeta queda como source_path, y el
+    log, el manifiesto, el indice y la lista de usuarios se guardan en archivos propios, agregando el nombre del
+    dominio antes de la extension (por ejemplo, 'log/history.imaco.cl.log').
+    Parametros:
+        - parameters: La configuracion completa.
+        - name: El nombre del dominio (ver expand).
+    """
+    @staticmethod
+    def tenant(parameters, name):
+        result = dict(parameters)
+        result["relative_paths"] = dict(parameters["relative_paths"])
+        result["source_path"] = parameters["tenants"][name]
+        result["tenants"] = {name: result["source_path"]}
+
+        for key in ParameterManager.tenant_paths:
+            base, extension = splitext(parameters[key])
+            result[key] = "{}.{}{}".format(base, name, extension)
+
+        return result
+
+    """
+    Permite obtener todos los parametros del archivo de configuracion presentes en la ruta
+    `config/parameters.config` que seran usados como referencia para agregar o eliminar dominios.
+    """
+    @staticmethod
+    def get_parameters(source):
+        parameters = ParameterManager.defaults()
+        
+        with open(source) as file:
+            for parameter in file:
+                parameter = parameter.strip()
+
+                if parameter == '':
+                    continue
+
+                tokenized_parameter = re.match(ParameterManager.format, parameter)
+
+                if not tokenized_parameter:
+                    raise Exception("La configuracion presenta problemas en la sintaxis. Asegurese de escribir en cada linea el formato PARAMETRO=VALOR.")
+
+                ParameterManager.set_parameter(parameters, tokenized_parameter.groups()[0], tokenized_parameter.groups()[1])
+                
+        return parameters
+
+    """
+    Permite validar un parametro y asignarlo a la configuracion.
+    Parametros:
+        - parameters: La configuracion a modificar.
+        - name: El nombre del parametro.
+        - value: El valor del parametro, como texto.
+    """
+    @staticmethod
+    def set_parameter(parameters, name, value):
+        if name not in ParameterManager.valid_parameters:
+            raise Exception("El parametro {} no existe ya que solo son validos los siguientes: {}".format(name, ParameterManager.valid_parameters))
+        
+        if name in ParameterManager.integer_parameters:
+            if not value.isdigit():
+                raise Exception("El parametro {} debe ser un entero positivo.".format(name))
+
+            value = int(value)
+
+        if name in ParameterManager.splitted_parameters.keys():
+            key = ParameterManager.splitted_parameters[name]["key"]
+            subkey = ParameterManager.splitted_parameters[name]["subkey"]
+            parameters[key][subkey] = value
+        else:
+            parameters[name] = value
+
+class MatchingEngine:
+    """
+    Permite construir, una sola vez por ejecucion, los indices de busqueda de los dominios provistos para cada
+    tipo de lista, de modo que comparar una linea de un archivo contra el lote sea una consulta en un conjunto
+    y no un recorrido por toda la lista.
+    Parametros:
+        - lists: Un diccionario que puede contener las llaves "whitelist" y "blacklist" junto con las listas
+        de todos los dominios del lote, en el orden en que fueron ingresados.
+    """
+    def __init__(self, lists):
+        self.ordered = {key: tuple(MatchingEngine.normalize(domain) for domain in domains) for key, domains in lists.items()}
+        self.domains = {key: frozenset(domains) for key, domains in self.ordered.items()}
+        self.multiplicity = {key: Counter(domains) for key, domains in self.ordered.items()}
+        self.encoded = self.domains
+        self.tries = {}
+
+    """
+    Permite construir el motor de busqueda adecuado para el lote. Si cada lista tiene a lo mas `budget` dominios,
+    se mantienen en memoria; si alguna lo supera, el lote completo se ordena y deduplica en disco y se compara
+    contra cada usuario mediante una mezcla ordenada (ver SpilledEngine).
+    Parametros:
+        - lists: Un diccionario con los dominios de cada tipo de lista, ya sea como listas o generadores.
+        - budget: La cantidad maxima de dominios por lista que se mantienen en memoria.
+    """
+    @staticmethod
+    def build(lists, budget):
+        heads = {}
+        tails = {}
+
+        for key, domains in lists.items():
+            tails[key] = iter(domains)
+            heads[key] = list(islice(tails[key], budget + 1))
+
+        if all(len(head) <= budget for head in heads.values()):
+            return MatchingEngine(heads)
+
+        return SpilledEngine({key: chain(heads[key], tails[key]) for key in lists.keys()}, budget)
+
+    """
+    Permite llevar un dominio a la forma en que se compara contra las listas de los usuarios.
+    """
+    @staticmethod
+    def normalize(domain):
+        return domain.strip()
+
+    def keys(self):
+        return self.ordered.keys()
+
+    def contains(self, key, domain):
+        return domain in self.domains[key] or (key in self.tries and self.tries[key].covers(domain))
+
+    """
+    Permite que las consultas tambien consideren como coincidencia toda entrada que cae bajo un dominio del
+    lote; por ejemplo, eliminar '*@example.com' elimina tambien 'example.com', '*@mail.example.com' y
+    'jose@example.com'.
+    """
+    def index_subdomains(self):
+        self.tries = {key: DomainTrie(domains) for key, domains in self.ordered.items()}
+
+    """
+    Permite obtener una huella de los dominios del lote para una lista, que cambia si cambia cualquier dominio
+    o su orden.
+    Parametros:
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def fingerprint(self, key):
+        return sha1('\n'.join(self.ordered[key])).hexdigest()
+
+    """
+    Permite obtener los dominios del lote que aparecen entre las lineas de un archivo, comparando directamente
+    los bytes de cada linea sin decodificarlas.
+    Parametros:
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - lines: Las lineas del archivo, como bytes y sin espacios en los extremos.
+    """
+    def matches(self, key, lines):
+        if key not in self.tries:
+            return {line for line in lines if line in self.encoded[key]}
+
+        return {line for line in lines if line in self.encoded[key] or self.tries[key].covers(line)}
+
+    """
+    Indica si los dominios del lote se pueden buscar directamente en una lista ordenada y sin duplicados (ver
+    SortedList), lo que no es posible si se consideran subdominios.
+    Parametros:
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def searchable(self, key):
+        return key not in self.tries
+
+    def close(self):
+        pass
+
+    """
+    Permite obtener los dominios del lote para una lista, en el orden en que fueron ingresados.
+    Parametros:
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def contents(self, key):
+        return list(self.ordered[key])
+
+    """
+    Permite obtener un contador que registra las coincidencias de una lista de un usuario con el lote.
+    Parametros:
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def tally(self, key):
+        return DomainTally(self, key)
+
+class DomainTally:
+    """
+    Registra las lineas de un archivo que ya estan presentes en el lote. Un dominio repetido en el lote se
+    considera repetido en el archivo tantas veces como aparezca en ambos, tal como lo haria `list.remove`.
+    """
+    def __init__(self, engine, key):
+        self.engine = engine
+        self.key = key
+        self.claimed = {}
+        self.repeated = []
+
+    def feed(self, domain):
+        if domain not in self.engine.domains[self.key]:
+            return
+
+        claimed = self.claimed.get(domain, 0)
+
+        if claimed < self.engine.multiplicity[self.key][domain]:
+            self.claimed[domain] = claimed + 1
+            self.repeated.append(domain)
+
+    """
+    Retorna los dominios a agregar, en el orden del lote, y los dominios repetidos en el orden del archivo.
+    """
+    def result(self):
+        pending = dict(self.claimed)
+        inserted = []
+
+        for domain in self.engine.ordered[self.key]:
+            if pending.get(domain, 0) > 0:
+                pending[domain] -= 1
+            else:
+                inserted.append(domain)
+
+        return inserted, self.repeated
+
+class DomainTrie:
+    """
+    Indice de entradas de una lista organizado por las etiquetas de su dominio en orden inverso ('mail.example.com'
+    se guarda como com -> example -> mail), lo que permite saber en tiempo proporcional a la cantidad de etiquetas
+    si una entrada ya esta cubierta por otra mas amplia. Las formas '*@dominio' y 'dominio' son equivalentes y
+    cubren al dominio, a todas sus direcciones y a todos sus subdominios; '*@*.dominio' cubre solo a los
+    subdominios, y 'usuario@dominio' es una direccion concreta que no cubre a ninguna otra entrada.
+    Parametros:
+        - entries: Las entradas con las que se inicializa el indice.
+    """
+    def __init__(self, entries = ()):
+        self.root = TrieNode()
+
+        for entry in entries:
+            self.insert(entry)
+
+    """
+    Permite descomponer una entrada en las etiquetas invertidas de su dominio, la parte local si es una direccion
+    concreta (o None si aplica a todo el dominio) y si aplica solo a los subdominios. Retorna None si la entrada
+    no tiene la forma de un dominio.
+    Parametros:
+        - entry: La entrada a descomponer.
+    """
+    @staticmethod
+    def parse(entry):
+        local, separator, domain = entry.strip().lower().rpartition('@')
+
+        if separator == '' or local == '*':
+            local = None
+
+        subtree = domain.startswith('*.')
+
+        if subtree:
+            domain = domain[2:]
+
+        labels = domain.split('.')
+
+        if '' in labels or any('*' in label for label in labels):
+            return None
+
+        return tuple(reversed(labels)), local, subtree
+
+    """
+    Permite obtener la forma canonica de una entrada: en minusculas y con la forma 'dominio' escrita como
+    '*@dominio'. Las entradas que no tienen la forma de un dominio solo se limpian de espacios en los extremos.
+    Parametros:
+        - entry: La entrada a normalizar.
+    """
+    @staticmethod
+    def canonical(entry):
+        entry = entry.strip()
+        parsed = DomainTrie.parse(entry)
+
+        if parsed is None or len(entry.split()) != 1:
+            return entry
+
+        labels, local, subtree = parsed
+        domain = '.'.join(reversed(labels))
+
+        return "{}@{}{}".format(local or '*', '*.' if subtree else '', domain)
+
+    """
+    Permite obtener, en forma canonica, las entradas mas amplias que cubren a una entrada (ver covers): los
+    dominios padre y, si la entrada es una direccion concreta o solo aplica a los subdominios, su propio dominio.
+    Parametros:
+        - entry: La entrada a consultar.
+    """
+    @staticmethod
+    def ancestors(entry):
+        parsed = DomainTrie.parse(entry)
+
+        if parsed is None or len(entry.split()) != 1:
+            return []
+
+        labels, local, subtree = parsed
+        result = []
+
+        for size in range(1, len(labels)):
+            domain = '.'.join(reversed(labels[:size]))
+            result += ["*@{}".format(domain), "*@*.{}".format(domain)]
+
+        if local is not None or subtree:
+            result.append("*@{}".format('.'.join(reversed(labels))))
+
+        return result
+
+    def insert(self, entry):
+        parsed = DomainTrie.parse(entry)
+
+        if parsed is None:
+            return
+
+        labels, local, subtree = parsed
+        node = self.root
+
+        for label in labels:
+            node = node.children.setdefault(label, TrieNode())
+
+        if subtree:
+            node.subtree = True
+        elif local is None:
+            node.domain = True
+
+    """
+    Indica si una entrada esta cubierta por alguna entrada del indice: un dominio equivalente o un dominio padre.
+    Parametros:
+        - entry: La entrada a consultar.
+    """
+    def covers(self, entry):
+        parsed = DomainTrie.parse(entry)
+
+        if parsed is None:
+            return False
+
+        labels, local, subtree = parsed
+        node = self.root
+
+        for label in labels:
+            if node.domain or node.subtree:
+                return True
+
+            node = node.children.get(label)
+
+            if node is None:
+                return False
+
+        return node.domain or (subtree and node.subtree)
+
+    """
+    Permite separar, en orden, las entradas que ya estan cubiertas por el indice de las que no. Cada entrada no
+    cubierta se agrega al indice, por lo que tambien se descartan las entradas cubiertas por otras anteriores.
+    Parametros:
+        - entries: Las entradas a revisar.
+    """
+    def prune(self, entries):
+        kept = []
+        covered = []
+
+        for entry in entries:
+            if self.covers(entry):
+                covered.append(entry)
+            else:
+                self.insert(entry)
+                kept.append(entry)
+
+        return kept, covered
+
+class TrieNode:
+    def __init__(self):
+        self.children = {}
+        self.domain = False
+        self.subtree = False
+
+class SortedRun:
+    """
+    Guarda en disco los dominios de un lote, ordenados y sin duplicados, sin mantener en memoria mas de `budget`
+    dominios a la vez: los dominios se acumulan en bloques que se ordenan y escriben en archivos temporales, y
+    luego todos los bloques se mezclan en un unico archivo.
+    Parametros:
+        - domains: Los dominios del lote, ya sea como lista o generador.
+        - budget: La cantidad maxima de dominios que se mantienen en memoria.
+    """
+    def __init__(self, domains, budget):
+        runs = []
+        chunk = set()
+
+        for domain in domains:
+            chunk.add(MatchingEngine.normalize(domain))
+
+            if len(chunk) >= budget:
+                runs.append(SortedRun.spill(sorted(chunk)))
+                chunk = set()
+
+        runs.append(SortedRun.spill(sorted(chunk)))
+
+        digest = sha1()
+        self.count = 0
+        previous = None
+        temporal_file, self.path = mkstemp()
+
+        with fdopen(temporal_file, 'w') as file:
+            for domain in merge(*[SortedRun.read(run) for run in runs]):
+                if domain == previous:
+                    continue
+
+                file.write("{}\n".format(domain))
+                digest.update("{}\n".format(domain))
+                self.count += 1
+                previous = domain
+
+        for run in runs:
+            remove(run)
+
+        self.digest = digest.hexdigest()
+
+    """
+    Permite escribir un bloque de dominios ordenados en un archivo temporal y retorna su ruta.
+    """
+    @staticmethod
+    def spill(domains):
+        temporal_file, absolute_temporal_file_path = mkstemp()
+
+        with fdopen(temporal_file, 'w') as file:
+            for domain in domains:
+                file.write("{}\n".format(domain))
+
+        return absolute_temporal_file_path
+
+    """
+    Permite recorrer los dominios de un archivo con un dominio por linea.
+    """
+    @staticmethod
+    def read(path):
+        with open(path) as file:
+            for line in file:
+                yield line[:-1]
+
+    """
+    Permite obtener, mediante una mezcla, los elementos comunes de dos secuencias ordenadas y sin duplicados.
+    """
+    @staticmethod
+    def intersection(left, right):
+        right = iter(right)
+        current = next(right, None)
+
+        for domain in left:
+            while current is not None and current < domain:
+                current = next(right, None)
+
+            if current is None:
+                return
+
+            if current == domain:
+                yield domain
+
+    def __iter__(self):
+        return SortedRun.read(self.path)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        remove(self.path)
+
+class SpilledDomains:
+    """
+    Representa los dominios de un lote en disco que no estan en un conjunto, sin cargarlos en memoria. Al
+    mostrarse solo indica la cantidad de dominios, ya que el lote puede tener millones.
+    """
+    def __init__(self, run, excluded):
+        self.run = run
+        self.excluded = excluded
+
+    def __iter__(self):
+        return (domain for domain in self.run if domain not in self.excluded)
+
+    def __len__(self):
+        return len(self.run) - len(self.excluded)
+
+    def __str__(self):
+        return "<{} dominios>".format(len(self))
+
+class SpilledEngine:
+    """
+    Motor de busqueda para lotes que superan el presupuesto de memoria. Cada lista del lote se guarda ordenada y
+    sin duplicados en disco (ver SortedRun), y las lineas de cada usuario se ordenan y se mezclan contra ella en
+    lugar de consultarse en un conjunto. A diferencia de MatchingEngine, los dominios repetidos dentro del lote
+    se consideran una sola vez y los dominios agregados se escriben en orden alfabetico.
+    Parametros:
+        - lists: Un diccionario con los dominios de cada tipo de lista, ya sea como listas o generadores.
+        - budget: La cantidad maxima de dominios que se mantienen en memoria.
+    """
+    def __init__(self, lists, budget):
+        self.runs = {}
+
+        try:
+            for key, domains in lists.items():
+                self.runs[key] = SortedRun(domains, budget)
+        except:
+            self.close()
+            raise
+
+    def keys(self):
+        return self.runs.keys()
+
+    def fingerprint(self, key):
+        return self.runs[key].digest
+
+    def tally(self, key):
+        return MergeTally(self.runs[key])
+
+    def index_subdomains(self):
+        raise Exception("La opcion subdomains no esta disponible para lotes que superan el parametro memory_budget.")
+
+    def matches(self, key, lines):
+        return set(SortedRun.intersection(self.runs[key], sorted(set(lines))))
+
+    def searchable(self, key):
+        return False
+
+    def contents(self, key):
+        return SpilledDomains(self.runs[key], set())
+
+    def close(self):
+        for run in self.runs.values():
+            run.close()
+
+class MergeTally:
+    """
+    Equivalente a DomainTally para un lote en disco: guarda las lineas del archivo del usuario y, al final, las
+    mezcla ordenadas contra el lote.
+    """
+    def __init__(self, run):
+        self.run = run
+        self.lines = []
+
+    def feed(self, domain):
+        self.lines.append(domain)
+
+    def result(self):
+        common = set(SortedRun.intersection(self.run, sorted(set(self.lines))))
+        repeated = []
+
+        for domain in self.lines:
+            if domain in common and domain not in repeated:
+                repeated.append(domain)
+
+        return SpilledDomains(self.run, common), repeated
+
+class SortedList:
+    """
+    Permite consultar una lista ordenada y sin duplicados, como las que deja --compact, mediante una busqueda
+    binaria sobre el archivo mapeado en memoria: buscar los dominios de un lote no requiere leer la lista completa.
+    """
+
+    """
+    Permite obtener, ordenados, los dominios que estan presentes en la lista.
+    Parametros:
+        - path: La ruta de la lista.
+        - domains: Los dominios a buscar.
+    """
+    @staticmethod
+    def search(path, domains):
+        with open(path, 'rb') as file:
+            if fstat(file.fileno()).st_size == 0:
+                return []
+
+            with closing(mmap(file.fileno(), 0, access=ACCESS_READ)) as content:
+                return sorted(domain for domain in set(domains) if SortedList.contains(content, domain))
+
+    """
+    Indica si una linea esta en el contenido de una lista ordenada. En cada paso se toma la linea que contiene el
+    punto medio del rango, que siempre comienza y termina en un limite de linea.
+    Parametros:
+        - content: El contenido de la lista, como bytes o mmap.
+        - target: La linea a buscar, como bytes.
+    """
+    @staticmethod
+    def contains(content, target):
+        low, high = 0, len(content)
+
+        while low < high:
+            start = content.rfind(b'\n', low, (low + high) // 2) + 1 or low
+            end = content.find(b'\n', start, high)
+            end = high if end == -1 else end
+            line = content[start:end].strip()
+
+            if line == target:
+                return True
+
+            if line < target:
+                low = end + 1
+            else:
+                high = start
+
+        return False
+
+    """
+    Permite obtener el ultimo caracter de un archivo, o '' si esta vacio, sin leerlo completo.
+    Parametros:
+        - path: La ruta del archivo.
+    """
+    @staticmethod
+    def last_character(path):
+        with open(path, 'rb') as file:
+            size = fstat(file.fileno()).st_size
+
+            if size == 0:
+                return ''
+
+            file.seek(size - 1)
+
+            return file.read(1)
+
+class ListIndex:
+    """
+    Mantiene en memoria las lineas de las listas de los usuarios ya leidas, para que un proceso de larga duracion
+    no tenga que volver a leerlas en cada lote. Cada entrada se valida contra la fecha de modificacion, el tamaño
+    y el inodo del archivo, por lo que cualquier cambio, hecho por el programa o por fuera de el, obliga a leerla
+    de nuevo.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    """
+    Permite obtener las lineas no vacias de una lista y el ultimo caracter del archivo, leyendolo solo si cambio
+    desde la ultima vez.
+    Parametros:
+        - path: La ruta de la lista.
+    """
+    def get(self, path):
+        status = stat(path)
+        signature = (status.st_mtime, status.st_size, status.st_ino)
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        content = SpamManager.read_lines(path)
+
+        with self.lock:
+            self.entries[path] = (signature, content)
+
+        return content
+
+class AddressMatcher:
+    """
+    Compila las entradas de una lista en conjuntos separados de direcciones concretas ('usuario@dominio'), de
+    dominios ('*@dominio') y de dominios cuyos subdominios estan cubiertos ('*@*.dominio'), de modo que revisar una
+    direccion solo requiere buscar en ellos la direccion, su dominio y cada uno de los dominios que lo contienen.
+    Las entradas con comodines en otras posiciones (por ejemplo, 'jose*@dominio') se revisan aparte como patrones.
+    Parametros:
+        - entries: Las entradas de la lista.
+    """
+    def __init__(self, entries):
+        self.addresses = set()
+        self.domains = set()
+        self.subtrees = set()
+        self.patterns = []
+
+        for entry in entries:
+            entry = DomainTrie.canonical(entry)
+            local, separator, domain = entry.rpartition('@')
+            rest = domain[2:] if domain.startswith('*.') else domain
+
+            if '*' in rest or '?' in entry or (local != '*' and '*' in local):
+                self.patterns.append((entry, re.compile(translate(entry.lower()))))
+            elif local == '*' and domain.startswith('*.'):
+                self.subtrees.add(domain[2:])
+            elif local == '*':
+                self.domains.add(domain)
+            else:
+                self.addresses.add(entry)
+
+        self.patterns.sort(key=lambda pattern: pattern[0])
+
+    """
+    Indica si una direccion se puede revisar: debe tener la forma 'usuario@dominio' o 'dominio', sin comodines ni
+    espacios, y el usuario no puede estar vacio ni contener '@'.
+    Parametros:
+        - address: La direccion a revisar.
+    """
+    @staticmethod
+    def valid(address):
+        parsed = DomainTrie.parse(address)
+
+        if parsed is None or '*' in address or '?' in address or len(address.split()) != 1:
+            return False
+
+        return parsed[1] is None or (parsed[1] != '' and '@' not in parsed[1])
+
+    """
+    Permite obtener la entrada que coincide con una direccion, o None si ninguna coincide. '*@dominio' cubre a
+    todas las direcciones del dominio y '*@*.dominio' a las de sus subdominios; si se consideran los subdominios,
+    '*@dominio' cubre tambien a las direcciones de sus subdominios.
+    Parametros:
+        - address: La direccion a revisar, ya sea 'usuario@dominio' o 'dominio'.
+        - subdomains: Indica si se considera la jerarquia de dominios.
+    """
+    def match(self, address, subdomains = False):
+        address = address.strip().lower()
+        domain = address[address.rfind('@') + 1:]
+
+        if address in self.addresses:
+            return address
+        if domain in self.domains:
+            return "*@" + domain
+
+        position = domain.find('.') if subdomains or len(self.subtrees) != 0 else -1
+
+        while position != -1:
+            suffix = domain[position + 1:]
+
+            if suffix in self.subtrees:
+                return "*@*." + suffix
+            if subdomains and suffix in self.domains:
+                return "*@" + suffix
+
+            position = domain.find('.', position + 1)
+
+        for entry, pattern in self.patterns:
+            if pattern.match(address):
+                return entry
+
+        return None
+
+class MatcherCache:
+    """
+    Mantiene en memoria las listas de los usuarios ya compiladas (ver AddressMatcher). Al igual que ListIndex,
+    cada entrada se valida contra la fecha de modificacion, el tamaño y el inodo del archivo, por lo que cualquier
+    cambio obliga a compilarla de nuevo.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    """
+    Permite obtener una lista compilada, o None si la lista no existe.
+    Parametros:
+        - path: La ruta de la lista.
+        - io: Una funcion que recibe la cantidad de bytes a leer y retorna el contexto en que se lee la lista, como
+        SpamManager.io.
+    """
+    def get(self, path, io):
+        with self.lock:
+            entry = self.entries.get(path)
+
+        try:
+            status = stat(path)
+            signature = (status.st_mtime, status.st_size, status.st_ino)
+        except OSError:
+            signature = None
+
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        matcher = None
+
+        if signature is not None:
+            with io(signature[1]):
+                matcher = AddressMatcher(line for line in SpamManager.scan(path))
+
+        with self.lock:
+            self.entries[path] = (signature, matcher)
+
+        return matcher
+
+class RosterCache:
+    """
+    Guarda en disco los usuarios de source_path junto con la fecha de modificacion de la carpeta, de modo que no
+    sea necesario listar todos los buzones en cada ejecucion: la carpeta solo cambia al crear o eliminar buzones.
+    Tambien se guardan los buzones que no tienen ninguna lista, para revisar solo esos en cada ejecucion.
+    Parametros:
+        - path: La ruta del archivo.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    """
+    Permite obtener los usuarios guardados, o None si no hay usuarios guardados para la carpeta y las rutas de
+    las listas indicadas, o si la carpeta cambio desde entonces.
+    Parametros:
+        - source_path: La carpeta de los usuarios.
+        - relative_paths: Las rutas de las listas de cada usuario.
+        - mtime: La fecha de modificacion actual de la carpeta.
+    """
+    def load(self, source_path, relative_paths, mtime):
+        try:
+            with open(self.path) as file:
+                roster = json.load(file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if roster.get("source_path") != source_path or roster.get("relative_paths") != relative_paths or roster.get("mtime") != mtime:
+            return None
+
+        roster["users"] = [str(user) for user in roster["users"]]
+        roster["empty"] = [str(user) for user in roster["empty"]]
+
+        return roster
+
+    """
+    Permite guardar los usuarios, reemplazando el archivo anterior mediante un renombre atomico. Si el archivo no
+    se puede escribir, los usuarios se vuelven a listar en la siguiente ejecucion.
+    Parametros:
+        - roster: El diccionario con la carpeta, las rutas de las listas, la fecha de modificacion, los usuarios y
+        los buzones sin listas.
+    """
+    def save(self, roster):
+        try:
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(self.path) or '.')
+
+            with fdopen(temporal_file, 'w') as file:
+                json.dump(roster, file, sort_keys=True)
+
+            rename(absolute_temporal_file_path, self.path)
+        except (IOError, OSError):
+            pass
+
+class UserFilter:
+    """
+    Compila las lineas de un filtro allow o deny. Cada linea puede ser el nombre exacto de un usuario, un patron
+    con los comodines '*' y '?' (por ejemplo, 'ventas-*'), una expresion regular con el prefijo 're:' que debe
+    coincidir con el nombre completo (por ejemplo, 're:soporte[0-9]+') o un grupo con nombre con el prefijo '@'
+    (por ejemplo, '@ventas'), definido en el archivo de grupos (ver load_groups). Los patrones y grupos se compilan
+    en una sola expresion regular, con un grupo de captura por linea, de modo que cada usuario se revisa una sola
+    vez y se sabe que lineas lo seleccionaron.
+    Parametros:
+        - lines: Las lineas del filtro.
+        - groups: Un diccionario que asocia el nombre de cada grupo con sus entradas.
+    """
+    group_format = r'^([a-zA-Z_][a-zA-Z0-9_]*)\s*\=\s*([^\s]+)$'
+
+    def __init__(self, lines, groups = {}):
+        self.names = set()
+        self.patterns = []
+
+        for line in lines:
+            line = line.strip()
+
+            if line.startswith("@"):
+                if line[1:] not in groups:
+                    raise Exception("El grupo {} no existe; los grupos se definen en el archivo indicado en groups_path.".format(line[1:]))
+
+                expression = '|'.join("(?:{})".format(UserFilter.translate(entry) or re.escape(entry)) for entry in groups[line[1:]])
+            else:
+                expression = UserFilter.translate(line)
+
+                if expression is None:
+                    self.names.add(line)
+                    continue
+
+            try:
+                re.compile(expression)
+            except re.error as error:
+                raise Exception("El patron {} no es valido: {}".format(line, error))
+
+            self.patterns.append((line, expression))
+
+        self.labels = ["patron{}".format(index) for index in range(len(self.patterns))]
+        self.expression = None
+
+        """
+        Cada linea es una busqueda hacia adelante opcional, de modo que una sola coincidencia indica todas las
+        lineas que seleccionan al usuario y no solo la primera.
+        """
+        if len(self.patterns) != 0:
+            try:
+                self.expression = re.compile(''.join("(?:(?=(?P<{}>(?:{})\\Z)))?".format(label, expression) for label, (line, expression) in zip(self.labels, self.patterns)))
+            except re.error as error:
+                raise Exception("Los patrones del filtro no son validos en conjunto: {}".format(error))
+
+    """
+    Permite obtener la expresion regular de una linea de un filtro, o None si es un nombre exacto.
+    Parametros:
+        - line: La linea del filtro.
+    """
+    @staticmethod
+    def translate(line):
+        if line.startswith("re:"):
+            return line[3:]
+        if '*' in line or '?' in line:
+            return ''.join('.*' if character == '*' else '.' if character == '?' else re.escape(character) for character in line)
+
+        return None
+
+    """
+    Permite leer el archivo de grupos de usuarios, donde cada linea tiene la forma GRUPO=ENTRADA y la entrada puede
+    ser un nombre exacto, un patron o una expresion regular, igual que en los filtros. Un grupo puede tener varias
+    lineas. Retorna un diccionario que asocia cada grupo con sus entradas, vacio si el archivo no existe.
+    Parametros:
+        - path: La ruta del archivo de grupos.
+    """
+    @staticmethod
+    def load_groups(path):
+        groups = {}
+
+        if not exists(path):
+            return groups
+
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+
+                if line == '':
+                    continue
+
+                tokenized_line = re.match(UserFilter.group_format, line)
+
+                if not tokenized_line:
+                    raise Exception("El archivo de grupos {} presenta problemas en la sintaxis en la linea '{}'. Asegurese de escribir en cada linea el formato GRUPO=USUARIO.".format(path, line))
+
+                groups.setdefault(tokenized_line.groups()[0], []).append(tokenized_line.groups()[1])
+
+        return groups
+
+    """
+    Permite obtener, en una sola pasada, los usuarios seleccionados por el filtro. Retorna el conjunto de
+    usuarios seleccionados y la lista de patrones y grupos que no seleccionaron a ningun usuario.
+    Parametros:
+        - users: Los usuarios a revisar.
+    """
+    def select(self, users):
+        selected = set()
+        used = set()
+
+        for user in users:
+            if user in self.names:
+                selected.add(user)
+
+            if self.expression is not None:
+                result = self.expression.match(user)
+                matched = [label for label in self.labels if result.group(label) is not None]
+
+                if len(matched) != 0:
+                    selected.add(user)
+                    used.update(matched)
+
+        unused = [line for label, (line, expression) in zip(self.labels, self.patterns) if label not in used]
+
+        return selected, unused
+
+class StateManifest:
+    """
+    Registra en disco, para cada usuario y lista, el estado del archivo (fecha de modificacion, tamaño y hash de su
+    contenido) junto con la huella del ultimo lote aplicado. Permite saber si una lista ya refleja un lote sin
+    volver a leerla, y detectar las listas que fueron modificadas por fuera del programa.
+    Parametros:
+        - path: La ruta del manifiesto. Si no existe, se comienza con un manifiesto vacio.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.users = {}
+        self.dirty = False
+
+        if exists(path):
+            with open(path) as file:
+                self.users = json.load(file)["users"]
+
+    """
+    Permite obtener el hash del contenido de un archivo, leyendolo por bloques.
+    Parametros:
+        - path: La ruta del archivo.
+    """
+    @staticmethod
+    def digest(path):
+        result = sha1()
+
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 16), b''):
+                result.update(block)
+
+        return result.hexdigest()
+
+    """
+    Indica si la lista de un usuario ya refleja un lote. Si la fecha de modificacion o el tamaño cambiaron desde
+    el ultimo registro, se compara el hash del contenido: si coincide solo se actualiza el registro, y si no, la
+    lista fue modificada por fuera del programa y debe volver a revisarse.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+        - batch: La huella del lote.
+    """
+    def current(self, user, key, path, batch):
+        with self.lock:
+            entry = self.users.get(user, {}).get(key)
+
+        if entry is None or entry["batch"] != batch:
+            return False
+
+        status = stat(path)
+
+        if status.st_mtime == entry["mtime"] and status.st_size == entry["size"]:
+            return True
+
+        if StateManifest.digest(path) != entry["sha1"]:
+            return False
+
+        self.record(user, key, path, batch, entry["sha1"])
+
+        return True
+
+    """
+    Permite obtener la huella del ultimo lote aplicado a la lista de un usuario, o None si no hay registro o la
+    lista fue modificada por fuera del programa desde entonces.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def applied(self, user, key, path):
+        with self.lock:
+            entry = self.users.get(user, {}).get(key)
+
+        if entry is None or entry["batch"] is None or not self.current(user, key, path, entry["batch"]):
+            return None
+
+        return entry["batch"]
+
+    """
+    Indica si la lista de un usuario esta ordenada y sin duplicados (ver --compact). Solo se confia en el registro
+    si la fecha de modificacion y el tamaño no han cambiado desde entonces.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def is_sorted(self, user, key, path):
+        with self.lock:
+            entry = self.users.get(user, {}).get(key)
+
+        if entry is None or not entry.get("sorted", False):
+            return False
+
+        status = stat(path)
+
+        return status.st_mtime == entry["mtime"] and status.st_size == entry["size"]
+
+    """
+    Permite registrar el estado actual de la lista de un usuario luego de aplicarle un lote.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+        - batch: La huella del lote aplicado.
+        - digest: El hash del contenido, si ya se conoce.
+        - sorted: Indica si la lista quedo ordenada y sin duplicados. Si la lista no cambio desde el registro
+        anterior, se conserva lo que este indicaba.
+    """
+    def record(self, user, key, path, batch, digest = None, sorted = False):
+        sorted = sorted or self.is_sorted(user, key, path)
+        status = stat(path)
+        entry = {
+            "mtime": status.st_mtime,
+            "size": status.st_size,
+            "sha1": digest or StateManifest.digest(path),
+            "batch": batch,
+            "sorted": sorted
+        }
+
+        with self.lock:
+            self.users.setdefault(user, {})[key] = entry
+            self.dirty = True
+
+    """
+    Permite que la lista de un usuario herede el registro de otra con el mismo contenido, siempre que ese registro
+    siga vigente.
+    Parametros:
+        - source_user: El usuario dueño de la lista original.
+        - user: El usuario que hereda el registro.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - source_path: La ruta de la lista original.
+        - path: La ruta de la lista que hereda el registro.
+    """
+    def mirror(self, source_user, user, key, source_path, path):
+        with self.lock:
+            entry = self.users.get(source_user, {}).get(key)
+
+        if entry is None:
+            return
+
+        status = stat(source_path)
+
+        if status.st_mtime == entry["mtime"] and status.st_size == entry["size"]:
+            self.record(user, key, path, entry["batch"], entry["sha1"], entry.get("sorted", False))
+
+    """
+    Permite guardar el manifiesto en disco, reemplazando el anterior mediante un renombre atomico.
+    """
+    def save(self):
+        temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(self.path) or '.')
+
+        with fdopen(temporal_file, 'w') as file:
+            with self.lock:
+                json.dump({"users": self.users}, file, sort_keys=True)
+                self.dirty = False
+
+        rename(absolute_temporal_file_path, self.path)
+
+class DomainIndex:
+    """
+    Indice invertido persistente que registra, para cada entrada en forma canonica (ver DomainTrie.canonical), los
+    usuarios que la tienen en cada tipo de lista. Se guarda en una base de datos SQLite, de modo que consultar
+    quien tiene un dominio no requiere recorrer las listas de todos los usuarios. Para cada lista se registra
+    tambien su fecha de modificacion y tamaño, y solo se vuelven a leer las listas que cambiaron desde entonces.
+    Parametros:
+        - path: La ruta de la base de datos. Si no existe, se crea vacia.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (domain TEXT NOT NULL, list TEXT NOT NULL, user TEXT NOT NULL, PRIMARY KEY (domain, list, user))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_user ON entries (user, list)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (user TEXT NOT NULL, list TEXT NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (user, list))")
+        self.connection.commit()
+        self.files = {(user, key): (mtime, size) for user, key, mtime, size in self.connection.execute("SELECT user, list, mtime, size FROM files")}
+
+    """
+    Permite leer las entradas de la lista de un usuario si cambio desde la ultima vez que se indexo. Retorna None
+    si la lista no cambio, o bien su estado y sus entradas en forma canonica; si la lista no existe, el estado es
+    None y no tiene entradas. Puede llamarse desde varios hilos a la vez.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def collect(self, user, key, path):
+        try:
+            status = stat(path)
+        except OSError:
+            status = None
+
+        signature = None if status is None else (status.st_mtime, status.st_size)
+
+        with self.lock:
+            if self.files.get((user, key)) == signature:
+                return None
+
+        if signature is None:
+            return None, set()
+
+        return signature, {DomainTrie.canonical(line) for line in SpamManager.scan(path)}
+
+    """
+    Permite reemplazar las entradas registradas de la lista de un usuario por las obtenidas con collect. Los
+    cambios se guardan en disco al llamar a commit.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - signature: El estado de la lista, o None si ya no existe.
+        - entries: Las entradas de la lista.
+    """
+    def store(self, user, key, signature, entries):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE user = ? AND list = ?", (user, key))
+            self.connection.executemany("INSERT INTO entries (domain, list, user) VALUES (?, ?, ?)", [(entry, key, user) for entry in sorted(entries)])
+
+            if signature is None:
+                self.connection.execute("DELETE FROM files WHERE user = ? AND list = ?", (user, key))
+                self.files.pop((user, key), None)
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO files (user, list, mtime, size) VALUES (?, ?, ?, ?)", (user, key, signature[0], signature[1]))
+                self.files[(user, key)] = signature
+
+    """
+    Permite eliminar del indice a los usuarios que ya no existen, y retorna los usuarios eliminados.
+    Parametros:
+        - users: Los usuarios que existen actualmente.
+    """
+    def prune(self, users):
+        users = set(users)
+
+        with self.lock:
+            removed = sorted({user for user, key in self.files if user not in users})
+
+            for user in removed:
+                self.connection.execute("DELETE FROM entries WHERE user = ?", (user,))
+                self.connection.execute("DELETE FROM files WHERE user = ?", (user,))
+
+            self.files = {(user, key): signature for (user, key), signature in self.files.items() if user in users}
+
+        return removed
+
+    """
+    Permite guardar en disco los cambios pendientes.
+    """
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    """
+    Permite obtener los usuarios que tienen alguna de las entradas indicadas. Retorna una lista de tuplas con el
+    tipo de lista, el usuario y la entrada, ordenada por tipo de lista y usuario.
+    Parametros:
+        - entries: Las entradas a buscar, en forma canonica.
+    """
+    def query(self, entries):
+        entries = sorted(set(entries))
+
+        with self.lock:
+            rows = self.connection.execute("SELECT list, user, domain FROM entries WHERE domain IN ({}) ORDER BY list, user, domain".format(', '.join('?' for entry in entries)), entries).fetchall()
+
+        return [tuple(row) for row in rows]
+
+class PolicyStore:
+    """
+    Almacen de las listas de todos los usuarios en una base de datos SQLite, que guarda cada entrada con su
+    posicion dentro de la lista. Con el, agregar o eliminar un lote es una consulta indexada por usuario y entrada
+    en lugar de un recorrido por cada archivo, y los archivos de SpamAssassin se escriben a partir del almacen
+    solo cuando cambian. Para cada lista se registra la fecha de modificacion y tamaño del archivo escrito, de
+    modo que las listas modificadas por fuera del almacen se pueden detectar.
+    Parametros:
+        - path: La ruta de la base de datos. Si no existe, se crea vacia.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (user TEXT NOT NULL, list TEXT NOT NULL, position INTEGER NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (user, list, position))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_entry ON entries (user, list, entry)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (user TEXT NOT NULL, list TEXT NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (user, list))")
+        self.connection.execute("CREATE TEMPORARY TABLE IF NOT EXISTS batch (list TEXT NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (list, entry))")
+        self.connection.commit()
+        self.files = {(user, key): (mtime, size) for user, key, mtime, size in self.connection.execute("SELECT user, list, mtime, size FROM files")}
+
+    """
+    Permite obtener el estado de un archivo, tal como se registra en el almacen, o None si no existe.
+    Parametros:
+        - path: La ruta del archivo.
+    """
+    @staticmethod
+    def signature(path):
+        try:
+            status = stat(path)
+        except OSError:
+            return None
+
+        return status.st_mtime, status.st_size
+
+    """
+    Indica si el archivo de una lista esta tal como se escribio o importo por ultima vez desde el almacen.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def is_current(self, user, key, path):
+        with self.lock:
+            return self.files.get((user, key)) == PolicyStore.signature(path)
+
+    """
+    Permite cargar los dominios del lote, con los que luego se consultan las listas (ver matches y delete).
+    Parametros:
+        - lists: Un diccionario con los dominios del lote para cada tipo de lista.
+    """
+    def load_batch(self, lists):
+        with self.lock:
+            self.connection.execute("DELETE FROM batch")
+            self.connection.executemany("INSERT OR IGNORE INTO batch (list, entry) VALUES (?, ?)", [(key, domain) for key, domains in sorted(lists.items()) for domain in domains])
+
+    """
+    Permite obtener las entradas de la lista de un usuario, en orden.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def lines(self, user, key):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT entry FROM entries WHERE user = ? AND list = ? ORDER BY position", (user, key))]
+
+    """
+    Permite obtener, en orden, las entradas de la lista de un usuario que estan en el lote.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def matches(self, user, key):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT entry FROM entries WHERE user = ? AND list = ? AND entry IN (SELECT entry FROM batch WHERE list = ?) ORDER BY position", (user, key, key))]
+
+    """
+    Permite agregar entradas al final de la lista de un usuario y registrar el nuevo estado de su archivo.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - entries: Las entradas a agregar, en orden.
+        - path: La ruta de la lista, ya actualizada.
+    """
+    def append(self, user, key, entries, path):
+        with self.lock:
+            start = self.connection.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM entries WHERE user = ? AND list = ?", (user, key)).fetchone()[0]
+            self.connection.executemany("INSERT INTO entries (user, list, position, entry) VALUES (?, ?, ?, ?)", [(user, key, start + index, entry) for index, entry in enumerate(entries)])
+            self.record(user, key, PolicyStore.signature(path))
+
+    """
+    Permite eliminar de la lista de un usuario las entradas indicadas, todas sus apariciones, y registrar el nuevo
+    estado de su archivo.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - entries: Las entradas a eliminar.
+        - path: La ruta de la lista, ya actualizada.
+    """
+    def delete(self, user, key, entries, path):
+        with self.lock:
+            self.connection.executemany("DELETE FROM entries WHERE user = ? AND list = ? AND entry = ?", [(user, key, entry) for entry in sorted(set(entries))])
+            self.record(user, key, PolicyStore.signature(path))
+
+    """
+    Permite reemplazar todas las entradas de la lista de un usuario y registrar el estado de su archivo.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - entries: Las entradas de la lista, en orden.
+        - signature: El estado del archivo, o None si no existe.
+    """
+    def replace(self, user, key, entries, signature):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE user = ? AND list = ?", (user, key))
+            self.connection.executemany("INSERT INTO entries (user, list, position, entry) VALUES (?, ?, ?, ?)", [(user, key, index, entry) for index, entry in enumerate(entries)])
+            self.record(user, key, signature)
+
+    """
+    Permite registrar el estado actual del archivo de una lista, que ya refleja las entradas del almacen.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def mark(self, user, key, path):
+        with self.lock:
+            self.record(user, key, PolicyStore.signature(path))
+
+    """
+    Permite registrar el estado del archivo de una lista; debe llamarse con el candado tomado.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - signature: El estado del archivo, o None si no existe.
+    """
+    def record(self, user, key, signature):
+        if signature is None:
+            self.connection.execute("DELETE FROM files WHERE user = ? AND list = ?", (user, key))
+            self.files.pop((user, key), None)
+        else:
+            self.connection.execute("INSERT OR REPLACE INTO files (user, list, mtime, size) VALUES (?, ?, ?, ?)", (user, key, signature[0], signature[1]))
+            self.files[(user, key)] = signature
+
+    """
+    Permite obtener los usuarios que tienen al menos una lista en el almacen, en orden alfabetico.
+    """
+    def users(self):
+        with self.lock:
+            return sorted({row[0] for row in self.connection.execute("SELECT DISTINCT user FROM entries")} | {user for user, key in self.files})
+
+    """
+    Permite eliminar del almacen a los usuarios que ya no existen, y retorna los usuarios eliminados.
+    Parametros:
+        - users: Los usuarios que existen actualmente.
+    """
+    def prune(self, users):
+        removed = sorted(set(self.users()).difference(users))
+
+        with self.lock:
+            for user in removed:
+                self.connection.execute("DELETE FROM entries WHERE user = ?", (user,))
+                self.connection.execute("DELETE FROM files WHERE user = ?", (user,))
+                self.files = {(name, key): signature for (name, key), signature in self.files.items() if name != user}
+
+        return removed
+
+    """
+    Permite guardar en disco los cambios pendientes.
+    """
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+class BatchJournal:
+    """
+    Registro previo de escritura (write-ahead journal) que hace atomico un lote completo. Mientras el registro esta
+    abierto, las listas nuevas no reemplazan a las originales: quedan en archivos temporales junto a ellas y se
+    anotan en el registro, usuario por usuario. Al terminar el lote se anota la confirmacion y recien entonces se
+    renombran todas las listas. Si la ejecucion se interrumpe, el registro indica si el lote se debe completar (ya
+    fue confirmado) o deshacer (no alcanzo a confirmarse), lo que se hace con recover.
+    Para que el registro sea confiable, el contenido de cada archivo temporal se sincroniza con el disco una vez
+    escrito, pero las carpetas solo se sincronizan una vez por buzon, y el registro una vez por lote.
+    Parametros:
+        - path: La ruta del registro. Solo existe mientras hay un lote en curso o interrumpido.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file = None
+        self.staged = {}
+        self.pending = {}
+
+    """
+    Permite sincronizar con el disco un archivo o una carpeta.
+    Parametros:
+        - path: La ruta del archivo o carpeta.
+    """
+    @staticmethod
+    def sync(path):
+        descriptor = os_open(path, O_RDONLY)
+
+        try:
+            fsync(descriptor)
+        finally:
+            close(descriptor)
+
+    """
+    Indica si hay un lote en curso.
+    """
+    @property
+    def active(self):
+        return self.file is not None
+
+    """
+    Permite comenzar un lote. Si quedo un lote interrumpido, se lanza una excepcion.
+    Parametros:
+        - batch_id: El identificador del lote.
+        - users: La cantidad de usuarios del lote.
+    """
+    def begin(self, batch_id, users):
+        if exists(self.path):
+            raise Exception("Hay un lote interrumpido en {}; utilice recover para completarlo o deshacerlo antes de aplicar otro.".format(self.path))
+
+        self.file = open(self.path, 'w')
+        self.write({"batch": batch_id, "users": users})
+
+    """
+    Permite escribir una linea del registro; debe llamarse con el candado tomado o antes de procesar usuarios.
+    Parametros:
+        - record: El diccionario a registrar.
+    """
+    def write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+
+    """
+    Permite dejar lista la version nueva de una lista, ya escrita en un archivo temporal en su misma carpeta. El
+    archivo queda pendiente hasta que se registre el usuario que lo escribio (ver stage_user).
+    Parametros:
+        - path: La ruta de la lista.
+        - absolute_temporal_file_path: La ruta del archivo temporal con el nuevo contenido.
+    """
+    def stage(self, path, absolute_temporal_file_path):
+        BatchJournal.sync(absolute_temporal_file_path)
+
+        with self.lock:
+            self.pending.setdefault(current_thread(), []).append((path, absolute_temporal_file_path))
+            self.staged[path] = absolute_temporal_file_path
+
+    """
+    Permite registrar las listas que el hilo actual dejo pendientes para un usuario, sincronizando cada carpeta una
+    sola vez, o bien descartarlas si el usuario fallo.
+    Parametros:
+        - user: El usuario procesado.
+        - discard: Indica si las listas pendientes se descartan.
+    """
+    def stage_user(self, user, discard = False):
+        with self.lock:
+            files = self.pending.pop(current_thread(), [])
+
+        if len(files) == 0:
+            return
+
+        try:
+            if not discard:
+                for folder in sorted({dirname(staged) for path, staged in files}):
+                    BatchJournal.sync(folder)
+
+                with self.lock:
+                    self.write({"user": user, "files": [[path, staged] for path, staged in files]})
+
+                return
+        except Exception:
+            self.discard(files)
+            raise
+
+        self.discard(files)
+
+    """
+    Permite descartar listas pendientes, eliminando sus archivos temporales.
+    Parametros:
+        - files: Los pares de lista y archivo temporal.
+    """
+    def discard(self, files):
+        with self.lock:
+            for path, staged in files:
+                self.staged.pop(path, None)
+
+        for path, staged in files:
+            if exists(staged):
+                remove(staged)
+
+    """
+    Permite obtener la ruta donde esta la version mas reciente de una lista: su archivo temporal si esta pendiente
+    en el lote en curso, o la lista misma.
+    Parametros:
+        - path: La ruta de la lista.
+    """
+    def resolve(self, path):
+        with self.lock:
+            return self.staged.get(path, path)
+
+    """
+    Permite confirmar el lote: se anota la confirmacion, se reemplazan todas las listas registradas y se elimina el
+    registro. Retorna la cantidad de listas reemplazadas.
+    """
+    def commit(self):
+        with self.lock:
+            self.write({"commit": True})
+            fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            files = sorted(self.staged.items())
+            self.staged = {}
+            self.pending = {}
+
+        BatchJournal.finish(self.path, files)
+
+        return len(files)
+
+    """
+    Permite renombrar los archivos temporales de un lote confirmado sobre sus listas, omitiendo los que ya se
+    renombraron, y luego sincronizar cada carpeta una vez y eliminar el registro.
+    Parametros:
+        - path: La ruta del registro.
+        - files: Los pares de lista y archivo temporal.
+    """
+    @staticmethod
+    def finish(path, files):
+        for target, staged in files:
+            if exists(staged):
+                SpamManager.replace(target, staged)
+
+        for folder in sorted({dirname(target) for target, staged in files}):
+            BatchJournal.sync(folder)
+
+        remove(path)
+
+    """
+    Permite completar o deshacer un lote interrumpido, segun si alcanzo a confirmarse. Retorna el identificador del
+    lote, si se completo y la cantidad de listas registradas, o None si no hay ningun lote interrumpido.
+    """
+    def recover(self):
+        if not exists(self.path):
+            return None
+
+        batch_id = None
+        committed = False
+        files = []
+
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                batch_id = record.get("batch", batch_id)
+                committed = committed or record.get("commit", False)
+                files += [(str(target), str(staged)) for target, staged in record.get("files", [])]
+
+        if committed:
+            BatchJournal.finish(self.path, files)
+        else:
+            for target, staged in files:
+                if exists(staged):
+                    remove(staged)
+
+            remove(self.path)
+
+        return batch_id, committed, len(files)
+
+class Checkpoint:
+    """
+    Registra en disco los usuarios que ya terminaron un lote, junto con su identificador, para que una ejecucion
+    interrumpida pueda retomarse sin volver a procesarlos (ver --resume). Cada usuario se agrega al final del
+    archivo apenas termina, y el archivo se elimina cuando el lote termina sin errores.
+    Parametros:
+        - path: La ruta del archivo.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    """
+    Permite obtener los usuarios que ya terminaron un lote, o None si el archivo no existe o corresponde a otro
+    lote. Se ignora la ultima linea si quedo a medio escribir.
+    Parametros:
+        - batch_id: El identificador del lote.
+    """
+    def load(self, batch_id):
+        if not exists(self.path):
+            return None
+
+        batch = None
+        users = set()
+
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if "batch" in record:
+                    batch = record["batch"]
+                else:
+                    users.add(str(record["user"]))
+
+        return users if batch == batch_id else None
+
+    """
+    Permite comenzar a registrar un lote, reemplazando el archivo anterior mediante un renombre atomico.
+    Parametros:
+        - batch_id: El identificador del lote.
+        - users: Los usuarios que ya terminaron el lote.
+    """
+    def begin(self, batch_id, users):
+        temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(self.path) or '.')
+
+        with fdopen(temporal_file, 'w') as file:
+            file.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in [{"batch": batch_id}] + [{"user": user} for user in users]))
+
+        rename(absolute_temporal_file_path, self.path)
+        self.file = open(self.path, 'a')
+
+    """
+    Permite registrar que un usuario termino el lote.
+    Parametros:
+        - user: El usuario.
+    """
+    def done(self, user):
+        self.file.write(json.dumps({"user": user}) + '\n')
+        self.file.flush()
+
+    """
+    Permite dejar de registrar el lote y, si termino sin errores, eliminar el archivo.
+    Parametros:
+        - finished: Indica si el lote termino sin errores.
+    """
+    def close(self, finished):
+        self.file.close()
+        self.file = None
+
+        if finished:
+            remove(self.path)
+
+class ChangeHistory:
+    """
+    Historial de los cambios que cada lote hizo en las listas de los usuarios, guardado en una base de datos SQLite
+    para poder deshacerlos (ver restore). De cada lista solo se guarda su diferencia, es decir, las entradas que el
+    lote elimino y agrego, comprimida con zlib. Las diferencias identicas, como las de un mismo lote aplicado a
+    miles de usuarios, se guardan una sola vez y cada usuario solo anota su hash.
+    Parametros:
+        - path: La ruta de la base de datos. Si no existe, se crea vacia.
+    """
+    cache_size = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("CREATE TABLE IF NOT EXISTS batches (sequence INTEGER PRIMARY KEY AUTOINCREMENT, batch TEXT NOT NULL, action TEXT NOT NULL, time REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS batches_batch ON batches (batch)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS deltas (hash TEXT PRIMARY KEY, content BLOB NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS changes (user TEXT NOT NULL, sequence INTEGER NOT NULL, list TEXT NOT NULL, delta TEXT NOT NULL, PRIMARY KEY (user, sequence, list))")
+        self.connection.commit()
+        self.sequence = None
+        self.pending = {}
+        self.cache = {}
+
+    """
+    Permite registrar el comienzo de un lote y retorna su numero de secuencia, que ordena los lotes del historial.
+    Parametros:
+        - batch_id: El identificador del lote.
+        - action: La accion del lote.
+    """
+    def begin(self, batch_id, action):
+        with self.lock:
+            self.sequence = self.connection.execute("INSERT INTO batches (batch, action, time) VALUES (?, ?, ?)", (batch_id, action, time())).lastrowid
+            self.pending = {}
+
+        return self.sequence
+
+    """
+    Permite anotar la diferencia de una lista de un usuario, que queda pendiente hasta que el usuario termina (ver
+    store y discard). Las listas sin cambios no se anotan.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - removed: Las entradas eliminadas, con sus repeticiones.
+        - added: Las entradas agregadas, en el orden en que se escribieron al final de la lista.
+    """
+    def note(self, user, key, removed, added):
+        removed = list(removed)
+        added = list(added)
+
+        if len(removed) == 0 and len(added) == 0:
+            return
+
+        with self.lock:
+            self.pending.setdefault(user, {})[key] = (removed, added)
+
+    """
+    Permite guardar las diferencias pendientes de un usuario, que tambien se registran para los usuarios que
+    recibieron una copia de sus listas (ver SpamManager.propagate).
+    Parametros:
+        - user: El usuario que termino el lote.
+        - members: Los usuarios a los que se copiaron sus listas.
+    """
+    def store(self, user, members = []):
+        with self.lock:
+            for key, (removed, added) in sorted(self.pending.pop(user, {}).items()):
+                content = json.dumps([removed, added])
+                digest = sha1(content).hexdigest()
+                self.connection.execute("INSERT OR IGNORE INTO deltas (hash, content) VALUES (?, ?)", (digest, sqlite3.Binary(zlib.compress(content))))
+                self.connection.executemany("INSERT INTO changes (user, sequence, list, delta) VALUES (?, ?, ?, ?)", [(name, self.sequence, key, digest) for name in [user] + members])
+
+    """
+    Permite descartar las diferencias pendientes de un usuario en que el lote fallo.
+    Parametros:
+        - user: El usuario.
+    """
+    def discard(self, user):
+        with self.lock:
+            self.pending.pop(user, None)
+
+    """
+    Permite obtener el numero de secuencia de la aplicacion mas reciente de un lote, o None si no esta en el
+    historial.
+    Parametros:
+        - batch_id: El identificador del lote.
+    """
+    def find(self, batch_id):
+        with self.lock:
+            return self.connection.execute("SELECT MAX(sequence) FROM batches WHERE batch = ?", (batch_id,)).fetchone()[0]
+
+    """
+    Permite obtener las diferencias de las listas de un usuario registradas desde un lote, sin incluir el lote en
+    curso, de la mas reciente a la mas antigua. Cada diferencia es una tupla con el tipo de lista, las entradas
+    eliminadas y las agregadas.
+    Parametros:
+        - user: El usuario dueño de las listas.
+        - sequence: El numero de secuencia del primer lote a considerar.
+    """
+    def changes(self, user, sequence):
+        with self.lock:
+            rows = self.connection.execute("SELECT list, delta FROM changes WHERE user = ? AND sequence >= ? AND sequence < ? ORDER BY sequence DESC", (user, sequence, self.sequence)).fetchall()
+
+            return [(key,) + self.delta(digest) for key, digest in rows]
+
+    """
+    Permite obtener las entradas eliminadas y agregadas de una diferencia a partir de su hash; debe llamarse con el
+    candado tomado. Las diferencias mas usadas se mantienen descomprimidas en memoria.
+    Parametros:
+        - digest: El hash de la diferencia.
+    """
+    def delta(self, digest):
+        if digest not in self.cache:
+            if len(self.cache) >= ChangeHistory.cache_size:
+                self.cache.clear()
+
+            content = self.connection.execute("SELECT content FROM deltas WHERE hash = ?", (digest,)).fetchone()[0]
+            removed, added = json.loads(zlib.decompress(content))
+            self.cache[digest] = ([str(entry) for entry in removed], [str(entry) for entry in added])
+
+        return self.cache[digest]
+
+    """
+    Permite guardar en disco los cambios hechos al historial.
+    """
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+class ProgressLine:
+    """
+    Muestra en la salida de errores el avance de un lote: los usuarios terminados, los usuarios por segundo y el
+    tiempo restante estimado. En una terminal la linea se reescribe en el mismo lugar a lo mas cada `interval`
+    segundos, y se borra mientras el LogWriter escribe en la salida estandar; si no, se escribe una linea nueva
+    cada `log_interval` segundos. La linea no se registra en el archivo log.
+    Parametros:
+        - stream: La salida donde se muestra, normalmente sys.stderr.
+        - total: La cantidad de usuarios a procesar.
+    """
+    interval = 0.5
+    log_interval = 10
+    erase = '\x1b[K'
+    lock = Lock()
+    active = None
+
+    def __init__(self, stream, total):
+        self.stream = stream
+        self.total = total
+        self.terminal = stream.isatty()
+        self.started = perf_counter()
+        self.shown = None
+        self.last = None
+        self.visible = False
+
+    """
+    Permite obtener una duracion en segundos con el formato H:MM:SS.
+    Parametros:
+        - seconds: La duracion, o None si no se conoce.
+    """
+    @staticmethod
+    def duration(seconds):
+        if seconds is None:
+            return "-:--:--"
+
+        seconds = int(round(seconds))
+
+        return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    """
+    Permite obtener el texto de la linea de avance.
+    Parametros:
+        - done: La cantidad de usuarios terminados.
+    """
+    def text(self, done):
+        elapsed = perf_counter() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        percent = 100.0 * done / self.total if self.total > 0 else 100.0
+        remaining = (self.total - done) / rate if rate > 0 else None
+
+        return "Usuarios: {}/{} ({:.1f}%), {:.1f} usuarios/s, Restante: {}".format(done, self.total, percent, rate, ProgressLine.duration(remaining))
+
+    """
+    Permite mostrar el avance, si paso el intervalo desde la ultima vez o si es el final del lote.
+    Parametros:
+        - done: La cantidad de usuarios terminados.
+        - final: Indica si el lote termino, en cuyo caso la linea se muestra siempre, salvo que ya se haya mostrado
+        con la misma cantidad, y se cierra.
+    """
+    def update(self, done, final = False):
+        now = perf_counter()
+
+        if not final and self.shown is not None and now - self.shown < (ProgressLine.interval if self.terminal else ProgressLine.log_interval):
+            return
+
+        self.shown = now
+
+        with ProgressLine.lock:
+            if final and self.last == done and (self.visible or not self.terminal):
+                self.stream.write('\n' if self.terminal else '')
+            elif self.terminal:
+                self.stream.write('\r' + self.text(done) + ProgressLine.erase + ('\n' if final else ''))
+            else:
+                self.stream.write(self.text(done) + '\n')
+
+            self.last = done
+
+            self.stream.flush()
+            self.visible = self.terminal and not final
+            ProgressLine.active = None if final else self
+
+    """
+    Permite borrar la linea de avance visible, si la hay, para escribir otros mensajes en la terminal; debe
+    llamarse con el candado tomado.
+    """
+    @staticmethod
+    def clear():
+        line = ProgressLine.active
+
+        if line is not None and line.visible:
+            line.stream.write('\r' + ProgressLine.erase)
+            line.stream.flush()
+            line.visible = False
+
+class TokenBucket:
+    """
+    Cubeta de fichas que limita la tasa de una operacion: las fichas se recargan a `rate` por segundo hasta un
+    maximo de `rate`, es decir, un segundo de rafaga. Una operacion que pide mas fichas de las disponibles deja la
+    cubeta en deuda y debe esperar a que se recargue, de modo que las operaciones grandes se permiten igual pero
+    retrasan a las siguientes lo que corresponda.
+    Parametros:
+        - rate: La cantidad de fichas por segundo.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = perf_counter()
+        self.lock = Lock()
+
+    """
+    Permite tomar fichas de la cubeta y retorna los segundos que se deben esperar antes de la operacion.
+    Parametros:
+        - amount: La cantidad de fichas.
+    """
+    def take(self, amount):
+        with self.lock:
+            now = perf_counter()
+            self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class IOThrottle:
+    """
+    Limita las operaciones sobre las listas de los usuarios para no saturar los discos que comparte el servidor de
+    correo: los bytes y archivos por segundo se limitan con cubetas de fichas (ver TokenBucket) y las operaciones
+    simultaneas con un semaforo. Ademas, si se indica una latencia objetivo, se mide el tiempo de cada operacion y,
+    mientras su promedio la supere, se agregan pausas que se duplican con cada operacion lenta y se reducen de a
+    poco cuando la latencia vuelve a la normalidad.
+    Parametros:
+        - bytes_per_second: La cantidad maxima de bytes por segundo, o 0 para no limitarla.
+        - files_per_second: La cantidad maxima de archivos por segundo, o 0 para no limitarla.
+        - concurrency: La cantidad maxima de operaciones simultaneas, o 0 para no limitarla.
+        - latency: La latencia objetivo en milisegundos, o 0 para no ajustar las pausas.
+    """
+    parameters = ["io_bytes_per_second", "io_files_per_second", "io_concurrency", "io_latency"]
+    minimum_factor = 1.0 / 16
+    recovery = 0.05
+    smoothing = 0.2
+
+    def __init__(self, bytes_per_second = 0, files_per_second = 0, concurrency = 0, latency = 0):
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second > 0 else None
+        self.files = TokenBucket(files_per_second) if files_per_second > 0 else None
+        self.slots = BoundedSemaphore(concurrency) if concurrency > 0 else None
+        self.latency = latency / 1000.0
+        self.average = None
+        self.factor = 1.0
+        self.lock = Lock()
+
+    """
+    Permite construir el limitador indicado en la configuracion, o None si no se indica ningun limite.
+    Parametros:
+        - parameters: La configuracion.
+    """
+    @staticmethod
+    def build(parameters):
+        values = [parameters[name] for name in IOThrottle.parameters]
+
+        if not any(values):
+            return None
+
+        return IOThrottle(*values)
+
+    """
+    Permite repartir los limites de la configuracion entre varios procesos, de modo que entre todos respeten el
+    mismo limite. Retorna una copia de la configuracion.
+    Parametros:
+        - parameters: La configuracion.
+        - processes: La cantidad de procesos.
+    """
+    @staticmethod
+    def share(parameters, processes):
+        result = dict(parameters)
+
+        for name in IOThrottle.parameters[:3]:
+            if result[name] > 0:
+                result[name] = max(1, result[name] // processes)
+
+        return result
+
+    """
+    Permite esperar a que los limites de bytes y archivos por segundo admitan una operacion.
+    Parametros:
+        - size: La cantidad de bytes de la operacion.
+    """
+    def wait(self, size):
+        delay = max(self.bytes.take(size) if self.bytes is not None else 0.0, self.files.take(1) if self.files is not None else 0.0)
+
+        if delay > 0:
+            sleep(delay)
+
+    """
+    Permite comenzar una operacion: se espera a que los limites la admitan y a que haya un cupo libre.
+    Parametros:
+        - size: La cantidad de bytes de la operacion.
+    """
+    def enter(self, size):
+        self.wait(size)
+
+        if self.slots is not None:
+            self.slots.acquire()
+
+    """
+    Permite terminar una operacion, liberando su cupo, y retorna los segundos de pausa que corresponden segun la
+    latencia observada.
+    Parametros:
+        - elapsed: Los segundos que tomo la operacion.
+    """
+    def leave(self, elapsed):
+        if self.slots is not None:
+            self.slots.release()
+
+        if self.latency <= 0:
+            return 0.0
+
+        with self.lock:
+            self.average = elapsed if self.average is None else self.average + IOThrottle.smoothing * (elapsed - self.average)
+
+            if self.average > self.latency:
+                self.factor = max(IOThrottle.minimum_factor, self.factor / 2)
+            else:
+                self.factor = min(1.0, self.factor + IOThrottle.recovery)
+
+            return elapsed * (1.0 / self.factor - 1.0)
+
+class RunStats:
+    """
+    Acumula las mediciones de una ejecucion: el tiempo de cada fase, contadores de bytes, archivos y usuarios, y el
+    tiempo de cada usuario para informar los mas lentos. Los tiempos de las fases que ocurren dentro de cada usuario
+    se suman entre todos los hilos, por lo que con jobs mayor a 1 pueden superar el tiempo total de la ejecucion.
+    Las fases medidas son:
+        - config: Lectura del archivo de configuracion.
+        - discovery: Listado de los usuarios en source_path.
+        - filter: Aplicacion de los filtros allow y deny.
+        - build: Lectura del lote y construccion de sus estructuras de busqueda.
+        - read: Lectura de las listas de los usuarios.
+        - match: Comparacion de las listas con el lote.
+        - write: Escritura de las listas nuevas o de los dominios agregados.
+        - rename: Reemplazo de las listas mediante renombres atomicos.
+        - throttle: Esperas y pausas impuestas por el limite de entrada y salida (ver IOThrottle).
+    En patch la comparacion y la escritura ocurren en una sola pasada, por lo que ambas se miden como write.
+    """
+    phases = ["config", "discovery", "filter", "build", "read", "match", "write", "rename", "throttle"]
+    slowest_count = 10
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = perf_counter()
+        self.timers = Counter({phase: 0.0 for phase in RunStats.phases})
+        self.counters = Counter()
+        self.user_seconds = {}
+        self.tenants = {}
+        self.success = True
+
+    """
+    Permite medir el tiempo de un bloque de codigo y sumarlo a una fase.
+    Parametros:
+        - phase: El nombre de la fase.
+    """
+    @contextmanager
+    def timer(self, phase):
+        started = perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+
+            with self.lock:
+                self.timers[phase] += elapsed
+
+    """
+    Permite sumar un valor a un contador.
+    Parametros:
+        - name: El nombre del contador.
+        - value: El valor a sumar.
+    """
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    """
+    Permite registrar el tiempo que tomo procesar a un usuario.
+    Parametros:
+        - user: El usuario.
+        - seconds: Los segundos que tomo.
+    """
+    def record_user(self, user, seconds):
+        with self.lock:
+            self.user_seconds[user] = self.user_seconds.get(user, 0) + seconds
+
+    """
+    Permite sumar el resumen de la ejecucion de un dominio (ver TenantPool): sus fases, contadores y usuarios mas
+    lentos, que se identifican como 'dominio/usuario'. Los contadores del dominio se conservan tambien por separado.
+    Parametros:
+        - name: El nombre del dominio.
+        - report: El resumen de su ejecucion (ver report).
+    """
+    def merge(self, name, report):
+        with self.lock:
+            self.timers.update(report["phases"])
+            self.counters.update(report["counters"])
+
+            for entry in report["slowest_users"]:
+                self.user_seconds["{}/{}".format(name, entry['user'])] = entry["seconds"]
+
+            self.tenants[name] = {"success": report["success"], "seconds": report["seconds"], "counters": report["counters"]}
+
+    """
+    Permite obtener el resumen de la ejecucion como un diccionario.
+    """
+    def report(self):
+        with self.lock:
+            slowest = sorted(self.user_seconds.items(), key=lambda item: (-item[1], item[0]))[:RunStats.slowest_count]
+            report = {
+                "success": self.success,
+                "timestamp": round(time(), 3),
+                "seconds": round(perf_counter() - self.started, 6),
+                "phases": {phase: round(self.timers[phase], 6) for phase in RunStats.phases},
+                "counters": dict(self.counters),
+                "slowest_users": [{"user": user, "seconds": round(seconds, 6)} for user, seconds in slowest]
+            }
+
+            if len(self.tenants) != 0:
+                report["tenants"] = dict(self.tenants)
+
+            return report
+
+    """
+    Permite obtener el resumen de la ejecucion en el formato de texto de Prometheus, para ser recogido por el
+    colector de archivos de texto de node_exporter.
+    """
+    def prometheus(self):
+        report = self.report()
+        lines = [
+            "# HELP spager_success Indica si la ultima ejecucion termino sin errores.",
+            "# TYPE spager_success gauge",
+            "spager_success {}".format(int(report['success'])),
+            "# HELP spager_last_run_timestamp_seconds Momento en que termino la ultima ejecucion.",
+            "# TYPE spager_last_run_timestamp_seconds gauge",
+            "spager_last_run_timestamp_seconds {}".format(report['timestamp']),
+            "# HELP spager_run_seconds Duracion total de la ultima ejecucion.",
+            "# TYPE spager_run_seconds gauge",
+            "spager_run_seconds {}".format(report['seconds']),
+            "# HELP spager_phase_seconds Tiempo acumulado en cada fase de la ultima ejecucion.",
+            "# TYPE spager_phase_seconds gauge"
+        ]
+        lines += ["spager_phase_seconds{{phase=\"{}\"}} {}".format(phase, report["phases"][phase]) for phase in RunStats.phases]
+        lines += ["# HELP spager_count Contadores de la ultima ejecucion.", "# TYPE spager_count gauge"]
+        lines += ["spager_count{{name=\"{}\"}} {}".format(name, value) for name, value in sorted(report["counters"].items())]
+        lines += ["# HELP spager_user_seconds Tiempo de los usuarios mas lentos de la ultima ejecucion.", "# TYPE spager_user_seconds gauge"]
+        lines += ["spager_user_seconds{{user=\"{}\"}} {}".format(entry["user"], entry["seconds"]) for entry in report["slowest_users"]]
+
+        if "tenants" in report:
+            lines += ["# HELP spager_tenant_success Indica si la ultima ejecucion de cada dominio termino sin errores.", "# TYPE spager_tenant_success gauge"]
+            lines += ["spager_tenant_success{{tenant=\"{}\"}} {}".format(tenant, int(entry["success"])) for tenant, entry in sorted(report["tenants"].items())]
+            lines += ["# HELP spager_tenant_count Contadores de la ultima ejecucion de cada dominio.", "# TYPE spager_tenant_count gauge"]
+            lines += ["spager_tenant_count{{tenant=\"{}\",name=\"{}\"}} {}".format(tenant, name, value) for tenant, entry in sorted(report["tenants"].items()) for name, value in sorted(entry["counters"].items())]
+
+        return "\n".join(lines) + "\n"
+
+    """
+    Permite escribir el resumen de la ejecucion en la salida estandar o en un archivo. Los archivos se reemplazan
+    mediante un renombre atomico, para que un colector nunca lea un archivo a medio escribir.
+    Parametros:
+        - path: La ruta del archivo, o "-" para la salida estandar.
+        - format: El formato del resumen, ya sea "json" o "prometheus".
+    """
+    def save(self, path, format = "json"):
+        content = self.prometheus() if format == "prometheus" else json.dumps(self.report(), indent=4, sort_keys=True) + "\n"
+
+        if path == "-":
+            sys.stdout.write(content)
+            return
+
+        temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path) or '.')
+
+        with fdopen(temporal_file, 'w') as file:
+            file.write(content)
+
+        rename(absolute_temporal_file_path, path)
+
+class LogWriter:
+    """
+    Escribe los mensajes del programa en el archivo log y en la salida estandar desde un hilo propio, de modo que
+    procesar a los usuarios no espere a la terminal ni al disco. Los mensajes se encolan con su fecha y se escriben
+    por bloques: el hilo toma todos los mensajes pendientes (hasta `batch_size`) y los escribe y vacia de una vez.
+    Si escribir falla, por ejemplo porque se cerro la salida estandar o se lleno el disco, el hilo sigue vaciando
+    la cola: los mensajes del log se escriben en la salida de errores y los de la salida estandar se descartan.
+    Parametros:
+        - path: La ruta del archivo log.
+        - format: El formato de los mensajes del log, segun la libreria logging.
+    """
+    batch_size = 1000
+    queue_size = 10000
+    wait_seconds = 1
+    levels = {"info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+    def __init__(self, path, format):
+        self.file = open(path, 'a')
+        self.formatter = logging.Formatter(format)
+        self.queue = Queue(LogWriter.queue_size)
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    """
+    Permite encolar un mensaje.
+    Parametros:
+        - message: El mensaje.
+        - kind: El tipo de mensaje, ya sea "info", "warning" o "error".
+        - show: Indica si el mensaje tambien se muestra en la salida estandar.
+    """
+    def write(self, message, kind, show = True):
+        record = logging.getLogger().makeRecord("root", LogWriter.levels[kind], "(unknown file)", 0, message, None, None)
+        self.enqueue((record, show))
+
+    """
+    Permite encolar una entrada mientras el hilo siga vivo. Si el hilo termino, la entrada se descarta en lugar de
+    esperar a que la cola tenga espacio.
+    Parametros:
+        - entry: La entrada, o None para la señal de termino.
+    """
+    def enqueue(self, entry):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(entry, timeout=LogWriter.wait_seconds)
+                return
+            except Full:
+                pass
+
+    """
+    Permite escribir los mensajes encolados por bloques hasta recibir la señal de termino.
+    """
+    def run(self):
+        while True:
+            entries = [self.queue.get()]
+
+            while len(entries) < LogWriter.batch_size:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            messages = [entry for entry in entries if entry is not None]
+
+            try:
+                self.file.write(''.join("{}\n".format(self.formatter.format(record)) for record, show in messages))
+                self.file.flush()
+            except Exception:
+                LogWriter.fallback(''.join("{}\n".format(record.getMessage()) for record, show in messages))
+
+            try:
+                with ProgressLine.lock:
+                    ProgressLine.clear()
+                    sys.stdout.write(''.join("{}\n".format(record.getMessage()) for record, show in messages if show))
+                    sys.stdout.flush()
+            except Exception:
+                pass
+
+            if len(messages) != len(entries):
+                return
+
+    """
+    Permite escribir en la salida de errores los mensajes que no se pudieron escribir en el log, o descartarlos si
+    tampoco se puede.
+    Parametros:
+        - text: Los mensajes.
+    """
+    @staticmethod
+    def fallback(text):
+        try:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+    """
+    Permite esperar a que se escriban todos los mensajes encolados y cerrar el archivo log. Puede llamarse mas de
+    una vez.
+    """
+    def close(self):
+        self.enqueue(None)
+        self.thread.join()
+
+        if not self.file.closed:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+
+class SpamManager:
+    """
+    Permite agregar, eliminar y parchar dominios de las listas de los usuarios. Crear un SpamManager no lee ningun
+    archivo: la configuracion se lee la primera vez que se necesita, y los usuarios se listan la primera vez que se
+    aplica un lote, por lo que una misma instancia puede aplicar muchos lotes sin volver a pagar ese costo.
+    Parametros:
+        - config: La configuracion, ya sea None para leer `config/parameters.config`, la ruta de otro archivo de
+        configuracion o un diccionario con los parametros (ver ParameterManager.load).
+    """
+    writers = {}
+    writers_lock = Lock()
+    counter_labels = [("rewritten", "Archivos reescritos"), ("skipped", "Archivos omitidos"), ("current", "Usuarios al dia")]
+    maintenance = {"index": "build_index", "import": "import_store", "verify": "verify_store", "materialize": "materialize_store"}
+    creation_mask = umask(0)
+    umask(creation_mask)
+
+    def __init__(self, config = None):
+        self.config = config
+        self.loaded_parameters = None
+        self.roster = None
+        self.stats = RunStats()
+        self.manifest = None
+        self.incremental = False
+        self.shared = False
+        self.subdomains = False
+        self.verbose = False
+        self.index = None
+        self.domain_index = None
+        self.store = None
+        self.journal = None
+        self.history = None
+        self.resume = False
+        self.progress = None
+        self.throttle = None
+        self.matchers = MatcherCache()
+        self.echo = True
+
+    """
+    Permite obtener la configuracion, leyendola la primera vez que se necesita.
+    """
+    @property
+    def parameters(self):
+        if self.loaded_parameters is None:
+            with self.stats.timer("config"):
+                self.loaded_parameters = ParameterManager.load(self.config)
+
+        return self.loaded_parameters
+
+    """
+    Permite obtener los usuarios de source_path, listandolos la primera vez que se necesitan.
+    """
+    @property
+    def users(self):
+        if self.roster is None:
+            self.discover()
+
+        return self.roster
+
+    """
+    Permite volver a listar los usuarios de source_path, por ejemplo luego de crear o eliminar un buzon. Se omiten
+    los buzones que no tienen ninguna lista. Los usuarios se guardan en roster_path y solo se vuelven a listar si
+    la carpeta cambio; de los buzones sin listas, en cambio, se revisa en cada llamada si ya tienen alguna.
+    """
+    def discover(self):
+        with self.stats.timer("discovery"):
+            source_path = self.parameters["source_path"]
+            relative_paths = self.parameters["relative_paths"]
+            mtime = stat(source_path).st_mtime
+            cache = RosterCache(self.parameters["roster_path"])
+            roster = cache.load(source_path, relative_paths, mtime)
+
+            if roster is None:
+                folders = SpamManager.list_folders(source_path)
+                roster = {"source_path": source_path, "relative_paths": relative_paths, "mtime": mtime, "users": [], "empty": []}
+
+                for user in folders:
+                    roster["users" if self.has_lists(user) else "empty"].append(user)
+
+                cache.save(roster)
+            else:
+                found = [user for user in roster["empty"] if self.has_lists(user)]
+
+                if len(found) != 0:
+                    roster["users"] = sorted(roster["users"] + found)
+                    roster["empty"] = [user for user in roster["empty"] if user not in found]
+                    cache.save(roster)
+
+            self.roster = roster["users"]
+
+    """
+    Permite obtener, en orden alfabetico, las subcarpetas de una carpeta.
+    Parametros:
+        - path: La carpeta.
+    """
+    @staticmethod
+    def list_folders(path):
+        if scandir is None:
+            return sorted(name for name in listdir(path) if isdir("{}/{}".format(path, name)))
+
+        with closing(scandir(path)) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+
+    """
+    Indica si un buzon tiene al menos una de sus listas.
+    Parametros:
+        - user: El usuario dueño del buzon.
+    """
+    def has_lists(self, user):
+        return any(exists(self.list_path(user, key)) for key in sorted(self.parameters["relative_paths"].keys()))
+
+    """
+    Permite obtener los grupos de usuarios que pueden nombrar los filtros allow y deny. El archivo se vuelve a leer
+    en cada llamada, para que un proceso de larga duracion vea los cambios.
+    """
+    def groups(self):
+        return UserFilter.load_groups(self.parameters["groups_path"])
+
+    """
+    Permite obtener la ruta de una lista de un usuario.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+    """
+    def list_path(self, user, key):
+        return "{}{}{}".format(self.parameters['source_path'], user, self.parameters['relative_paths'][key])
+
+    """
+    Permite preparar el manejador con las opciones de la consola: el manifiesto de estado y el indice de dominios
+    se usan si se piden o si ya existen, mientras que el almacen de listas solo se usa si se pide. El registro de
+    lotes se usa si se pide o si quedo un lote interrumpido, para que no se aplique otro lote antes de recuperarlo.
+    El historial de cambios, al igual que el manifiesto, se usa si se pide o si ya existe. El limite de entrada y
+    salida se toma de la configuracion (ver IOThrottle).
+    Parametros:
+        - incremental: Indica si se activan las ejecuciones incrementales (ver use_manifest).
+        - index: Indica si se crea el indice de dominios aunque no exista (ver use_domain_index).
+        - store: Indica si las listas se actualizan a traves del almacen (ver use_store).
+        - journal: Indica si cada lote se aplica de forma atomica (ver use_journal).
+        - history: Indica si se crea el historial de cambios aunque no exista (ver use_history).
+        - resume, shared, subdomains, verbose: Los atributos del mismo nombre.
+    """
+    def configure(self, incremental = False, index = False, store = False, journal = False, history = False, resume = False, shared = False, subdomains = False, verbose = False):
+        if store and shared:
+            raise Exception("El almacen de listas no admite el parametro shared.")
+
+        if incremental or exists(self.parameters["manifest_path"]):
+            self.use_manifest(self.parameters["manifest_path"], incremental)
+
+        if index or exists(self.parameters["index_path"]):
+            self.use_domain_index(self.parameters["index_path"])
+
+        if store:
+            self.use_store(self.parameters["store_path"])
+
+        if journal or exists(self.parameters["journal_path"]):
+            self.use_journal(self.parameters["journal_path"])
+
+        if history or exists(self.parameters["history_path"]):
+            self.use_history(self.parameters["history_path"])
+
+        self.throttle = IOThrottle.build(self.parameters)
+        self.resume = resume
+        self.shared = shared
+        self.subdomains = subdomains
+        self.verbose = verbose
+
+    """
+    Permite usar el manifiesto de estado. Con el se reconocen las listas ya compactadas (ver compact) y, si se
+    activan las ejecuciones incrementales, las listas cuyo estado registrado ya refleja el lote no se vuelven a
+    revisar.
+    Parametros:
+        - path: La ruta del manifiesto.
+        - incremental: Indica si se activan las ejecuciones incrementales.
+    """
+    def use_manifest(self, path, incremental = True):
+        self.manifest = StateManifest(path)
+        self.incremental = incremental
+
+    """
+    Indica si una lista esta ordenada y sin duplicados segun el manifiesto, si esta activo.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - path: La ruta de la lista.
+    """
+    def is_sorted(self, user, key, path):
+        return self.manifest is not None and self.manifest.is_sorted(user, key, path)
+
+    """
+    Permite usar el indice invertido de dominios (ver DomainIndex). Mientras este activo, cada lista procesada
+    que cambie se vuelve a indexar.
+    Parametros:
+        - path: La ruta del indice.
+    """
+    def use_domain_index(self, path):
+        self.domain_index = DomainIndex(path)
+
+    """
+    Permite actualizar en el indice invertido, si esta activo, las listas de un usuario que cambiaron desde la
+    ultima vez que se indexaron. Retorna el error ocurrido o None.
+    Parametros:
+        - user: El usuario dueño de las listas.
+        - keys: Los tipos de lista a revisar.
+    """
+    def refresh(self, user, keys):
+        if self.domain_index is None:
+            return None
+
+        try:
+            for key in sorted(keys):
+                with self.io(0), self.stats.timer("read"):
+                    result = self.domain_index.collect(user, key, self.resolve(self.list_path(user, key)))
+
+                if result is not None:
+                    with self.stats.timer("write"):
+                        self.domain_index.store(user, key, *result)
+
+                    self.stats.count("indexed_lists")
+        except Exception as error:
+            return error
+
+        return None
+
+    """
+    Permite construir o poner al dia el indice invertido con las listas de todos los usuarios, ya sea uno tras
+    otro o repartiendo los usuarios entre varios hilos. Solo se leen las listas que cambiaron desde la ultima vez
+    que se indexaron, y se eliminan del indice los usuarios que ya no existen.
+    Parametros:
+        - jobs: La cantidad de hilos que leen listas en paralelo.
+    """
+    def build_index(self, jobs = 1):
+        if self.domain_index is None:
+            self.use_domain_index(self.parameters["index_path"])
+
+        users = sorted(self.users)
+        keys = list(self.parameters["relative_paths"].keys())
+        failures = self.run_users(users, lambda user: self.refresh(user, keys), jobs)
+
+        removed = self.domain_index.prune(users)
+        self.domain_index.commit()
+
+        self.log_and_print("Indice: {}, Usuarios: {}, Listas indexadas: {}, Usuarios eliminados: {}".format(self.domain_index.path, len(users), self.stats.counters['indexed_lists'], len(removed)), "info")
+        self.report_failures("indexar", users, failures)
+
+    """
+    Permite aplicar una tarea de mantenimiento a cada usuario, ya sea uno tras otro o repartiendo los usuarios
+    entre varios hilos. Retorna, en orden alfabetico, los usuarios en que la tarea fallo junto con su error.
+    Parametros:
+        - users: Los usuarios a procesar, en orden alfabetico.
+        - work: Una funcion que recibe un usuario y retorna el error ocurrido o None; si lanza una excepcion, esta
+        se considera el error del usuario.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    def run_users(self, users, work, jobs = 1):
+        failures = []
+        pool = None
+
+        def attempt(user):
+            try:
+                return user, work(user)
+            except Exception as error:
+                return user, error
+
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            results = pool.imap(attempt, users)
+        else:
+            results = (attempt(user) for user in users)
+
+        progress = ProgressLine(self.progress, len(users)) if self.progress is not None else None
+
+        for done, (user, error) in enumerate(results, 1):
+            if error is not None:
+                failures.append((user, error))
+
+            if progress is not None:
+                progress.update(done)
+
+        if progress is not None:
+            progress.update(len(users), True)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        self.stats.count("users", len(users))
+        self.stats.count("failed_users", len(failures))
+
+        return failures
+
+    """
+    Permite registrar los errores de una tarea de mantenimiento (ver run_users) y, si hubo alguno, lanzar una
+    excepcion.
+    Parametros:
+        - verb: La tarea, tal como se nombra en el mensaje de error.
+        - users: Los usuarios procesados.
+        - failures: Los usuarios en que la tarea fallo junto con su error.
+    """
+    def report_failures(self, verb, users, failures):
+        for user, error in failures:
+            self.log_and_print("Usuario: {}\n\tError: {}\n".format(user, error), "error")
+
+        if len(failures) != 0:
+            self.stats.success = False
+            raise Exception("No se pudo {} {} de {} usuarios: {}. Revise el log para mas detalles.".format(verb, len(failures), len(users), [user for user, error in failures]))
+
+    """
+    Permite usar el almacen de listas (ver PolicyStore). Mientras este activo, add y remove consultan y actualizan
+    el almacen en lugar de recorrer los archivos, y solo escriben los archivos de las listas que cambian.
+    Parametros:
+        - path: La ruta del almacen.
+    """
+    def use_store(self, path):
+        self.store = PolicyStore(path)
+
+    """
+    Permite aplicar cada lote de forma atomica mediante un registro previo de escritura (ver BatchJournal): las
+    listas de todos los usuarios se reemplazan recien al final del lote, y un lote interrumpido se puede completar
+    o deshacer con recover.
+    Parametros:
+        - path: La ruta del registro.
+    """
+    def use_journal(self, path):
+        self.journal = BatchJournal(path)
+
+    """
+    Permite registrar en un historial los cambios que cada lote hace en las listas (ver ChangeHistory), para luego
+    poder devolverlas al estado que tenian antes de un lote con restore.
+    Parametros:
+        - path: La ruta del historial.
+    """
+    def use_history(self, path):
+        self.history = ChangeHistory(path)
+
+    """
+    Permite anotar en el historial, si esta activo, las entradas que una tarea elimino y agrego a una lista.
+    Parametros:
+        - user: El usuario dueño de la lista.
+        - key: El tipo de lista, ya sea "whitelist" o "blacklist".
+        - removed: Las entradas eliminadas.
+        - added: Las entradas agregadas al final de la lista.
+    """
+    def note(self, user, key, removed, added):
+        if self.history is not None:
+            self.history.note(user, key, removed, added)
+
+    """
+    Permite obtener la ruta donde esta la version mas reciente de una lista, que durante un lote con registro
+    puede ser un archivo temporal aun no confirmado (ver BatchJournal.resolve).
+    Parametros:
+        - path: La ruta de la lista.
+    """
+    def resolve(self, path):
+        if self.journal is None or not self.journal.active:
+            return path
+
+        return self.journal.resolve(path)
+
+    """
+    Permite completar o deshacer el lote que quedo interrumpido, segun si alcanzo a confirmarse (ver
+    BatchJournal.recover).
+    """
+    def recover(self):
+        journal = self.journal or BatchJournal(self.parameters["journal_path"])
+        result = journal.recover()
+
+        if result is None:
+            self.log_and_print("Registro: {}, No hay ningun lote interrumpido".format(journal.path), "info")
+            return
+
+        batch_id, committed, files = result
+        self.stats.count("recovered_lists", files)
+        self.log_and_print("Registro: {}, Lote: {}, {}, Listas: {}".format(journal.path, batch_id, 'Completado' if committed else 'Deshecho', files), "info")
+
+    """
+    Permite obtener las rutas de las listas de un usuario, verificando que sus archivos esten tal como se
+    escribieron o importaron por ultima vez desde el almacen.
+    Parametros:
+        - user: El usuario dueño de las listas.
+        - keys: Los tipos de lista a revisar.
+    """
+    def store_paths(self, user, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        stale = [path for key, path in sorted(paths.items()) if not self.store.is_current(user, key, path)]
+
+        if len(stale) != 0:
+            raise Exception("Las listas {} fueron modificadas por fuera del almacen; utilice import para leerlas o materialize para sobrescribirlas.".format(stale))
+
+        return paths
+
+    """
+    Permite importar al almacen las listas de todos los usuarios, ya sea uno tras otro o repartiendo los usuarios
+    entre varios hilos. Solo se leen las listas que cambiaron desde la ultima vez que se importaron o escribieron,
+    y se eliminan del almacen los usuarios que ya no existen.
+    Parametros:
+        - jobs: La cantidad de hilos que leen listas en paralelo.
+    """
+    def import_store(self, jobs = 1):
+        if self.store is None:
+            self.use_store(self.parameters["store_path"])
+
+        users = sorted(self.users)
+        keys = sorted(self.parameters["relative_paths"].keys())
+
+        def work(user):
+            for key in keys:
+                path = self.list_path(user, key)
+
+                if self.store.is_current(user, key, path):
+                    continue
+
+                signature = PolicyStore.signature(path)
+                lines = self.read_list(path)[0] if signature is not None else []
+
+                with self.stats.timer("write"):
+                    self.store.replace(user, key, lines, signature)
+
+                self.stats.count("imported_lists")
+
+        failures = self.run_users(users, work, jobs)
+        removed = self.store.prune(users)
+        self.store.commit()
+
+        self.log_and_print("Almacen: {}, Usuarios: {}, Listas importadas: {}, Usuarios eliminados: {}".format(self.store.path, len(users), self.stats.counters['imported_lists'], len(removed)), "info")
+        self.report_failures("importar", users, failures)
+
+    """
+    Permite comparar las listas de todos los usuarios con el almacen, sin modificar ninguna de las dos. Se
+    registra cada lista que difiere, con las entradas que solo estan en el archivo y las que solo estan en el
+    almacen (o bien que solo difiere el orden), y los usuarios del almacen que ya no tienen buzon. Si hay alguna
+    diferencia se lanza una excepcion.
+    Parametros:
+        - jobs: La cantidad de hilos que leen listas en paralelo.
+    """
+    def verify_store(self, jobs = 1):
+        if self.store is None:
+            self.use_store(self.parameters["store_path"])
+
+        users = sorted(self.users)
+        keys = sorted(self.parameters["relative_paths"].keys())
+        differences = {}
+
+        def work(user):
+            for key in keys:
+                path = self.list_path(user, key)
+                lines = self.read_list(path)[0] if exists(path) else []
+                stored = self.store.lines(user, key)
+
+                if lines != stored:
+                    differences[(user, key)] = (sorted((Counter(lines) - Counter(stored)).elements()), sorted((Counter(stored) - Counter(lines)).elements()))
+
+        failures = self.run_users(users, work, jobs)
+        orphans = sorted(set(self.store.users()).difference(users))
+
+        for user, key in sorted(differences.keys()):
+            only_file, only_store = differences[(user, key)]
+            labels = [("Solo en archivo", only_file), ("Solo en almacen", only_store)]
+            message = "Usuario: {}, Lista: {}, ".format(user, key) + ', '.join("{}: {}".format(label, domains if self.verbose else len(domains)) for label, domains in labels)
+            self.log_and_print(message + (", Orden distinto" if len(only_file) + len(only_store) == 0 else ""), "warning")
+
+        for user in orphans:
+            self.log_and_print("Usuario: {}, Sin buzon".format(user), "warning")
+
+        mismatched = sorted({user for user, key in differences.keys()} | set(orphans))
+        self.stats.count("mismatched_lists", len(differences))
+        self.log_and_print("Almacen: {}, Usuarios: {}, Listas distintas: {}, Usuarios sin buzon: {}".format(self.store.path, len(users), len(differences), len(orphans)), "info")
+        self.report_failures("verificar", users, failures)
+
+        if len(mismatched) != 0:
+            self.stats.success = False
+            raise Exception("Las listas de {} usuarios no coinciden con el almacen: {}. Utilice import o materialize para igualarlas.".format(len(mismatched), mismatched))
+
+    """
+    Permite escribir las listas de todos los usuarios a partir del almacen, ya sea uno tras otro o repartiendo los
+    usuarios entre varios hilos. Solo se leen las listas que cambiaron desde la ultima vez que se importaron o
+    escribieron, y solo se reescriben las que tienen entradas distintas a las del almacen.
+    Parametros:
+        - jobs: La cantidad de hilos que escriben listas en paralelo.
+    """
+    def materialize_store(self, jobs = 1):
+        if self.store is None:
+            self.use_store(self.parameters["store_path"])
+
+        users = sorted(self.users)
+        keys = sorted(self.parameters["relative_paths"].keys())
+
+        def work(user):
+            for key in keys:
+                path = self.list_path(user, key)
+
+                if self.store.is_current(user, key, path):
+                    continue
+
+                stored = self.store.lines(user, key)
+                lines = self.read_list(path)[0] if exists(path) else None
+
+                if lines != stored:
+                    temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+                    with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                        new_file.write(''.join("{}\n".format(domain) for domain in stored))
+
+                    self.replace_list(path, absolute_temporal_file_path)
+
+                    self.stats.count("rewritten")
+                else:
+                    self.stats.count("skipped")
+
+                self.store.mark(user, key, path)
+
+        failures = self.run_users(users, work, jobs)
+        self.store.commit()
+
+        self.log_and_print("Almacen: {}, Usuarios: {}, ".format(self.store.path, len(users)) + ', '.join("{}: {}".format(label, self.stats.counters[key]) for key, label in SpamManager.counter_labels[:2]), "info")
+        self.report_failures("materializar", users, failures)
+
+    """
+    Permite revisar las listas de todos los usuarios, ya sea uno tras otro o repartiendo los usuarios entre varios
+    hilos, leyendo una sola vez cada archivo. En cada lista se buscan las entradas repetidas (segun su forma
+    canonica), las que no tienen la forma de un dominio o direccion, si falta el salto de linea final y las
+    entradas que tambien estan en la otra lista del usuario. Ademas, si mas de la mitad de los usuarios tiene
+    exactamente las mismas entradas en un tipo de lista, se indica para cada lista distinta las entradas de la
+    mayoria que le faltan y las que le sobran. Las entradas se informan tal como estan escritas en la lista.
+    Se escribe una linea JSON por cada lista con algun hallazgo, en orden alfabetico, seguida de una linea con los
+    totales. Con `fix`, las listas con entradas repetidas o invalidas, o sin salto de linea final, se reescriben
+    sin ellas mediante un renombre atomico y, si el historial de cambios esta activo y se corrigio alguna lista, las
+    entradas eliminadas se anotan en el como un lote mas (ver restore); las entradas en ambas listas y las diferencias con la mayoria solo
+    se informan. Si quedan hallazgos sin corregir, aparte de las diferencias con la mayoria, se lanza una excepcion.
+    Parametros:
+        - output: El archivo donde se escriben los hallazgos.
+        - fix: Indica si se corrigen las listas.
+        - jobs: La cantidad de hilos que leen listas en paralelo.
+    """
+    def audit(self, output, fix = False, jobs = 1):
+        users = sorted(self.users)
+        keys = sorted(self.parameters["relative_paths"].keys())
+        findings = {}
+        contents = {}
+        digests = {}
+        batch_id = None
+
+        def work(user):
+            findings[user], contents[user] = self.audit_user(user, keys, fix)
+
+        failures = self.run_users(users, work, jobs)
+        removed = {user: {key: finding["duplicates"] + finding["malformed"] for key, finding in findings[user].items() if finding["fixed"]} for user in findings.keys()}
+        fixed = sorted(user for user in removed.keys() if any(len(entries) != 0 for entries in removed[user].values()))
+
+        if len(fixed) != 0 and self.history is not None:
+            batch_id = sha1("audit:{}".format(time())).hexdigest()[:12]
+            self.history.begin(batch_id, "audit")
+
+            for user in fixed:
+                for key, entries in sorted(removed[user].items()):
+                    self.note(user, key, entries, [])
+
+                self.history.store(user)
+
+            self.history.commit()
+
+        distinct = {key: {} for key in keys}
+
+        for user in sorted(contents.keys()):
+            digests[user] = {}
+
+            for key, entries in contents[user].items():
+                digest = sha1('\n'.join(sorted(entries))).hexdigest()
+                group = distinct[key].setdefault(digest, [entries, 0])
+                group[1] += 1
+                digests[user][key] = digest
+
+                if group[0] == entries:
+                    contents[user][key] = group[0]
+
+        for key in keys:
+            lists = sum(count for entries, count in distinct[key].values())
+            digest, (majority, count) = max(distinct[key].items(), key=lambda item: (item[1][1], item[0])) if lists != 0 else (None, (None, 0))
+
+            if count * 2 <= lists:
+                continue
+
+            for user in sorted(digests.keys()):
+                if digests[user].get(key, digest) != digest:
+                    entries = contents[user][key]
+                    findings[user][key]["missing"] = sorted(majority[entry] for entry in majority if entry not in entries)
+                    findings[user][key]["extra"] = sorted(entries[entry] for entry in entries if entry not in majority)
+
+        totals = Counter()
+        pending = []
+
+        for user in sorted(findings.keys()):
+            for key, finding in sorted(findings[user].items()):
+                totals["lists"] += 1
+                labels = ["duplicates", "malformed", "conflicts", "missing", "extra"]
+
+                if not (finding["unterminated"] or any(finding.get(label) for label in labels)):
+                    continue
+
+                for label in labels:
+                    totals[label] += len(finding.get(label, []))
+
+                totals["unterminated"] += finding["unterminated"]
+                totals["divergent"] += "missing" in finding
+                totals["fixed"] += finding["fixed"]
+
+                if len(finding["conflicts"]) != 0 or (not finding["fixed"] and (finding["unterminated"] or len(finding["duplicates"]) + len(finding["malformed"]) != 0)):
+                    pending.append(user)
+
+                output.write(json.dumps(dict(finding, user=user, list=key), sort_keys=True) + '\n')
+
+        totals["users"] = len(users)
+        output.write(json.dumps(dict((label, totals[label]) for label in ["users", "lists", "duplicates", "malformed", "conflicts", "unterminated", "divergent", "fixed"]), sort_keys=True) + '\n')
+        output.flush()
+
+        self.stats.count("audited_lists", totals["lists"])
+        self.stats.count("fixed_lists", totals["fixed"])
+        self.log_and_print("Auditoria: Usuarios: {}, Listas: {}, Duplicados: {}, Invalidos: {}, En ambas listas: {}, Sin salto final: {}, Distintas de la mayoria: {}, Corregidas: {}".format(len(users), totals['lists'], totals['duplicates'], totals['malformed'], totals['conflicts'], totals['unterminated'], totals['divergent'], totals['fixed']) + (", Lote: {}".format(batch_id) if batch_id is not None else ""), "info")
+        self.report_failures("auditar", users, failures)
+
+        pending = sorted(set(pending))
+
+        if len(pending) != 0:
+            self.stats.success = False
+            raise Exception("Las listas de {} usuarios tienen entradas repetidas, invalidas o en ambas listas, o les falta el salto de linea final: {}. Utilice fix para corregir las que no estan en ambas listas.".format(len(pending), pending))
+
+    """
+    Permite revisar las listas de un usuario (ver audit) y, si se pide, corregirlas. Retorna un diccionario que
+    asocia cada tipo de lista existente con sus hallazgos, y otro que asocia cada tipo de lista con un diccionario
+    de sus entradas en forma canonica y su primera aparicion.
+    Parametros:
+        - user: El usuario dueño de las listas.
+        - keys: Los tipos de lista a revisar.
+        - fix: Indica si se reescriben las listas con entradas repetidas o invalidas, o sin salto de linea final.
+    """
+    def audit_user(self, user, keys, fix):
+        findings = {}
+        contents = {}
+
+        for key in keys:
+            path = self.list_path(user, key)
+
+            if not exists(path):
+                continue
+
+            domains, last_line_character = self.read_list(path)
+            seen = {}
+            kept = []
+            finding = {"duplicates": [], "malformed": [], "unterminated": len(domains) != 0 and last_line_character != '\n', "fixed": False}
+
+            with self.stats.timer("match"):
+                for domain in domains:
+                    canonical = DomainTrie.canonical(domain)
+
+                    if DomainTrie.parse(domain) is None or len(domain.split()) != 1:
+                        finding["malformed"].append(domain)
+                    elif canonical in seen:
+                        finding["duplicates"].append(domain)
+                    else:
+                        seen[canonical] = domain
+                        kept.append(domain)
+
+            if fix and (finding["unterminated"] or len(finding["duplicates"]) + len(finding["malformed"]) != 0):
+                temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+                with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                    new_file.write(''.join("{}\n".format(domain) for domain in kept))
+
+                self.replace_list(path, absolute_temporal_file_path)
+                finding["fixed"] = True
+
+            findings[key] = finding
+            contents[key] = seen
+
+        for key in findings.keys():
+            others = [contents[other] for other in contents.keys() if other != key]
+            findings[key]["conflicts"] = sorted(contents[key][entry] for entry in set(contents[key]).intersection(*others)) if len(others) != 0 else []
+
+        return findings, contents
+
+    """
+    Permite obtener, desde el indice invertido, los usuarios que tienen una entrada en cada tipo de lista. Si se
+    consideran los subdominios, tambien se buscan las entradas mas amplias que la cubren. Retorna un diccionario
+    que asocia cada tipo de lista con una lista ordenada de tuplas con el usuario y la entrada encontrada.
+    Parametros:
+        - entry: La entrada a buscar, ya sea 'dominio', '*@dominio' o 'usuario@dominio'.
+    """
+    def query(self, entry):
+        if self.domain_index is None:
+            raise Exception("El indice de dominios no existe. Para crearlo utilice el parametro index.")
+
+        entries = [DomainTrie.canonical(entry)] + (DomainTrie.ancestors(entry) if self.subdomains else [])
+        result = {key: [] for key in self.parameters["relative_paths"].keys()}
+
+        for key, user, domain in self.domain_index.query(entries):
+            result.setdefault(key, []).append((user, domain))
+
+        return result
+
+    """
+    Permite revisar si las direcciones de correo coinciden con la lista blanca o negra de su destinatario. Cada
+    linea debe tener el usuario dueño del buzon y la direccion, separados por espacios. Las listas se compilan la
+    primera vez que se necesitan (ver AddressMatcher) y se mantienen en memoria; en cada llamada se revisa una vez
+    por usuario si sus listas cambiaron. Retorna un generador de tuplas con el usuario, la direccion y un
+    diccionario que asocia cada tipo de lista con la entrada que coincide, o None si la linea no es valida, el
+    usuario no existe o la direccion no tiene la forma de una direccion o dominio (ver AddressMatcher.valid).
+    Parametros:
+        - lines: Las lineas a revisar.
+    """
+    def check(self, lines):
+        users = set(self.users)
+        keys = sorted(self.parameters["relative_paths"].keys())
+        compiled = {}
+        totals = Counter()
+
+        for line in lines:
+            fields = line.split()
+
+            if len(fields) == 0:
+                continue
+
+            user, address = fields[0], ' '.join(fields[1:])
+
+            if len(fields) != 2 or user not in users or not AddressMatcher.valid(address):
+                totals["invalid_addresses"] += 1
+                yield user, address, None
+                continue
+
+            if user not in compiled:
+                with self.stats.timer("build"):
+                    compiled[user] = [(key, self.matchers.get(self.list_path(user, key), self.io)) for key in keys]
+                    compiled[user] = [(key, matcher) for key, matcher in compiled[user] if matcher is not None]
+
+            hits = {}
+
+            for key, matcher in compiled[user]:
+                entry = matcher.match(address, self.subdomains)
+
+                if entry is not None:
+                    hits[key] = entry
+                    totals[key + "_hits"] += 1
+
+            totals["checked_addresses"] += 1
+
+            yield user, address, hits
+
+        for key, value in totals.items():
+            self.stats.count(key, value)
+
+        self.log("Revision: {} direcciones, ".format(totals['checked_addresses']) + ', '.join("{}: {}".format(key, totals[key + '_hits']) for key in keys) + ", Lineas invalidas: {}".format(totals['invalid_addresses']), "info")
+
+    """
+    Permite mantener en memoria las listas de los usuarios entre un lote y otro (ver ListIndex).
+    """
+    def use_index(self):
+        self.index = ListIndex()
+
+    """
+    Permite hacer una operacion sobre las listas respetando el limite de entrada y salida, si esta activo: se
+    espera a que el limite la admita y, al terminar, se hace la pausa que corresponda segun su latencia. Las
+    esperas se miden en la fase throttle.
+    Parametros:
+        - size: La cantidad de bytes que lee o escribe la operacion.
+    """
+    @contextmanager
+    def io(self, size):
+        if self.throttle is None:
+            yield
+            return
+
+        with self.stats.timer("throttle"):
+            self.throttle.enter(size)
+
+        started = perf_counter()
+
+        try:
+            yield
+        finally:
+            pause = self.throttle.leave(perf_counter() - started)
+
+            if pause > 0:
+                self.stats.count("throttle_pauses")
+
+                with self.stats.timer("throttle"):
+                    sleep(pause)
+
+    """
+    Permite leer las lineas no vacias de una lista junto con el ultimo caracter del archivo, ya sea desde el
+    disco o desde el indice en memoria si esta activo.
+    Parametros:
+        - path: La ruta de la lista.
+    """
+    def read_list(self, path):
+        size = stat(path).st_size
+        self.stats.count("bytes_read", size)
+
+        with self.io(size), self.stats.timer("read"):
+            if self.index is None:
+                return SpamManager.read_lines(path)
+
+            return self.index.get(path)
+
+    """
+    Permite recorrer las lineas no vacias de una lista como bytes (ver scan), ya sea desde el disco o desde el
+    indice en memoria si esta activo. El recorrido completo cuenta como una operacion del limite de entrada y
+    salida (ver io).
+    Parametros:
+        - path: La ruta de la lista.
+    """
+    def scan_list(self, path):
+        size = stat(path).st_size
+        self.stats.count("bytes_read", size)
+
+        with self.io(size):
+            for line in (SpamManager.scan(path) if self.index is None else (line for line in self.index.get(path)[0])):
+                yield line
+
+    """
+    Permite obtener el LogWriter del archivo log de la configuracion. Las instancias que comparten el archivo log
+    comparten tambien su LogWriter.
+    """
+    def writer(self):
+        path = self.parameters["log_path"]
+
+        with SpamManager.writers_lock:
+            if path not in SpamManager.writers:
+                SpamManager.writers[path] = LogWriter(path, self.parameters["log_format"])
+
+            return SpamManager.writers[path]
+
+    """
+    Permite registrar en el archivo log un mensaje de cierto tipo, ya sea warning, error o info, y mostrarlo en la
+    salida estandar, salvo que `echo` sea falso. La escritura la realiza el hilo del LogWriter.
+    """
+    def log_and_print(self, message, kind):
+        self.writer().write(message, kind, self.echo)
+
+    """
+    Permite registrar en el archivo log un mensaje de cierto tipo sin mostrarlo en la salida estandar.
+    """
+    def log(self, message, kind):
+        self.writer().write(message, kind, False)
+
+    """
+    Permite esperar a que todos los mensajes pendientes queden escritos en los logs y la salida estandar.
+    """
+    @staticmethod
+    def flush():
+        with SpamManager.writers_lock:
+            for writer in SpamManager.writers.values():
+                writer.close()
+
+            SpamManager.writers.clear()
+    
+    """
+    Permite recorrer una a una las lineas de un archivo, saltandose todas aquellas que estan vacias. Las lineas
+    se leen a medida que se consumen, por lo que el archivo nunca se carga completo en memoria.
+    Parametros:
+        - absolute_path: La ruta absoluta del archivo
+    """
+    @staticmethod
+    def tokenize(absolute_path):
+        with open(absolute_path) as file:
+            for line in file:
+                line = line.strip()
+                if line == '':
+                    continue
+                yield line
+
+    """
+    Permite leer todas las lineas no vacias de un archivo, sin espacios en los extremos, junto con el ultimo
+    caracter del archivo, que indica si termina en un salto de linea.
+    Parametros:
+        - absolute_path: La ruta absoluta del archivo
+    """
+    @staticmethod
+    def read_lines(absolute_path):
+        lines = []
+        last_line_character = ''
+
+        with open(absolute_path) as file:
+            for line in file:
+                last_line_character = line[-1]
+                line = line.strip()
+
+                if line != '':
+                    lines.append(line)
+
+        return lines, last_line_character
+
+    """
+    Permite separar las lineas de un archivo de parche en los dominios a agregar, que comienzan con '+', y los
+    dominios a eliminar, que comienzan con '-'. Las lineas vacias se omiten.
+    Parametros:
+        - absolute_path: La ruta absoluta del archivo
+    """
+    @staticmethod
+    def tokenize_patch(absolute_path):
+        return SpamManager.split_patch(SpamManager.tokenize(absolute_path), absolute_path)
+
+    """
+    Permite separar lineas de parche ya leidas en los dominios a agregar y a eliminar (ver tokenize_patch).
+    Parametros:
+        - lines: Las lineas no vacias del parche.
+        - source: El origen de las lineas, usado en los mensajes de error.
+    """
+    @staticmethod
+    def split_patch(lines, source):
+        result = {"add": [], "remove": []}
+
+        for line in lines:
+            if line[0] == '+':
+                result["add"].append(line[1:].strip())
+            elif line[0] == '-':
+                result["remove"].append(line[1:].strip())
+            else:
+                raise Exception("La linea '{}' del parche {} debe comenzar con '+' (agregar) o '-' (eliminar).".format(line, source))
+
+        return result
+
+    """
+    Permite obtener las rutas de las listas y filtros presentes en una carpeta de lote. Los archivos deben
+    llamarse estrictamente whitelist, blacklist, allow y deny; el resto se ignora.
+    Parametros:
+        - folder: La ruta de la carpeta.
+    """
+    @staticmethod
+    def batch_filenames(folder):
+        list_filenames = {}
+        filter_filenames = {}
+
+        if folder[-1] != "/":
+            folder += "/"
+
+        for listname in listdir(folder):
+            if listname in ["whitelist", "blacklist"]:
+                list_filenames[listname] = "{}{}".format(folder, listname)
+            if listname in ["allow", "deny"]:
+                filter_filenames[listname] = "{}{}".format(folder, listname)
+
+        return list_filenames, filter_filenames
+
+    """
+    Permite leer las listas y filtros de un lote a partir de sus rutas.
+    Parametros:
+        - list_filenames: Un diccionario con las rutas de las listas "whitelist" y/o "blacklist".
+        - filter_filenames: Un diccionario con las rutas de los filtros "allow" y/o "deny".
+        - patch: Indica si las listas son parches (ver tokenize_patch).
+    """
+    @staticmethod
+    def load_batch(list_filenames, filter_filenames, patch = False):
+        lists = {}
+        filters = {}
+
+        for key, filename in list_filenames.items():
+            if patch:
+                lists[key] = SpamManager.tokenize_patch(filename)
+            else:
+                lists[key] = SpamManager.tokenize(filename)
+
+        for key, filename in filter_filenames.items():
+            filters[key] = SpamManager.tokenize(filename)
+
+        return lists, filters
+
+    """
+    Permite reemplazar un archivo por otro temporal creado en su misma carpeta, conservando sus permisos si ya
+    existia; si no, recibe los permisos que tendria al crearlo con open, segun la mascara del proceso. Como ambos
+    estan en el mismo sistema de archivos, el cambio se hace con un unico renombre atomico.
+    Parametros:
+        - path: La ruta del archivo a reemplazar.
+        - absolute_temporal_file_path: La ruta del archivo temporal con el nuevo contenido.
+    """
+    @staticmethod
+    def replace(path, absolute_temporal_file_path):
+        if exists(path):
+            copymode(path, absolute_temporal_file_path)
+        else:
+            chmod(absolute_temporal_file_path, 0o666 & ~SpamManager.creation_mask)
+
+        rename(absolute_temporal_file_path, path)
+
+    """
+    Permite reemplazar una lista por su version nueva (ver replace), registrando el tiempo y los bytes escritos.
+    Durante un lote con registro, la version nueva solo queda pendiente hasta que se confirme el lote.
+    Parametros:
+        - path: La ruta de la lista.
+        - absolute_temporal_file_path: La ruta del archivo temporal con el nuevo contenido.
+    """
+    def replace_list(self, path, absolute_temporal_file_path):
+        size = stat(absolute_temporal_file_path).st_size
+        self.stats.count("bytes_written", size)
+
+        with self.io(size), self.stats.timer("rename"):
+            if self.journal is not None and self.journal.active:
+                self.journal.stage(path, absolute_temporal_file_path)
+            else:
+                SpamManager.replace(path, absolute_temporal_file_path)
+    
+    """
+    Permite recorrer las lineas no vacias de un archivo como bytes y sin espacios en los extremos. El archivo se
+    mapea en memoria en lugar de leerse, de modo que revisar un archivo que no se modificara no lo copia completo.
+    Parametros:
+        - absolute_path: La ruta absoluta del archivo
+    """
+    @staticmethod
+    def scan(absolute_path):
+        with open(absolute_path, 'rb') as file:
+            if fstat(file.fileno()).st_size == 0:
+                return
+
+            with closing(mmap(file.fileno(), 0, access=ACCESS_READ)) as content:
+                for line in iter(content.readline, b''):
+                    line = line.strip()
+
+                    if line != b'':
+                        yield line
+
+    """
+    Permite filtrar que usuarios seran afectados por los cambios hechos en la lista blanca y/o negra.
+    Parametros:
+        - users: La lista de usuarios que se pretende filtrar.
+        - filter: Es un diccionario que puede contener las llaves "allow" y "deny", y junto a ello, las listas
+        de todos los usuarios.
+            -- Si "allow" esta presente, significa que solo los usuarios enlistados son afectados por los cambios.
+            -- Si "deny" esta presente, significa que todos los usuarios seran afectados por los cambios, excepto
+            los enlistados
+        Ademas de nombres exactos, las listas pueden contener patrones y grupos con nombre (ver UserFilter).
+        - groups: Los grupos de usuarios que pueden nombrar las listas (ver UserFilter.load_groups).
+    """
+    @staticmethod
+    def filter_as(users, filter, groups = {}):
+        for key, domains in filter.items():
+            if key not in ["allow", "deny"]:
+                raise Exception("Llaves mal provistas en la funcion filter_as; Solo se permiten las siguientes: allow o deny.")
+
+            users, domains = set(users), UserFilter(domains, groups)
+
+            """
+            Simula un left join que excluye cualquier elemento del lado derecho, es decir, obtenemos los elementos que no estan
+            presentes en el lado derecho para asi ver si estamos tratando con un usuario que no existe.
+            """
+            if len(domains.names) != len(users.intersection(domains.names)):
+                raise Exception("Uno o mas usuarios que trata de filtrar no existen dentro del dominio.")
+
+            selected, unused = domains.select(users)
+
+            if len(unused) != 0:
+                raise Exception("Los patrones o grupos {} no coinciden con ningun usuario del dominio.".format(unused))
+            
+            if key == "allow":
+                users = list(selected)
+            else:
+                users = list(users.difference(selected))
+                
+        return users
+
+    """
+    Permite aplicar una accion ("add", "remove", "patch", "reconcile" o "compact") sobre las listas de los usuarios
+    y retorna los resumenes de cada usuario.
+    Parametros:
+        - action: El nombre de la accion.
+        - lists, filter, jobs: Los mismos parametros de add, remove, patch, reconcile y compact.
+    """
+    def apply(self, action, lists, filter = {}, jobs = 1):
+        actions = {"add": self.add, "remove": self.remove, "patch": self.patch, "reconcile": self.reconcile, "compact": self.compact}
+
+        if action not in actions:
+            raise Exception("La accion {} no existe, solo son validas las siguientes: {}".format(action, sorted(actions.keys())))
+        if self.store is not None and action not in ["add", "remove"]:
+            raise Exception("La accion {} no admite el almacen de listas, solo son validas las siguientes: ['add', 'remove']".format(action))
+
+        return actions[action](lists, filter, jobs)
+
+    """
+    Permite agregar nuevos dominios tanto para la lista blanca como negra de los usuarios, verificando
+    si estos ya se encuentran presentes en las listas actuales; si ocurre una coincidencia, se lanza
+    una excepcion y simplemente se elimina de los nuevos dominios a agregar. Note que el metodo puede
+    agregar solo itemes a la lista blanca, negra o ambas.
+    Parametros:
+        - lists: Un diccionario que puede contener las llaves "whitelist" y "blacklist" junto las listas
+        de todos los posibles dominios a agregar.
+        - filter_as: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los dominios a filtrar.
+            -- Si la llave es "allow", solo se agregaran los nuevos dominios a esos usuarios.
+            -- Si la llave es "deny", se agregaran los dominios a todos los usuarios exceptos a los que
+            indique el filtro de dominios.
+    """
+    def add(self, lists, filter = {}, jobs = 1):
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        with self.stats.timer("build"):
+            engine = MatchingEngine.build(lists, self.parameters["memory_budget"]) if self.store is None else MatchingEngine(lists)
+
+        try:
+            with self.stats.timer("build"):
+                if self.subdomains:
+                    engine.index_subdomains()
+                if self.store is not None:
+                    self.store.load_batch(engine.ordered)
+
+                batches = {key: "add:{}".format(engine.fingerprint(key)) for key in engine.keys()}
+
+            contents = [(key, [("Agregar", engine.contents(key))]) for key in engine.keys()]
+
+            task = self.add_user if self.store is None else self.store_add_user
+
+            return self.dispatch(users, lambda user, keys: task(user, engine, keys), jobs, batches, contents)
+        finally:
+            engine.close()
+
+    """
+    Permite agregar los dominios del lote a las listas de un usuario y retorna el resumen de los cambios.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - engine: El MatchingEngine construido a partir de los dominios a agregar.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def add_user(self, user, engine, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        inserted_domains = {}
+        repeated_domains = {}
+        covered_domains = {}
+
+        for key, path in paths.items():
+            tally = engine.tally(key)
+            trie = DomainTrie()
+
+            """
+            En una lista compactada basta con buscar los dominios del lote, ya que cada uno aparece a lo mas una vez
+            y en orden.
+            """
+            if engine.searchable(key) and self.is_sorted(user, key, path):
+                with self.io(0), self.stats.timer("read"):
+                    domains = SortedList.search(path, engine.domains[key])
+                    last_line_character = SortedList.last_character(path)
+
+                self.stats.count("sorted_lookups")
+            else:
+                domains, last_line_character = self.read_list(path)
+            
+            with self.stats.timer("match"):
+                for domain in domains:
+                    tally.feed(domain)
+
+                    if self.subdomains:
+                        trie.insert(domain)
+
+                inserted_domains[key], repeated_domains[key] = tally.result()
+
+                if self.subdomains:
+                    inserted_domains[key], covered_domains[key] = trie.prune(inserted_domains[key])
+            
+            self.append_lines(path, inserted_domains[key], last_line_character)
+            self.note(user, key, [], inserted_domains[key])
+            self.stats.count("appended" if len(inserted_domains[key]) != 0 else "unchanged")
+
+        return self.added(paths.keys(), inserted_domains, repeated_domains, covered_domains), {}
+
+    """
+    Permite agregar dominios al final de una lista, agregando antes un salto de linea si la lista no termina en uno.
+    Si la lista no existe, se crea. Durante un lote con registro, la lista no se modifica en el lugar: se copia
+    junto con los dominios nuevos a un archivo temporal que la reemplaza al confirmar el lote (ver replace_list).
+    Parametros:
+        - path: La ruta de la lista.
+        - domains: Los dominios a agregar, en orden.
+        - last_line_character: El ultimo caracter de la lista.
+    """
+    def append_lines(self, path, domains, last_line_character):
+        content = ''
+
+        if len(domains) != 0:
+            content = ('\n' if last_line_character != '\n' else '') + '\n'.join(domains)
+
+        if self.journal is not None and self.journal.active and exists(path):
+            if content == '':
+                return
+
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+            with self.stats.timer("write"), fdopen(temporal_file, 'wb') as new_file, open(path, 'rb') as file:
+                copyfileobj(file, new_file)
+                new_file.write(content)
+
+            self.replace_list(path, absolute_temporal_file_path)
+            return
+
+        with self.io(len(content)), self.stats.timer("write"), open(path, 'a+') as file:
+            file.write(content)
+            self.stats.count("bytes_written", len(content))
+
+    """
+    Permite obtener el detalle de los dominios agregados a las listas de un usuario (ver summarize).
+    Parametros:
+        - keys: Los tipos de lista actualizados.
+        - inserted_domains, repeated_domains, covered_domains: Los dominios agregados, repetidos y cubiertos por
+        otra entrada en cada tipo de lista.
+    """
+    def added(self, keys, inserted_domains, repeated_domains, covered_domains):
+        details = []
+
+        for key in keys:
+            details.append((key, [("Agregados", inserted_domains[key]), ("Repetidos", repeated_domains[key])]))
+
+            if self.subdomains:
+                details[-1][1].append(("Cubiertos", covered_domains[key]))
+
+        return details
+
+    """
+    Permite agregar los dominios del lote a las listas de un usuario a traves del almacen y retorna el resumen de
+    los cambios, que es el mismo de add_user. Las coincidencias con el lote se obtienen del almacen y los dominios
+    nuevos se agregan tanto al almacen como al final de cada archivo.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - engine: El MatchingEngine construido a partir de los dominios a agregar.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def store_add_user(self, user, engine, keys):
+        paths = self.store_paths(user, keys)
+        inserted_domains = {}
+        repeated_domains = {}
+        covered_domains = {}
+
+        for key, path in paths.items():
+            tally = engine.tally(key)
+            trie = DomainTrie()
+
+            with self.stats.timer("read"):
+                domains = self.store.lines(user, key) if self.subdomains else self.store.matches(user, key)
+
+            self.stats.count("store_lookups")
+
+            with self.stats.timer("match"):
+                for domain in domains:
+                    tally.feed(domain)
+
+                    if self.subdomains:
+                        trie.insert(domain)
+
+                inserted_domains[key], repeated_domains[key] = tally.result()
+
+                if self.subdomains:
+                    inserted_domains[key], covered_domains[key] = trie.prune(inserted_domains[key])
+
+            if len(inserted_domains[key]) != 0:
+                with self.io(0):
+                    last_line_character = SortedList.last_character(path) if exists(path) else ''
+
+                self.append_lines(path, inserted_domains[key], last_line_character)
+
+                with self.stats.timer("write"):
+                    self.store.append(user, key, inserted_domains[key], self.resolve(path))
+
+                self.note(user, key, [], inserted_domains[key])
+
+            self.stats.count("appended" if len(inserted_domains[key]) != 0 else "unchanged")
+
+        return self.added(paths.keys(), inserted_domains, repeated_domains, covered_domains), {}
+
+    """
+    Permite eliminar dominios de la lista blanca y negra de los usuarios. Note que el metodo puede hacerlo solo para
+    itemes de la lista blanca, negra o ambos.
+    Parametros:
+        - Undesirables: Diccionario que puede contener las llaves "whitelist" y "blacklist" junto con una lista de todos
+        los posibles dominios a eliminar.
+        - Filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los dominios a filtrar.
+            -- Si la llave es "allow", solo se agregaran los nuevos dominios a esos usuarios.
+            -- Si la llave es "deny", se agregaran los dominios a todos los usuarios exceptos a los que
+            indique el filtro de dominios.
+    """
+    def remove(self, undesirables, filter = {}, jobs = 1):
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        with self.stats.timer("build"):
+            engine = MatchingEngine.build(undesirables, self.parameters["memory_budget"]) if self.store is None else MatchingEngine(undesirables)
+
+        try:
+            with self.stats.timer("build"):
+                if self.subdomains:
+                    engine.index_subdomains()
+                if self.store is not None:
+                    self.store.load_batch(engine.ordered)
+
+                batches = {key: "remove:{}".format(engine.fingerprint(key)) for key in engine.keys()}
+
+            contents = [(key, [("Eliminar", engine.contents(key))]) for key in engine.keys()]
+
+            task = self.remove_user if self.store is None else self.store_remove_user
+
+            return self.dispatch(users, lambda user, keys: task(user, engine, keys), jobs, batches, contents)
+        finally:
+            engine.close()
+
+    """
+    Permite eliminar los dominios del lote de las listas de un usuario y retorna el resumen de los cambios.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - engine: El MatchingEngine construido a partir de los dominios a eliminar.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def remove_user(self, user, engine, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        dropped_domains = {key: [] for key in paths.keys()}
+        counters = {"rewritten": 0, "skipped": 0}
+        
+        for key, path in paths.items():
+            with self.stats.timer("match"):
+                if engine.searchable(key) and self.is_sorted(user, key, path):
+                    with self.io(0):
+                        matched = set(SortedList.search(path, engine.domains[key]))
+
+                    self.stats.count("sorted_lookups")
+                else:
+                    matched = engine.matches(key, self.scan_list(path))
+
+            if len(matched) == 0:
+                counters["skipped"] += 1
+                continue
+
+            counters["rewritten"] += 1
+            domains = self.read_list(path)[0]
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+            
+            with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                for domain in domains:
+                    if domain not in matched:
+                        new_file.write("{}\n".format(domain))
+                    else:
+                        dropped_domains[key].append(domain)
+                            
+            self.replace_list(path, absolute_temporal_file_path)
+            self.note(user, key, dropped_domains[key], [])
+
+        details = [(key, [("Eliminados", dropped_domains[key])]) for key in paths.keys()]
+
+        return details, counters
+
+    """
+    Permite eliminar los dominios del lote de las listas de un usuario a traves del almacen y retorna el resumen de
+    los cambios, que es el mismo de remove_user. Las coincidencias con el lote se obtienen del almacen, y solo se
+    reescriben los archivos de las listas que tienen alguna.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - engine: El MatchingEngine construido a partir de los dominios a eliminar.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def store_remove_user(self, user, engine, keys):
+        paths = self.store_paths(user, keys)
+        dropped_domains = {key: [] for key in paths.keys()}
+        counters = {"rewritten": 0, "skipped": 0}
+
+        for key, path in paths.items():
+            with self.stats.timer("match"):
+                if self.subdomains:
+                    matched = engine.matches(key, (line for line in self.store.lines(user, key)))
+                else:
+                    matched = set(self.store.matches(user, key))
+
+            self.stats.count("store_lookups")
+
+            if len(matched) == 0:
+                counters["skipped"] += 1
+                continue
+
+            counters["rewritten"] += 1
+
+            with self.stats.timer("read"):
+                domains = self.store.lines(user, key)
+
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+            with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                for domain in domains:
+                    if domain not in matched:
+                        new_file.write("{}\n".format(domain))
+                    else:
+                        dropped_domains[key].append(domain)
+
+            self.replace_list(path, absolute_temporal_file_path)
+
+            with self.stats.timer("write"):
+                self.store.delete(user, key, matched, self.resolve(path))
+
+            self.note(user, key, dropped_domains[key], [])
+
+        details = [(key, [("Eliminados", dropped_domains[key])]) for key in paths.keys()]
+
+        return details, counters
+
+    """
+    Permite agregar y eliminar dominios de las listas de los usuarios en una sola pasada por archivo. Cada lista se
+    lee una vez, se escriben en un archivo temporal las lineas que no se eliminan seguidas de los dominios nuevos,
+    y solo si hubo cambios se reemplaza la lista original mediante un renombre atomico.
+    Parametros:
+        - changes: Diccionario que puede contener las llaves "whitelist" y "blacklist" junto con los dominios a
+        agregar y eliminar, tal como los retorna `tokenize_patch`.
+        - filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los usuarios a filtrar.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    def patch(self, changes, filter = {}, jobs = 1):
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        with self.stats.timer("build"):
+            additions = MatchingEngine({key: change["add"] for key, change in changes.items()})
+            removals = MatchingEngine({key: change["remove"] for key, change in changes.items()})
+
+            if self.subdomains:
+                removals.index_subdomains()
+
+        for key in changes.keys():
+            conflicts = additions.domains[key].intersection(removals.domains[key])
+
+            if len(conflicts) != 0:
+                raise Exception("Los dominios {} se agregan y eliminan a la vez de la lista {}.".format(sorted(conflicts), key))
+
+        batches = {key: "patch:{}:{}".format(additions.fingerprint(key), removals.fingerprint(key)) for key in changes.keys()}
+
+        contents = [(key, [("Agregar", additions.contents(key)), ("Eliminar", removals.contents(key))]) for key in changes.keys()]
+
+        return self.dispatch(users, lambda user, keys: self.patch_user(user, additions, removals, keys), jobs, batches, contents)
+
+    """
+    Permite aplicar un parche a las listas de un usuario y retorna el resumen de los cambios.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - additions: El MatchingEngine construido a partir de los dominios a agregar.
+        - removals: El MatchingEngine construido a partir de los dominios a eliminar.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def patch_user(self, user, additions, removals, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        inserted_domains = {}
+        repeated_domains = {}
+        dropped_domains = {key: [] for key in paths.keys()}
+        covered_domains = {}
+        counters = {"rewritten": 0, "skipped": 0}
+
+        for key, path in paths.items():
+            tally = additions.tally(key)
+            trie = DomainTrie()
+            domains = self.read_list(path)[0]
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+            try:
+                with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                    for domain in domains:
+                        if removals.contains(key, domain):
+                            dropped_domains[key].append(domain)
+                            continue
+
+                        tally.feed(domain)
+                        new_file.write("{}\n".format(domain))
+
+                        if self.subdomains:
+                            trie.insert(domain)
+
+                    inserted_domains[key], repeated_domains[key] = tally.result()
+
+                    if self.subdomains:
+                        inserted_domains[key], covered_domains[key] = trie.prune(inserted_domains[key])
+
+                    for domain in inserted_domains[key]:
+                        new_file.write("{}\n".format(domain))
+            except:
+                remove(absolute_temporal_file_path)
+                raise
+
+            if len(inserted_domains[key]) == 0 and len(dropped_domains[key]) == 0:
+                remove(absolute_temporal_file_path)
+                counters["skipped"] += 1
+            else:
+                self.replace_list(path, absolute_temporal_file_path)
+                self.note(user, key, dropped_domains[key], inserted_domains[key])
+                counters["rewritten"] += 1
+
+        details = []
+
+        for key in paths.keys():
+            details.append((key, [("Agregados", inserted_domains[key]), ("Repetidos", repeated_domains[key]), ("Eliminados", dropped_domains[key])]))
+
+            if self.subdomains:
+                details[-1][1].append(("Cubiertos", covered_domains[key]))
+
+        return details, counters
+
+    """
+    Permite llevar las listas de los usuarios al estado indicado: a diferencia de add y remove, el lote no son
+    cambios sino el contenido completo que debe tener cada lista. Para cada lista se conservan, en su orden, las
+    entradas que estan en el lote, se eliminan las demas y las repetidas, y se agregan al final las entradas del
+    lote que faltan. Solo se reescriben, mediante un renombre atomico, las listas que difieren del lote.
+    Parametros:
+        - lists: Un diccionario que puede contener las llaves "whitelist" y "blacklist" junto con todas las
+        entradas que debe tener cada lista; una lista vacia deja la lista de los usuarios vacia.
+        - filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los usuarios a filtrar.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    def reconcile(self, lists, filter = {}, jobs = 1):
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        with self.stats.timer("build"):
+            desired = {}
+
+            for key, domains in lists.items():
+                desired[key] = []
+                seen = set()
+
+                for domain in domains:
+                    if domain not in seen:
+                        seen.add(domain)
+                        desired[key].append(domain)
+
+            engine = MatchingEngine(desired)
+            batches = {key: "reconcile:{}".format(engine.fingerprint(key)) for key in engine.keys()}
+
+        contents = [(key, [("Estado", engine.contents(key))]) for key in engine.keys()]
+
+        return self.dispatch(users, lambda user, keys: self.reconcile_user(user, engine, keys), jobs, batches, contents)
+
+    """
+    Permite llevar las listas de un usuario al estado indicado por el lote y retorna el resumen de los cambios.
+    Parametros:
+        - user: El usuario cuyas listas seran actualizadas.
+        - engine: El MatchingEngine construido a partir de las entradas que debe tener cada lista.
+        - keys: Los tipos de lista que se deben actualizar.
+    """
+    def reconcile_user(self, user, engine, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        inserted_domains = {key: [] for key in paths.keys()}
+        dropped_domains = {key: [] for key in paths.keys()}
+        counters = {"rewritten": 0, "skipped": 0}
+
+        for key, path in paths.items():
+            domains = self.read_list(path)[0] if exists(path) else None
+            present = set()
+            kept = []
+
+            with self.stats.timer("match"):
+                for domain in domains or []:
+                    if domain in engine.domains[key] and domain not in present:
+                        present.add(domain)
+                        kept.append(domain)
+                    else:
+                        dropped_domains[key].append(domain)
+
+                inserted_domains[key] = [domain for domain in engine.ordered[key] if domain not in present]
+
+            if domains is not None and len(inserted_domains[key]) == 0 and len(dropped_domains[key]) == 0:
+                counters["skipped"] += 1
+                continue
+
+            content = ''.join("{}\n".format(domain) for domain in kept + inserted_domains[key])
+
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+            with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                new_file.write(content)
+
+            self.replace_list(path, absolute_temporal_file_path)
+
+            self.note(user, key, dropped_domains[key], inserted_domains[key])
+            counters["rewritten"] += 1
+
+        details = [(key, [("Agregados", inserted_domains[key]), ("Eliminados", dropped_domains[key])]) for key in paths.keys()]
+
+        return details, counters
+
+    """
+    Permite compactar las listas de los usuarios: cada lista se reescribe con sus entradas en forma canonica (ver
+    DomainTrie.canonical), ordenadas, sin duplicados y sin lineas vacias. Solo se reemplazan, mediante un renombre
+    atomico, las listas cuyo contenido cambia. Las listas compactadas quedan registradas en el manifiesto, de modo
+    que add y remove las consultan mediante busqueda binaria mientras no vuelvan a modificarse.
+    Parametros:
+        - lists: Un diccionario cuyas llaves indican las listas a compactar, ya sea "whitelist" y/o "blacklist". Si
+        esta vacio, se compactan ambas.
+        - filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los usuarios a filtrar.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    def compact(self, lists = {}, filter = {}, jobs = 1):
+        if self.incremental:
+            raise Exception("La compactacion no admite ejecuciones incrementales.")
+        if self.manifest is None:
+            self.use_manifest(self.parameters["manifest_path"], False)
+
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        keys = list(lists.keys()) or ["whitelist", "blacklist"]
+        batches = {key: "compact" for key in keys}
+        contents = [(key, []) for key in keys]
+
+        return self.dispatch(users, self.compact_user, jobs, batches, contents)
+
+    """
+    Permite compactar las listas de un usuario y retorna el resumen de los cambios.
+    Parametros:
+        - user: El usuario cuyas listas seran compactadas.
+        - keys: Los tipos de lista que se deben compactar.
+    """
+    def compact_user(self, user, keys):
+        paths = {key: self.list_path(user, key) for key in keys}
+        duplicated_domains = {key: [] for key in paths.keys()}
+        normalized_domains = {key: [] for key in paths.keys()}
+        counters = {"rewritten": 0, "skipped": 0}
+
+        for key, path in paths.items():
+            batch = self.manifest.applied(user, key, path)
+            domains = self.read_list(path)[0]
+            seen = set()
+
+            with self.stats.timer("match"):
+                for domain in domains:
+                    canonical = DomainTrie.canonical(domain)
+
+                    if canonical in seen:
+                        duplicated_domains[key].append(domain)
+                    elif canonical != domain:
+                        normalized_domains[key].append(domain)
+
+                    seen.add(canonical)
+
+                content = ''.join("{}\n".format(domain) for domain in sorted(seen))
+
+            with self.io(stat(path).st_size), open(path, 'rb') as file:
+                unchanged = file.read() == content
+
+            if unchanged:
+                counters["skipped"] += 1
+            else:
+                temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+                with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                    new_file.write(content)
+
+                self.replace_list(path, absolute_temporal_file_path)
+                self.note(user, key, list((Counter(domains) - Counter(seen)).elements()), sorted((Counter(seen) - Counter(domains)).elements()))
+                counters["rewritten"] += 1
+
+            self.manifest.record(user, key, self.resolve(path), batch, sorted = True)
+
+        details = [(key, [("Duplicados", duplicated_domains[key]), ("Normalizados", normalized_domains[key])]) for key in paths.keys()]
+
+        return details, counters
+
+    """
+    Permite devolver las listas de los usuarios al estado que tenian antes de la aplicacion mas reciente de un lote,
+    deshaciendo, de la mas reciente a la mas antigua, las diferencias que el historial registro desde entonces: se
+    quitan las entradas agregadas y se vuelven a agregar al final las eliminadas. Las listas recuperan sus entradas
+    pero no necesariamente su orden. La restauracion se registra en el historial como un lote mas, de modo que
+    tambien se puede deshacer.
+    Parametros:
+        - batch_id: El identificador del lote, tal como aparece en el log.
+        - filter: Un diccionario que puede contener las llaves "allow" o "deny" junto con todos
+        los usuarios a filtrar.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    def restore(self, batch_id, filter = {}, jobs = 1):
+        if self.history is None:
+            raise Exception("El historial de cambios {} no existe. Para registrar los cambios de cada lote utilice el parametro history.".format(self.parameters['history_path']))
+
+        sequence = self.history.find(batch_id)
+
+        if sequence is None:
+            raise Exception("El lote {} no esta en el historial de cambios {}.".format(batch_id, self.history.path))
+
+        with self.stats.timer("filter"):
+            users = SpamManager.filter_as(self.users, filter, self.groups())
+
+        keys = sorted(self.parameters["relative_paths"].keys())
+        batches = {key: "restore:{}".format(batch_id) for key in keys}
+        contents = [(key, [("Restaurar", [batch_id])]) for key in keys]
+
+        return self.dispatch(users, lambda user, keys: self.restore_user(user, keys, sequence), jobs, batches, contents)
+
+    """
+    Permite deshacer en las listas de un usuario las diferencias registradas desde un lote y retorna el resumen de
+    los cambios. Solo se reescriben las listas que cambian.
+    Parametros:
+        - user: El usuario cuyas listas seran restauradas.
+        - keys: Los tipos de lista que se deben restaurar.
+        - sequence: El numero de secuencia del lote (ver ChangeHistory.find).
+    """
+    def restore_user(self, user, keys, sequence):
+        paths = {key: self.list_path(user, key) for key in keys}
+        restored_domains = {key: [] for key in paths.keys()}
+        withdrawn_domains = {key: [] for key in paths.keys()}
+        counters = {"rewritten": 0, "skipped": 0}
+
+        with self.stats.timer("read"):
+            changes = self.history.changes(user, sequence)
+
+        for key, path in paths.items():
+            deltas = [(removed, added) for name, removed, added in changes if name == key]
+
+            if len(deltas) == 0:
+                counters["skipped"] += 1
+                continue
+
+            domains = self.read_list(path)[0] if exists(path) else []
+            lines = domains
+
+            with self.stats.timer("match"):
+                for removed, added in deltas:
+                    pending = Counter(added)
+                    kept = []
+
+                    for domain in reversed(lines):
+                        if pending[domain] > 0:
+                            pending[domain] -= 1
+                        else:
+                            kept.append(domain)
+
+                    lines = kept[::-1] + removed
+
+            if lines == domains:
+                counters["skipped"] += 1
+                continue
+
+            withdrawn_domains[key] = list((Counter(domains) - Counter(lines)).elements())
+            restored_domains[key] = list((Counter(lines) - Counter(domains)).elements())
+            temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(path))
+
+            with self.stats.timer("write"), fdopen(temporal_file, 'w') as new_file:
+                new_file.write(''.join("{}\n".format(domain) for domain in lines))
+
+            self.replace_list(path, absolute_temporal_file_path)
+            self.note(user, key, withdrawn_domains[key], restored_domains[key])
+            counters["rewritten"] += 1
+
+        details = [(key, [("Restaurados", restored_domains[key]), ("Quitados", withdrawn_domains[key])]) for key in paths.keys()]
+
+        return details, counters
+
+    """
+    Permite construir el resumen de los cambios de un usuario (o de los dominios de un lote). El detalle es una
+    lista de pares con el tipo de lista y los pares de etiqueta y dominios, por ejemplo:
+        [("whitelist", [("Agregados", [...]), ("Repetidos", [...])])]
+    El resumen completo incluye todos los dominios, uno por etiqueta y lista; el compacto ocupa una sola linea con
+    la cantidad de dominios de cada etiqueta y el identificador del lote, cuyos dominios quedan en el log.
+    Parametros:
+        - title: El titulo del resumen, ya sea "Usuario" o "Lote".
+        - name: El usuario o el identificador del lote.
+        - details: El detalle de los cambios.
+        - verbose: Indica si el resumen debe incluir todos los dominios.
+        - batch_id: El identificador del lote, que se incluye en el resumen compacto.
+    """
+    @staticmethod
+    def summarize(title, name, details, verbose, batch_id = None):
+        if verbose:
+            summary = "{}: {}\n".format(title, name)
+
+            for key, entries in details:
+                summary += "\tLista: {}\n".format(key)
+
+                for label, domains in entries:
+                    summary += "\t\t{}: {}\n".format(label, domains)
+
+            return summary
+
+        lists = '; '.join("{}: ".format(key) + ', '.join("{} {}".format(label, len(domains)) for label, domains in entries) for key, entries in details)
+
+        return "{}: {}, Lote: {}, {}".format(title, name, batch_id, lists)
+
+    """
+    Permite aplicar una tarea a cada usuario, ya sea uno tras otro o repartiendo los usuarios entre varios hilos.
+    Los dominios del lote se registran una sola vez en el log, bajo un identificador de lote, y luego se registra
+    el resumen de cada usuario en orden alfabetico, sin importar cual hilo termine primero (ver summarize); los
+    usuarios que comparten listas se registran a continuacion del primero de su grupo.
+    Si la tarea falla para un usuario, el error se guarda y se continua con el resto; al final se registran los
+    contadores acumulados, todos los errores y se lanza una excepcion.
+    Cuando hay un manifiesto activo, a cada usuario solo se le actualizan las listas cuyo estado no refleja aun el
+    lote, y los usuarios que ya estan al dia se omiten por completo. Si el indice de dominios esta activo, se
+    vuelven a indexar las listas que cambiaron; si el almacen de listas esta activo, sus cambios se guardan al final.
+    Con las listas compartidas activas (`shared`), la tarea solo se aplica al primer usuario de cada grupo de
+    listas identicas y el resultado se copia al resto del grupo (ver group y propagate).
+    Con el registro de lotes activo, las listas de cada usuario quedan pendientes y se registran al terminar el
+    usuario, o se descartan si fallo; las de todos los usuarios se reemplazan al final, antes de guardar el
+    manifiesto, el indice y el almacen (ver BatchJournal). Del mismo modo, con el historial de cambios activo las
+    diferencias de cada usuario se guardan al terminar el usuario y se confirman al final (ver ChangeHistory).
+    Con `resume` y sin el registro de lotes, se omiten los usuarios que ya terminaron el mismo lote en una ejecucion
+    anterior y cada usuario terminado se anota en el punto de control (ver Checkpoint). Si `progress` indica
+    una salida, en ella se muestra el avance (ver ProgressLine).
+    Parametros:
+        - users: La lista de usuarios a procesar.
+        - task: Una funcion que recibe un usuario y los tipos de lista a actualizar, y retorna el detalle de los
+        cambios realizados (ver summarize) junto con un diccionario de contadores, cuyas llaves deben estar en
+        `counter_labels`.
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+        - batches: Un diccionario con la huella del lote para cada tipo de lista.
+        - contents: Los dominios del lote, con el mismo formato del detalle de cada usuario.
+    """
+    def dispatch(self, users, task, jobs, batches, contents):
+        users = sorted(users)
+        batch_id = sha1('\n'.join("{}={}".format(key, batch) for key, batch in sorted(batches.items()))).hexdigest()[:12]
+        summaries = []
+        failures = []
+        totals = Counter()
+        pool = None
+        checkpoint = None
+        resumed = set()
+
+        if self.journal is None and self.resume:
+            checkpoint = Checkpoint(self.parameters["checkpoint_path"])
+
+            done = checkpoint.load(batch_id)
+
+            if done is None:
+                self.log_and_print("Lote: {}, No hay un punto de control de este lote; se procesan todos los usuarios".format(batch_id), "warning")
+            else:
+                resumed = done.intersection(users)
+
+            checkpoint.begin(batch_id, sorted(resumed))
+
+        pending = [user for user in users if user not in resumed]
+        groups = {user: ([], None) for user in pending}
+
+        def attempt(user):
+            started = perf_counter()
+            members, signature = groups[user]
+
+            try:
+                report = self.track(user, task, batches)
+                results = [(user, report, None)] + [(member, report if error is None else None, error) for member, error in self.propagate(user, members, signature)]
+            except Exception as error:
+                results = [(user, None, error)] + [(member, None, error) for member in members]
+            finally:
+                self.stats.record_user(user, perf_counter() - started)
+
+            if self.journal is not None:
+                try:
+                    self.journal.stage_user(user, results[0][2] is not None)
+                except Exception as error:
+                    results = [(name, None, error) for name, report, previous in results]
+
+            if self.history is not None:
+                if results[0][2] is None:
+                    self.history.store(user, [member for member, report, error in results[1:] if error is None])
+                else:
+                    self.history.discard(user)
+
+            return [(name, report, error or self.refresh(name, batches.keys())) for name, report, error in results]
+
+        if self.journal is not None:
+            self.journal.begin(batch_id, len(users))
+
+        if self.history is not None:
+            self.history.begin(batch_id, ','.join(sorted({batch.split(':')[0] for batch in batches.values()})))
+
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+
+        if self.shared:
+            groups = self.group(pending, list(batches.keys()), pool)
+
+        if pool is not None:
+            results = pool.imap(attempt, sorted(groups.keys()))
+        else:
+            results = (attempt(user) for user in sorted(groups.keys()))
+
+        self.log(SpamManager.summarize("Lote", batch_id, contents, True), "info")
+        self.log_and_print("Lote: {}, Usuarios: {}".format(batch_id, len(users)) + (", Listas distintas: {}".format(len(groups)) if self.shared else "") + (", Retomados: {}".format(len(resumed)) if self.resume else ""), "info")
+        progress = ProgressLine(self.progress, len(pending)) if self.progress is not None else None
+
+        for done, (user, report, error) in enumerate((result for group in results for result in group), 1):
+            if error is None:
+                details, counters = report
+                totals.update(counters)
+
+                if details is not None:
+                    summaries.append(SpamManager.summarize("Usuario", user, details, self.verbose, batch_id))
+                    self.log_and_print(summaries[-1], "info")
+
+                if checkpoint is not None:
+                    checkpoint.done(user)
+            else:
+                failures.append((user, error))
+
+            if progress is not None:
+                progress.update(done)
+
+        if progress is not None:
+            progress.update(len(pending), True)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if checkpoint is not None:
+            checkpoint.close(len(failures) == 0)
+
+        for key, value in totals.items():
+            self.stats.count(key, value)
+
+        self.stats.count("users", len(users))
+        self.stats.count("resumed_users", len(resumed))
+        self.stats.count("failed_users", len(failures))
+
+        if len(failures) != 0:
+            self.stats.success = False
+
+        if self.journal is not None:
+            with self.stats.timer("rename"):
+                self.stats.count("journaled_lists", self.journal.commit())
+
+        if self.manifest is not None and self.manifest.dirty:
+            self.manifest.save()
+
+        if self.domain_index is not None:
+            self.domain_index.commit()
+
+        if self.store is not None:
+            self.store.commit()
+
+        if self.history is not None:
+            self.history.commit()
+
+        if len(totals) != 0:
+            self.log_and_print(', '.join("{}: {}".format(label, totals[key]) for key, label in SpamManager.counter_labels if key in totals), "info")
+
+        for user, error in failures:
+            self.log_and_print("Usuario: {}\n\tError: {}\n".format(user, error), "error")
+
+        if len(failures) != 0:
+            raise Exception("No se pudo actualizar {} de {} usuarios: {}. Revise el log para mas detalles.".format(len(failures), len(users), [user for user, error in failures]))
+
+        return summaries
+
+    """
+    Permite agrupar a los usuarios cuyas listas tienen exactamente el mismo contenido, comparando el hash de cada
+    lista. Retorna un diccionario que asocia el primer usuario de cada grupo, en orden alfabetico, con el resto de
+    los usuarios del grupo y los hashes de sus listas. Los usuarios cuyas listas no se pueden leer quedan solos,
+    para que el error se informe al procesarlos.
+    Parametros:
+        - users: Los usuarios a agrupar, en orden alfabetico.
+        - keys: Los tipos de lista que se comparan.
+        - pool: El ThreadPool con que se calculan los hashes, o None para calcularlos uno tras otro.
+    """
+    def group(self, users, keys, pool = None):
+        def signature(user):
+            digests = []
+
+            try:
+                for key in keys:
+                    path = self.list_path(user, key)
+
+                    with self.io(stat(path).st_size):
+                        digests.append(StateManifest.digest(path))
+            except (IOError, OSError):
+                return None
+
+            return tuple(digests)
+
+        with self.stats.timer("read"):
+            signatures = pool.map(signature, users) if pool is not None else [signature(user) for user in users]
+
+        groups = {}
+        result = {}
+
+        for user, digests in zip(users, signatures):
+            if digests is None:
+                result[user] = ([], None)
+            elif digests in groups:
+                result[groups[digests]][0].append(user)
+            else:
+                groups[digests] = user
+                result[user] = ([], dict(zip(keys, digests)))
+
+        self.stats.count("distinct_lists", len(result))
+
+        return result
+
+    """
+    Permite copiar las listas de un usuario, ya procesadas, a los usuarios que compartian su contenido. Solo se
+    copian las listas que cambiaron, y cada copia reemplaza la lista del usuario mediante un renombre atomico. Si
+    el manifiesto esta activo, cada usuario hereda el registro de la lista copiada. Retorna, para cada usuario,
+    el error ocurrido al copiar sus listas o None.
+    Parametros:
+        - user: El usuario cuyas listas ya fueron procesadas.
+        - members: Los usuarios que compartian el contenido de sus listas.
+        - signature: Un diccionario con el hash que tenia cada lista antes de procesarla.
+    """
+    def propagate(self, user, members, signature):
+        errors = {member: None for member in members}
+
+        for key, digest in sorted((signature or {}).items()):
+            path = self.resolve(self.list_path(user, key))
+
+            try:
+                with self.io(stat(path).st_size), self.stats.timer("read"), open(path, 'rb') as file:
+                    content = file.read()
+            except (IOError, OSError) as error:
+                errors = {member: errors[member] or error for member in members}
+                break
+
+            changed = sha1(content).hexdigest() != digest
+
+            for member in members:
+                if errors[member] is not None:
+                    continue
+
+                try:
+                    target = self.list_path(member, key)
+
+                    if changed:
+                        temporal_file, absolute_temporal_file_path = mkstemp(prefix='.', dir=dirname(target))
+
+                        with self.stats.timer("write"), fdopen(temporal_file, 'wb') as new_file:
+                            new_file.write(content)
+
+                        self.replace_list(target, absolute_temporal_file_path)
+                        self.stats.count("shared_copies")
+
+                    if self.manifest is not None:
+                        self.manifest.mirror(user, member, key, path, self.resolve(target))
+                except Exception as error:
+                    errors[member] = error
+
+        return [(member, errors[member]) for member in members]
+
+    """
+    Permite aplicar una tarea a un usuario considerando el manifiesto, si esta activo: se omiten las listas que ya
+    reflejan el lote y, luego de la tarea, se registra el nuevo estado de las listas actualizadas.
+    Parametros:
+        - user: El usuario a procesar.
+        - task: La tarea que recibe el usuario y los tipos de lista a actualizar.
+        - batches: Un diccionario con la huella del lote para cada tipo de lista.
+    """
+    def track(self, user, task, batches):
+        if not self.incremental:
+            return task(user, list(batches.keys()))
+
+        keys = [key for key, batch in batches.items() if not self.manifest.current(user, key, self.list_path(user, key), batch)]
+
+        if len(keys) == 0:
+            return None, {"current": 1}
+
+        report = task(user, keys)
+
+        for key in keys:
+            self.manifest.record(user, key, self.resolve(self.list_path(user, key)), batches[key])
+
+        return report
+
+class DirectoryWatcher:
+    """
+    Permite esperar cambios en una carpeta. En Linux usa inotify a traves de la libreria de C; si no esta
+    disponible, simplemente espera el intervalo indicado para que la carpeta se vuelva a revisar.
+    Parametros:
+        - path: La ruta de la carpeta a observar.
+    """
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+
+    def __init__(self, path):
+        self.descriptor = None
+
+        try:
+            libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+            descriptor = libc.inotify_init()
+            mask = DirectoryWatcher.IN_MODIFY | DirectoryWatcher.IN_CLOSE_WRITE | DirectoryWatcher.IN_MOVED_TO | DirectoryWatcher.IN_CREATE
+
+            if descriptor >= 0 and libc.inotify_add_watch(descriptor, path, mask) >= 0:
+                self.descriptor = descriptor
+        except (OSError, AttributeError):
+            self.descriptor = None
+
+    """
+    Permite bloquear hasta que haya un cambio en la carpeta o pase el tiempo indicado, lo que ocurra primero.
+    Parametros:
+        - timeout: La cantidad maxima de segundos a esperar.
+    """
+    def wait(self, timeout):
+        if self.descriptor is None:
+            sleep(timeout)
+            return
+
+        try:
+            ready = select([self.descriptor], [], [], timeout)[0]
+        except select_error:
+            return
+
+        if len(ready) != 0:
+            os_read(self.descriptor, 1 << 16)
+
+    def close(self):
+        if self.descriptor is not None:
+            close(self.descriptor)
+
+class SpamDaemon:
+    """
+    Proceso de larga duracion que mantiene en memoria los usuarios y sus listas, y aplica lotes a medida que
+    llegan, evitando pagar el inicio del programa y la lectura de todas las listas en cada ejecucion. Los lotes
+    llegan de dos formas:
+        - Como subcarpetas de la carpeta observada, con los mismos archivos que usa el parametro auto. Una vez
+        aplicada, cada subcarpeta se marca con un archivo `.aplicado` (o `.fallido` con el error) para no volver
+        a aplicarla, incluso si el proceso se reinicia.
+        - Como solicitudes a traves de un socket UNIX: una linea JSON con las llaves "action", "whitelist",
+        "blacklist", "allow" y "deny" (las listas como arreglos de lineas), a la que se responde con una linea JSON
+        con las llaves "ok", "summaries" y "error".
+    Los lotes se aplican de a uno a la vez, sin importar su origen.
+    Parametros:
+        - manager: El SpamManager que aplica los lotes.
+        - folder: La carpeta observada.
+        - action: La accion que se aplica a los lotes de la carpeta, ya sea "add", "remove" o "patch".
+        - jobs: La cantidad de hilos que procesan usuarios en paralelo.
+    """
+    markers = [".aplicado", ".fallido"]
+    settle_seconds = 1
+
+    def __init__(self, manager, folder, action, jobs = 1):
+        self.manager = manager
+        self.folder = folder if folder[-1] == "/" else "{}/".format(folder)
+        self.action = action
+        self.jobs = jobs
+        self.lock = Lock()
+        self.running = False
+        self.roster_mtime = stat(manager.parameters["source_path"]).st_mtime
+        self.manager.use_index()
+
+    """
+    Permite volver a listar los usuarios solo si la carpeta de origen cambio desde la ultima vez.
+    """
+    def refresh_users(self):
+        mtime = stat(self.manager.parameters["source_path"]).st_mtime
+
+        if mtime != self.roster_mtime:
+            self.manager.discover()
+            self.roster_mtime = mtime
+
+    """
+    Permite obtener, en orden alfabetico, las subcarpetas que aun no se aplican y que no han cambiado durante
+    los ultimos `settle_seconds` segundos, para no aplicar un lote que todavia se esta copiando. Tambien retorna
+    si quedan subcarpetas esperando a que se cumpla ese plazo.
+    """
+    def pending(self):
+        result = []
+        waiting = False
+
+        for name in sorted(listdir(self.folder)):
+            path = "{}{}".format(self.folder, name)
+
+            if not isdir(path) or any(exists("{}/{}".format(path, marker)) for marker in SpamDaemon.markers):
+                continue
+
+            mtimes = [stat(path).st_mtime] + [stat("{}/{}".format(path, child)).st_mtime for child in listdir(path)]
+
+            if time() - max(mtimes) >= SpamDaemon.settle_seconds:
+                result.append(name)
+            else:
+                waiting = True
+
+        return result, waiting
+
+    """
+    Permite aplicar los lotes de una subcarpeta y marcarla como aplicada o fallida.
+    Parametros:
+        - name: El nombre de la subcarpeta.
+    """
+    def apply_folder(self, name):
+        path = "{}{}".format(self.folder, name)
+        marker, content = ".aplicado", ""
+
+        try:
+            list_filenames, filter_filenames = SpamManager.batch_filenames(path)
+            if len(list_filenames) == 0:
+                raise Exception("El lote debe contener como minimo una de las listas whitelist y blacklist.")
+
+            lists, filters = SpamManager.load_batch(list_filenames, filter_filenames, self.action == "patch")
+
+            with self.lock:
+                self.refresh_users()
+                self.manager.apply(self.action, lists, filters, self.jobs)
+        except Exception as error:
+            marker, content = ".fallido", "{}\n".format(error)
+            self.manager.log_and_print("Lote: {}\n\tError: {}\n".format(path, error), "error")
+
+        with open("{}/{}".format(path, marker), 'w') as file:
+            file.write(content)
+
+    """
+    Permite atender una solicitud recibida por el socket y retorna la respuesta.
+    Parametros:
+        - request: El diccionario con la solicitud.
+    """
+    def handle(self, request):
+        action = request.get("action", "")
+        lines = {key: [str(line).strip() for line in request[key] if str(line).strip() != ''] for key in ["whitelist", "blacklist", "allow", "deny"] if key in request}
+        lists = {key: value for key, value in lines.items() if key in ["whitelist", "blacklist"]}
+        filters = {key: value for key, value in lines.items() if key in ["allow", "deny"]}
+
+        if len(lists) == 0:
+            raise Exception("La solicitud debe indicar como minimo una de las listas whitelist y blacklist.")
+
+        if action == "patch":
+            lists = {key: SpamManager.split_patch(value, key) for key, value in lists.items()}
+
+        with self.lock:
+            self.refresh_users()
+            return self.manager.apply(action, lists, filters, int(request.get("jobs", self.jobs)))
+
+    """
+    Permite atender las conexiones del socket UNIX, una a la vez, hasta que el proceso se detenga.
+    Parametros:
+        - server: El socket ya enlazado y escuchando.
+    """
+    def serve(self, server):
+        while self.running:
+            try:
+                connection = server.accept()[0]
+            except socket.error:
+                continue
+
+            with closing(connection):
+                stream = connection.makefile('rw')
+
+                try:
+                    response = {"ok": True, "summaries": self.handle(json.loads(stream.readline())), "error": None}
+                except Exception as error:
+                    response = {"ok": False, "summaries": [], "error": str(error)}
+
+                stream.write(json.dumps(response) + "\n")
+                stream.flush()
+
+    """
+    Permite detener el ciclo principal y el socket al recibir una señal de termino.
+    """
+    def stop(self, *args):
+        self.running = False
+
+    """
+    Permite ejecutar el proceso: abre el socket, aplica los lotes pendientes y luego espera nuevos lotes hasta
+    recibir SIGINT o SIGTERM.
+    """
+    def run(self):
+        socket_path = self.manager.parameters["socket_path"]
+        interval = self.manager.parameters["daemon_interval"]
+        watcher = DirectoryWatcher(self.folder)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        if exists(socket_path):
+            remove(socket_path)
+
+        server.bind(socket_path)
+        server.listen(8)
+        server.settimeout(1)
+
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        listener = Thread(target=self.serve, args=(server,))
+        listener.daemon = True
+        listener.start()
+
+        self.manager.log_and_print("Observando {} y escuchando en {}.".format(self.folder, socket_path), "info")
+
+        try:
+            while self.running:
+                names, waiting = self.pending()
+
+                for name in names:
+                    self.apply_folder(name)
+
+                watcher.wait(SpamDaemon.settle_seconds if waiting else interval)
+        finally:
+            self.running = False
+            listener.join()
+            server.close()
+            watcher.close()
+            remove(socket_path)
+
+"""
+Se definen todos los parametros para ser ejectuado el script en consola: add, remove, whitelist, blacklist, allow y deny.
+    - add: Es un booleano que indica si la accion principal es agregar dominios a la lista negra y/o blanca.
+    remove: Es un booleano que indica si la accion principal es eliminar dominios de la lista negra y/o blanca.
+    - patch: Es un booleano que indica si la accion principal es agregar y eliminar dominios en una sola pasada. En
+    este caso las listas whitelist y blacklist siguen el formato:
+        +dominio_a_agregar
+        -dominio_a_eliminar
+        ...
+    whitelist: Ruta del archivo que contiene todos los dominios a agregar. Siguen el formato:
+        *@dominio1
+        *@dominio2
+        ...
+        dominiok
+        dominiok+1
+        ...
+    - blacklist: Ruta del archivo que contiene todos los dominios a agregar. Sigue el formato:
+        *@dominio1
+        *@dominio2
+        ...
+        dominiok
+        dominiok+1
+        ...
+    - allow: Ruta del archivo que contiene todos los usuarios que seran afectados por los cambios. Sigue el formato:
+        usuario1
+        usuario2
+        ...
+    - deny: Ruta del archivo que contiene todos los usuarios que NO seran afectados por los cambios. Sigue el formato:
+        usuario1
+        usuario2
+        ...
+    - compact: Es un booleano que indica si la accion principal es compactar las listas de los usuarios: ordenarlas,
+    eliminar duplicados y lineas vacias, y escribir sus entradas en forma canonica.
+    - daemon: Es un booleano que indica si el programa debe quedar en ejecucion observando la carpeta indicada en auto,
+    aplicando cada subcarpeta nueva como un lote y atendiendo los lotes enviados por el socket UNIX.
+    Note que no esta permitido tener mas de uno de los flags add, remove, patch y compact activos al mismo tiempo.
+La funcion main recibe los argumentos de la consola, o una lista con ellos si se llama desde otro programa.
+"""
+class TenantPool:
+    """
+    Permite aplicar una misma accion sobre cada uno de los dominios de source_path (ver ParameterManager.expand),
+    repartiendolos entre varios procesos. Cada dominio se procesa con su propia configuracion (ver
+    ParameterManager.tenant) y los dominios con mas buzones se entregan primero, para que los procesos terminen
+    a la par. Los limites de entrada y salida se reparten entre los procesos (ver IOThrottle.share). Al final se
+    registra el resumen de cada dominio y el total.
+    Parametros:
+        - manager: El SpamManager con la configuracion completa, donde se registra el resumen.
+        - processes: La cantidad de procesos que atienden dominios en paralelo.
+    """
+    def __init__(self, manager, processes = 1):
+        self.manager = manager
+        self.processes = processes
+
+    """
+    Permite estimar la cantidad de buzones de un dominio, a partir de la lista de usuarios guardada si esta al dia
+    (ver RosterCache) o de la cantidad de entradas de su carpeta.
+    Parametros:
+        - parameters: La configuracion del dominio.
+    """
+    @staticmethod
+    def weight(parameters):
+        source_path = parameters["source_path"]
+        roster = RosterCache(parameters["roster_path"]).load(source_path, parameters["relative_paths"], stat(source_path).st_mtime)
+
+        if roster is not None:
+            return len(roster["users"])
+
+        return len(listdir(source_path))
+
+    """
+    Permite aplicar la accion sobre todos los dominios y retorna el resumen de cada uno.
+    Parametros:
+        - action: La accion, ya sea "add", "remove", "patch", "compact", "recover" o una de mantenimiento ("index",
+        "import", "verify" o "materialize").
+        - list_filenames, filter_filenames: Las rutas de las listas y filtros del lote (ver load_batch).
+        - patch: Indica si las listas del lote son parches.
+        - jobs: La cantidad de hilos con que se procesa cada dominio.
+        - options: Las opciones de cada SpamManager (ver configure).
+    """
+    def run(self, action, list_filenames, filter_filenames, patch, jobs, options):
+        parameters = self.manager.parameters
+        tasks = []
+
+        with self.manager.stats.timer("discovery"):
+            for name in sorted(parameters["tenants"].keys()):
+                tenant = IOThrottle.share(ParameterManager.tenant(parameters, name), min(self.processes, len(parameters["tenants"])))
+                tasks.append((TenantPool.weight(tenant), (name, tenant, action, list_filenames, filter_filenames, patch, jobs, options)))
+
+        tasks = [task for weight, task in sorted(tasks, key=lambda item: -item[0])]
+        pool = None
+
+        if self.processes > 1:
+            pool = Pool(min(self.processes, len(tasks)))
+            results = pool.imap_unordered(run_tenant, tasks)
+        else:
+            results = (run_tenant(task) for task in tasks)
+
+        reports = {}
+
+        for name, report, error in results:
+            reports[name] = (report, error)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        failures = []
+        totals = Counter()
+
+        for name in sorted(reports.keys()):
+            report, error = reports[name]
+            counters = report["counters"]
+            self.manager.stats.merge(name, report)
+            totals.update(counters)
+            self.manager.log_and_print("Dominio: {}, Usuarios: {}, ".format(name, counters.get('users', 0)) + ', '.join("{}: {}".format(label, counters.get(key, 0)) for key, label in SpamManager.counter_labels) + ", Errores: {}".format(counters.get('failed_users', 0)), "info")
+
+            if error is not None:
+                failures.append((name, error))
+
+        self.manager.log_and_print("Dominios: {}, Usuarios: {}, ".format(len(reports), totals['users']) + ', '.join("{}: {}".format(label, totals[key]) for key, label in SpamManager.counter_labels) + ", Errores: {}".format(totals['failed_users']), "info")
+
+        for name, error in failures:
+            self.manager.log_and_print("Dominio: {}\n\tError: {}\n".format(name, error), "error")
+
+        if len(failures) != 0:
+            self.manager.stats.success = False
+            raise Exception("No se pudo completar {} de {} dominios: {}. Revise el log de cada dominio para mas detalles.".format(len(failures), len(reports), [name for name, error in failures]))
+
+        return reports
+
+"""
+Permite aplicar una accion sobre un dominio (ver TenantPool). Es una funcion y no un metodo para que los procesos
+de multiprocessing puedan recibirla tambien en python2. Retorna el nombre del dominio, el resumen de su ejecucion
+(ver RunStats.report) y el mensaje de error, o None si termino sin errores.
+Parametros:
+    - task: Una tupla con el nombre del dominio, su configuracion, la accion, las rutas de las listas y filtros del
+    lote, si las listas son parches, la cantidad de hilos y las opciones de SpamManager.configure.
+"""
+def run_tenant(task):
+    name, parameters, action, list_filenames, filter_filenames, patch, jobs, options = task
+    manager = SpamManager()
+    manager.loaded_parameters = parameters
+    manager.echo = False
+    error = None
+
+    try:
+        manager.configure(**options)
+
+        if action == "recover":
+            manager.recover()
+        elif action in SpamManager.maintenance:
+            getattr(manager, SpamManager.maintenance[action])(jobs)
+        else:
+            lists, filters = SpamManager.load_batch(list_filenames, filter_filenames, patch)
+            manager.apply(action, lists, filters, jobs)
+    except Exception as exception:
+        manager.stats.success = False
+        error = str(exception)
+    finally:
+        SpamManager.flush()
+
+    return name, manager.stats.report(), error
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--add",
+                        help="Permite agregar dominios a la lista blanca y/o negra.",
+                        action="store_true")
+    parser.add_argument("--remove",
+                        help="Permite eliminar dominios de la lista blanca y/o negra",
+                        action="store_true")
+    parser.add_argument("--patch",
+                        help="Permite agregar y eliminar dominios de la lista blanca y/o negra en una sola pasada. Las listas indicadas deben tener en cada linea '+dominio' para agregarlo o '-dominio' para eliminarlo.",
+                        action="store_true")
+    parser.add_argument("--reconcile",
+                        help="Permite llevar la lista blanca y/o negra de los usuarios al estado indicado: las listas indicadas no son dominios a agregar o eliminar sino todas las entradas que debe tener cada lista. Solo se reescriben las listas que difieren, eliminando las entradas sobrantes y repetidas y agregando al final las que faltan.",
+                        action="store_true")
+    parser.add_argument("--compact",
+                        help="Permite reescribir las listas de los usuarios ordenadas, sin duplicados, sin lineas vacias y con las entradas en forma canonica ('dominio' como '*@dominio', en minusculas). Solo admite los filtros allow y deny.",
+                        action="store_true")
+    parser.add_argument("--index",
+                        help="Permite construir o poner al dia el indice de dominios, que registra que usuarios tienen cada entrada en su lista blanca y negra. Solo se leen las listas que cambiaron desde la ultima vez.",
+                        action="store_true")
+    parser.add_argument("--import",
+                        dest="import_store",
+                        help="Permite importar al almacen de listas la lista blanca y negra de todos los usuarios. Solo se leen las listas que cambiaron desde la ultima vez que se importaron o escribieron.",
+                        action="store_true")
+    parser.add_argument("--verify",
+                        help="Permite comparar la lista blanca y negra de todos los usuarios con el almacen de listas, indicando las listas que difieren, sin modificar ninguna.",
+                        action="store_true")
+    parser.add_argument("--materialize",
+                        help="Permite escribir la lista blanca y negra de todos los usuarios a partir del almacen de listas. Solo se reescriben las listas cuyas entradas difieren de las del almacen.",
+                        action="store_true")
+    parser.add_argument("--recover",
+                        help="Permite completar o deshacer el lote que quedo interrumpido con journal: si alcanzo a confirmarse se reemplazan las listas que faltaban, y si no, se descartan todas sus listas pendientes.",
+                        action="store_true")
+    parser.add_argument("--audit",
+                        help="Permite revisar la lista blanca y negra de todos los usuarios en busca de entradas repetidas, invalidas o en ambas listas, listas sin salto de linea final y listas distintas de la mayoria. Recibe la ruta del archivo donde se escriben los hallazgos en formato JSON, una linea por lista, o '-' (por defecto) para la salida estandar.",
+                        nargs="?",
+                        const="-",
+                        default="")
+    parser.add_argument("--fix",
+                        help="Permite que audit reescriba las listas con entradas repetidas o invalidas, o sin salto de linea final, sin ellas. Las entradas en ambas listas y las diferencias con la mayoria solo se informan.",
+                        action="store_true")
+    parser.add_argument("--restore",
+                        type=str,
+                        default="",
+                        metavar="BATCH_ID",
+                        help="Permite devolver la lista blanca y negra de los usuarios al estado que tenian antes del lote indicado, tal como aparece en el log, deshaciendo todos los lotes aplicados desde entonces. Requiere el historial de cambios (history) y solo admite los filtros allow y deny.")
+    parser.add_argument("--query",
+                        type=str,
+                        default="",
+                        help="Permite consultar en el indice de dominios que usuarios tienen la entrada indicada ('dominio', '*@dominio' o 'usuario@dominio') en su lista blanca y negra. Con subdomains tambien se muestran los usuarios que tienen una entrada mas amplia que la cubre.")
+    parser.add_argument("--check",
+                        help="Permite revisar si direcciones de correo coinciden con la lista blanca o negra de su destinatario. Recibe la ruta de un archivo con el usuario y la direccion separados por espacios en cada linea, o '-' (por defecto) para leerlos de la entrada estandar. Con subdomains, '*@dominio' cubre tambien a los subdominios.",
+                        nargs="?",
+                        const="-",
+                        default="")
+    parser.add_argument("--whitelist",
+                        default="",
+                        type=str,
+                        help="La ruta absoluta o relativa del archivo que contiene todos los dominios que se desean agregar a la lista blanca. Estos deben estar separados por un un salto de linea y pueden ser de la forma '*@dominio', o bien, 'dominio' (sin comillas).")
+    parser.add_argument("--blacklist",
+                        default="",
+                        type=str,
+                        help="La ruta absoluta o relativa del archivo que contiene todos los dominios que se desean agregar a la lista negra. Estos deben estar separados por un un salto de linea y pueden ser de la forma '*@dominio', o bien, 'dominio' (sin comillas).")
+    parser.add_argument("--allow",
+                        type=str,
+                        default="",
+                        help="La ruta absoluta o relativa del archivo que contiene todos los usuarios a los que se desea aplicar estos nuevos dominios. Todos estos deben estar separados por un salto de linea.")
+    parser.add_argument("--deny",
+                        type=str,
+                        default="",
+                        help="La ruta absoluta o relativa del archivo que contiene todos los usuarios a los que no se desea aplicar estos nuevos dominios. Todos estos deben estar separados por un salto de linea.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="La cantidad de usuarios que se procesan en paralelo. Por defecto se procesa un usuario a la vez.")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=1,
+                        help="La cantidad de dominios que se procesan en paralelo, cada uno en su propio proceso, cuando source_path indica varias carpetas de usuarios. Por defecto se procesa un dominio a la vez.")
+    parser.add_argument("--subdomains",
+                        help="Permite considerar la jerarquia de dominios: al agregar se omiten las entradas ya cubiertas por una mas amplia (por ejemplo, 'jose@example.com' o '*@mail.example.com' si existe '*@example.com'), y al eliminar un dominio se eliminan tambien todas las entradas que caen bajo el.",
+                        action="store_true")
+    parser.add_argument("--store",
+                        help="Permite agregar y eliminar dominios a traves del almacen de listas, previamente creado con import: las coincidencias con el lote se consultan en el almacen y solo se escriben las listas que cambian.",
+                        action="store_true")
+    parser.add_argument("--journal",
+                        help="Permite aplicar cada lote de forma atomica: las listas nuevas se escriben en archivos temporales, se anotan en un registro y se reemplazan todas recien al final del lote. Si la ejecucion se interrumpe, el lote se completa o deshace con recover.",
+                        action="store_true")
+    parser.add_argument("--history",
+                        help="Permite registrar en el historial de cambios las entradas que cada lote agrega y elimina de las listas, para luego deshacerlo con restore. Una vez creado, el historial se usa aunque no se indique el parametro.",
+                        action="store_true")
+    parser.add_argument("--resume",
+                        help="Permite retomar un lote interrumpido: se omiten los usuarios que, segun el punto de control, ya terminaron el mismo lote. No tiene efecto junto con journal, que completa o deshace el lote con recover.",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        help="Permite omitir las listas que, segun el manifiesto de estado, ya reflejan el lote indicado. Las listas modificadas por fuera del programa se vuelven a revisar.",
+                        action="store_true")
+    parser.add_argument("--shared",
+                        help="Permite procesar una sola vez las listas que tienen exactamente el mismo contenido en varios usuarios: se aplica el lote al primero de ellos y el resultado se copia a los demas.",
+                        action="store_true")
+    parser.add_argument("--daemon",
+                        help="Permite mantener el programa en ejecucion observando la carpeta indicada en auto: cada subcarpeta nueva se aplica como un lote con la accion indicada (add, remove, patch o reconcile). Tambien se atienden lotes enviados por el socket UNIX indicado en la configuracion.",
+                        action="store_true")
+    parser.add_argument("--progress",
+                        help="Permite mostrar en la salida de errores el avance de la ejecucion: los usuarios terminados, los usuarios por segundo y el tiempo restante estimado.",
+                        action="store_true")
+    parser.add_argument("--verbose",
+                        help="Permite mostrar y registrar, para cada usuario, todos los dominios agregados, repetidos y eliminados en lugar de solo su cantidad.",
+                        action="store_true")
+    parser.add_argument("--stats",
+                        help="Permite obtener un resumen con el tiempo de cada fase, los bytes leidos y escritos, los archivos modificados y omitidos y los usuarios mas lentos. Recibe la ruta del archivo donde se escribe, o '-' (por defecto) para la salida estandar.",
+                        nargs="?",
+                        const="-",
+                        default="")
+    parser.add_argument("--stats-format",
+                        help="Permite indicar el formato del resumen de stats: json (por defecto) o prometheus, para el colector de archivos de texto de node_exporter.",
+                        choices=["json", "prometheus"],
+                        default="json")
+    parser.add_argument("--auto",
+                        type=str,
+                        default="",
+                        help="Permite asociar automÃ¡ticamente la lista blanca, negra, los usuarios denegados y/o permitidos y ejecutar la actualizaciÃ³n de dominios. Como parÃ¡metro debe ser una una ruta relativa o absoluta de la carpeta que tenga todos los archivos anteriormente mencionados. Estos deben llamarse estrictamente whitelist, blacklist, deny y allow.")
+
+    args = parser.parse_args(arguments)
+
+    """
+    Se elige la accion de acuerdo al parametro provisto en la consola. En caso de que uno de los archivos no exista,
+    se genera una excepcion y no se realiza nada.
+    """
+    try:
+        actions = [name for name, active in [("add", args.add), ("remove", args.remove), ("patch", args.patch), ("reconcile", args.reconcile), ("compact", args.compact), ("index", args.index), ("import", args.import_store), ("verify", args.verify), ("materialize", args.materialize), ("recover", args.recover), ("audit", args.audit != ""), ("restore", args.restore != ""), ("query", args.query != ""), ("check", args.check != "")] if active]
+
+        if len(actions) == 0:
+            raise Exception("Debe indicar si desea agregar (add), eliminar (remove), parchar (patch), reconciliar (reconcile) o compactar (compact) los dominios, o bien indexar (index), importar (import), verificar (verify) o materializar (materialize) el almacen, recuperar un lote interrumpido (recover), auditar (audit) o restaurar las listas (restore), consultar (query) o revisar direcciones (check) en las listas.")
+        if len(actions) > 1:
+            raise Exception("Solo se permite agregar, remover, parchar, reconciliar, compactar, indexar, importar, verificar, materializar, recuperar, auditar, restaurar, consultar o revisar dominios de la lista blanca y/o negra, pero no varias opciones al mismo tiempo. Para agregar y eliminar en una sola pasada utilice patch.")
+        if args.jobs < 1:
+            raise Exception("El parametro jobs debe ser un entero mayor o igual a 1.")
+        if args.processes < 1:
+            raise Exception("El parametro processes debe ser un entero mayor o igual a 1.")
+        if args.store and not (args.add or args.remove):
+            raise Exception("El parametro store solo se admite junto con add o remove.")
+        if args.fix and not args.audit:
+            raise Exception("El parametro fix solo se admite junto con audit.")
+        if args.index or args.import_store or args.verify or args.materialize or args.recover or args.audit or args.query or args.check:
+            if args.whitelist or args.blacklist or args.allow or args.deny or args.auto or args.daemon or args.incremental or args.shared or args.journal or args.resume:
+                raise Exception("Los parametros index, import, verify, materialize, recover, audit, query y check no admiten los parametros whitelist, blacklist, allow, deny, auto, daemon, incremental, shared, journal ni resume.")
+        elif args.restore:
+            if args.whitelist or args.blacklist or args.auto or args.daemon or args.incremental or args.shared or args.store:
+                raise Exception("El parametro restore no admite los parametros whitelist, blacklist, auto, daemon, incremental, shared ni store; para elegir los usuarios utilice allow o deny.")
+        elif args.compact:
+            if args.whitelist or args.blacklist or args.auto or args.daemon or args.incremental:
+                raise Exception("El parametro compact no admite los parametros whitelist, blacklist, auto, daemon ni incremental; para elegir los usuarios utilice allow o deny.")
+        elif args.daemon and args.resume:
+            raise Exception("El parametro daemon no admite el parametro resume.")
+        elif args.auto:
+            if args.whitelist or args.blacklist or args.allow or args.deny:
+                raise Exception("No se pueden usar los parámetros whitelist, blacklist, allow o deny cuando el parametro auto esta activo.")
+        else:
+            if args.daemon:
+                raise Exception("El parametro daemon requiere indicar mediante auto la carpeta que se desea observar.")
+            if not (args.whitelist or args.blacklist):
+                raise Exception("Debe indicar como minimo el tipo de lista que desea modificar mediante los parametros whitelist y blacklist.")
+
+        list_filenames = {"whitelist": args.whitelist, "blacklist": args.blacklist}
+        filter_filenames = {"allow": args.allow, "deny": args.deny}
+
+        not_empty_filenames = {key: filename for (key, filename) in list_filenames.items() if filename != ""}
+        not_empty_filters = {key: filename for (key, filename) in filter_filenames.items() if filename != ""}
+
+        action = actions[0]
+
+        manager = SpamManager()
+        manager.progress = sys.stderr if args.progress else None
+        options = {"incremental": args.incremental, "index": args.index, "store": args.store, "journal": args.journal, "history": args.history, "resume": args.resume, "shared": args.shared, "subdomains": args.subdomains, "verbose": args.verbose}
+        tenants = len(manager.parameters["tenants"]) > 1
+
+        if tenants and (args.daemon or args.audit or args.restore or args.query or args.check):
+            raise Exception("Los parametros daemon, audit, restore, query y check solo admiten una carpeta de usuarios en source_path.")
+        if not tenants:
+            manager.configure(**options)
+
+        """
+        Cuando el parametro auto esta activado, se tomaran todos los archivos con nombres whitelist, blacklist,
+        allow y deny de la carpeta. Con el parametro daemon, en cambio, la carpeta indicada en auto no es un lote
+        sino la carpeta donde llegan los lotes. Con varias carpetas de usuarios, cada una se procesa como un dominio
+        aparte (ver TenantPool). El resumen de stats se escribe al terminar, incluso si la ejecucion falla.
+        """
+        try:
+            if args.auto != "" and not args.daemon:
+                not_empty_filenames, not_empty_filters = SpamManager.batch_filenames(args.auto)
+
+            if args.daemon:
+                SpamDaemon(manager, args.auto, action, args.jobs).run()
+            elif tenants:
+                TenantPool(manager, args.processes).run(action, not_empty_filenames, not_empty_filters, args.patch, args.jobs, options)
+            elif args.recover:
+                manager.recover()
+            elif action in SpamManager.maintenance:
+                getattr(manager, SpamManager.maintenance[action])(args.jobs)
+            elif args.audit:
+                output = sys.stdout if args.audit == "-" else open(args.audit, 'w')
+
+                try:
+                    manager.echo = output is not sys.stdout
+                    manager.audit(output, args.fix, args.jobs)
+                finally:
+                    if output is not sys.stdout:
+                        output.close()
+            elif args.restore:
+                lists, filters = SpamManager.load_batch({}, not_empty_filters)
+
+                manager.restore(args.restore, filters, args.jobs)
+            elif args.query:
+                entry = DomainTrie.canonical(args.query)
+
+                for key, matches in sorted(manager.query(args.query).items()):
+                    names = [user if domain == entry else user + " (" + domain + ")" for user, domain in matches]
+                    sys.stdout.write("{}: {}\n".format(key, ', '.join(names) if len(names) != 0 else 'ninguno'))
+            elif args.check:
+                source = sys.stdin if args.check == "-" else open(args.check)
+
+                """
+                Los resultados se escriben por bloques, ya que revisar una direccion toma menos que escribirla.
+                """
+                try:
+                    output = []
+
+                    for user, address, hits in manager.check(source):
+                        result = "invalida" if hits is None else ', '.join(key + " (" + hits[key] + ")" for key in sorted(hits)) or "ninguna"
+                        output.append("{} {}: {}\n".format(user, address, result))
+
+                        if len(output) == 10000:
+                            sys.stdout.write(''.join(output))
+                            output = []
+
+                    sys.stdout.write(''.join(output))
+                finally:
+                    if source is not sys.stdin:
+                        source.close()
+            else:
+                lists, filters = SpamManager.load_batch(not_empty_filenames, not_empty_filters, args.patch)
+
+                manager.apply(action, lists, filters, args.jobs)
+        except:
+            manager.stats.success = False
+            raise
+        finally:
+            SpamManager.flush()
+
+            if args.stats != "":
+                manager.stats.save(args.stats, args.stats_format)
+
+    except IOError as error:
+        parser.error("Una o muchas rutas de los archivos son invalidas.")
+    except Exception as error:
+        parser.error(error)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Pruebas de spager3 sobre un arbol de buzones temporal. Cada prueba crea su propia carpeta de usuarios y su propia
+configuracion, de modo que el manifiesto, el registro de lotes y el historial nunca se comparten entre pruebas.
+"""
+import sqlite3
+import sys
+from collections import Counter
+from os import remove, walk
+from os.path import abspath, dirname, exists, join, relpath
+from threading import Thread
+
+import pytest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import spager3
+from spager3 import AddressMatcher, BatchJournal, LogWriter, SpamManager
+
+WHITELIST = "*@a.cl\n*@b.cl\n\nx@c.cl\n"
+BLACKLIST = "*@spam.com\n*@junk.net"
+USERS = ["ana", "beto", "carla", "diego"]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    Crea cuatro usuarios con la misma lista blanca y negra, y retorna la carpeta raiz de la prueba.
+    """
+    for user in USERS:
+        folder = tmp_path / "mail" / user / ".spamassassin"
+        folder.mkdir(parents=True)
+        (folder / "whitelist").write_text(WHITELIST)
+        (folder / "blacklist").write_text(BLACKLIST)
+
+    (tmp_path / "log").mkdir()
+
+    return tmp_path
+
+
+def build(root, **options):
+    config = {"source_path": str(root / "mail") + "/"}
+
+    for name, filename in [("log_path", "history.log"), ("manifest_path", "manifest.json"), ("roster_path", "roster.json"), ("index_path", "index.db"), ("store_path", "policy.db"), ("journal_path", "journal.log"), ("checkpoint_path", "checkpoint.log"), ("history_path", "changes.db")]:
+        config[name] = str(root / "log" / filename)
+
+    manager = SpamManager(config)
+    manager.echo = False
+    manager.configure(**options)
+
+    return manager
+
+
+def lists(root):
+    result = {}
+
+    for folder, names, filenames in walk(str(root / "mail")):
+        for filename in filenames:
+            if not filename.startswith('.'):
+                with open(join(folder, filename)) as file:
+                    result[relpath(join(folder, filename), str(root / "mail"))] = file.read()
+
+    return result
+
+
+def entries(root):
+    return {path: Counter(line for line in content.splitlines() if line != '') for path, content in lists(root).items()}
+
+
+def batches(root):
+    connection = sqlite3.connect(str(root / "log" / "changes.db"))
+
+    try:
+        return connection.execute("SELECT batch, action FROM batches ORDER BY sequence").fetchall()
+    finally:
+        connection.close()
+
+
+def test_journal_recovery_rolls_back_uncommitted_batch(tree, monkeypatch):
+    before = lists(tree)
+
+    def crash(self):
+        raise RuntimeError("caida antes de confirmar")
+
+    monkeypatch.setattr(BatchJournal, "commit", crash)
+
+    with pytest.raises(RuntimeError):
+        build(tree, journal=True).apply("remove", {"whitelist": ["*@a.cl"], "blacklist": ["*@spam.com"]})
+
+    monkeypatch.undo()
+    assert lists(tree) == before
+
+    build(tree).recover()
+
+    assert lists(tree) == before
+    assert not exists(str(tree / "log" / "journal.log"))
+
+
+def test_journal_recovery_completes_committed_batch(tree, tmp_path_factory, monkeypatch):
+    reference = tmp_path_factory.mktemp("reference")
+    (reference / "log").mkdir()
+
+    for path, content in lists(tree).items():
+        (reference / "mail" / path).parent.mkdir(parents=True, exist_ok=True)
+        (reference / "mail" / path).write_text(content)
+
+    changes = {"whitelist": {"add": ["*@new.cl"], "remove": ["*@a.cl"]}, "blacklist": {"add": [], "remove": ["*@spam.com"]}}
+    build(reference).apply("patch", changes)
+
+    def partial(path, files):
+        SpamManager.replace(*files[0])
+        raise RuntimeError("caida durante el reemplazo")
+
+    monkeypatch.setattr(BatchJournal, "finish", staticmethod(partial))
+
+    with pytest.raises(RuntimeError):
+        build(tree, journal=True).apply("patch", changes)
+
+    monkeypatch.undo()
+    assert lists(tree) != lists(reference)
+
+    build(tree).recover()
+
+    assert lists(tree) == lists(reference)
+    assert not exists(str(tree / "log" / "journal.log"))
+
+
+@pytest.mark.parametrize("action, batch", [
+    ("add", {"whitelist": ["A.CL", "*@a.cl", "b.cl", "*@z.cl", "*@z.cl"], "blacklist": ["*@Spam.com", "spam.com", "*@new.com"]}),
+    ("remove", {"whitelist": ["A.CL", "*@a.cl", "b.cl", "x@c.cl"], "blacklist": ["*@Spam.com", "junk.net", "*@spam.com"]}),
+])
+def test_compacted_lists_give_the_same_result_as_the_linear_path(tree, tmp_path_factory, action, batch):
+    (tree / "mail" / "ana" / ".spamassassin" / "whitelist").write_text("*@b.cl\nB.CL\n*@a.cl\n\nx@c.cl\n*@zz.cl")
+    linear = tmp_path_factory.mktemp("linear")
+    (linear / "log").mkdir()
+
+    for path, content in lists(tree).items():
+        (linear / "mail" / path).parent.mkdir(parents=True, exist_ok=True)
+        (linear / "mail" / path).write_text(content)
+
+    for root in [tree, linear]:
+        build(root).apply("compact", {})
+
+    remove(str(linear / "log" / "manifest.json"))
+    assert lists(tree) == lists(linear)
+
+    fast = build(tree)
+    fast_summaries = fast.apply(action, batch)
+    slow = build(linear)
+    slow_summaries = slow.apply(action, batch)
+
+    assert fast.stats.counters["sorted_lookups"] == 8
+    assert slow.stats.counters["sorted_lookups"] == 0
+    assert lists(tree) == lists(linear)
+    assert [summary.split(", ", 2)[2] for summary in fast_summaries] == [summary.split(", ", 2)[2] for summary in slow_summaries]
+
+
+def test_restore_undoes_a_batch_and_the_batches_after_it(tree):
+    before = entries(tree)
+    manager = build(tree, history=True)
+    manager.apply("add", {"whitelist": ["*@new.cl"], "blacklist": ["*@evil.com"]})
+    manager.apply("remove", {"whitelist": ["*@a.cl"], "blacklist": ["*@spam.com"]})
+    first = batches(tree)[0][0]
+
+    build(tree).restore(first)
+
+    assert entries(tree) == before
+    assert [action for batch, action in batches(tree)] == ["add", "remove", "restore"]
+
+    restore = batches(tree)[-1][0]
+    build(tree).restore(restore)
+
+    assert all(content["*@new.cl"] == 1 and content["*@a.cl"] == 0 for path, content in entries(tree).items() if path.endswith("whitelist"))
+
+
+def test_audit_fix_records_removed_entries_in_the_history(tree):
+    whitelist = tree / "mail" / "ana" / ".spamassassin" / "whitelist"
+    whitelist.write_text("*@a.cl\nA.CL\nno es un dominio\n*@b.cl\n")
+    before = entries(tree)
+    output = tree / "audit.json"
+
+    with open(str(output), 'w') as file:
+        build(tree, history=True).audit(file, fix=True)
+
+    assert whitelist.read_text() == "*@a.cl\n*@b.cl\n"
+    assert [action for batch, action in batches(tree)] == ["audit"]
+
+    with open(str(output), 'w') as file:
+        build(tree).audit(file, fix=True)
+
+    assert [action for batch, action in batches(tree)] == ["audit"]
+
+    build(tree).restore(batches(tree)[0][0])
+
+    assert entries(tree)["ana/.spamassassin/whitelist"] == before["ana/.spamassassin/whitelist"]
+
+
+def test_incremental_runs_revisit_lists_edited_outside_the_program(tree):
+    batch = {"blacklist": ["*@evil.com"]}
+    build(tree, incremental=True).apply("add", batch)
+
+    manager = build(tree, incremental=True)
+    manager.apply("add", batch)
+    assert manager.stats.counters["current"] == len(USERS)
+
+    blacklist = tree / "mail" / "beto" / ".spamassassin" / "blacklist"
+    blacklist.write_text("*@spam.com\n")
+
+    manager = build(tree, incremental=True)
+    manager.apply("add", batch)
+
+    assert manager.stats.counters["current"] == len(USERS) - 1
+    assert blacklist.read_text() == "*@spam.com\n*@evil.com"
+
+
+def test_store_verify_detects_lists_edited_outside_the_store(tree):
+    build(tree).import_store()
+    build(tree).verify_store()
+
+    (tree / "mail" / "carla" / ".spamassassin" / "whitelist").write_text("*@otro.cl\n")
+
+    with pytest.raises(Exception) as error:
+        build(tree).verify_store()
+
+    assert "carla" in str(error.value)
+
+
+def test_log_writer_keeps_draining_when_stdout_fails(tree, monkeypatch):
+    class Broken:
+        def write(self, text):
+            raise BrokenPipeError(32, "Broken pipe")
+
+        def flush(self):
+            raise BrokenPipeError(32, "Broken pipe")
+
+    monkeypatch.setattr(spager3.sys, "stdout", Broken())
+    path = tree / "log" / "writer.log"
+    writer = LogWriter(str(path), "%(message)s")
+
+    def flood():
+        for number in range(2 * LogWriter.queue_size):
+            writer.write(f"mensaje {number}", "info")
+
+        writer.close()
+
+    thread = Thread(target=flood)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+
+    assert not thread.is_alive()
+    assert len(path.read_text().splitlines()) == 2 * LogWriter.queue_size
+
+
+@pytest.mark.parametrize("address, valid", [
+    ("jose@example.com", True),
+    ("example.com", True),
+    ("a@@example.com", False),
+    ("@example.com", False),
+    ("jose@", False),
+    ("*@example.com", False),
+    ("jo se@example.com", False),
+])
+def test_address_validation(address, valid):
+    assert AddressMatcher.valid(address) == valid